@@ -1,3 +1,5 @@
+import numpy as np
+
 class BitWriter:
     def __init__(self):
         self._buf = bytearray()
@@ -6,14 +8,18 @@ class BitWriter:
 
     def write_code(self, code: int, length: int):
         """Write 'length' bits of code (MSB-first)."""
-        for i in range(length - 1, -1, -1):
-            bit = (code >> i) & 1
-            self._cur = (self._cur << 1) | bit
-            self._nbits += 1
-            if self._nbits == 8:
-                self._buf.append(self._cur)
-                self._cur = 0
-                self._nbits = 0
+        self._cur = (self._cur << length) | (code & ((1 << length) - 1))
+        self._nbits += length
+        while self._nbits >= 8:
+            self._nbits -= 8
+            self._buf.append((self._cur >> self._nbits) & 0xFF)
+        self._cur &= (1 << self._nbits) - 1
+
+    def take_bytes(self) -> bytes:
+        """Return and drop the completed bytes so far (partial byte stays)."""
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
 
     def finish(self) -> bytes:
         """Pad remaining bits with zeros."""
@@ -38,3 +44,26 @@ class BitReader:
             self.bit = 0
             self.i += 1
         return b
+
+    def read_bits(self, n: int) -> int:
+        """Read n bits as an unsigned int (MSB-first)."""
+        v = 0
+        for _ in range(n):
+            v = (v << 1) | self.read_bit()
+        return v
+
+def pack_codes(codes, lengths) -> bytes:
+    """
+    Vectorized BitWriter: concatenate codes[i] (lengths[i] bits each, MSB-first)
+    and zero-pad the last byte, exactly as write_code() + finish() would.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    nbits = int(ends[-1]) if ends.size else 0
+    bits = np.zeros(nbits, dtype=np.uint8)
+    starts = ends - lengths
+    for j in range(int(lengths.max()) if lengths.size else 0):
+        m = lengths > j
+        bits[starts[m] + j] = (codes[m] >> (lengths[m] - 1 - j)) & 1
+    return np.packbits(bits).tobytes()
@@ -1,5 +1,7 @@
-import struct
+import io, mmap, struct, zlib
 from typing import List, Tuple
+import numpy as np
+from roi import pack_bits_u8, unpack_bits_u8
 
 MAGIC = b"MMIP"
 VERSION = 4
@@ -13,14 +15,52 @@ VERSION = 4
 # nstages(u8) reserved(3)
 HDR_FMT = "<4sBBBBHHHHHHIIH I B3s"
 HDR_SIZE = struct.calcsize(HDR_FMT)
+MAX_STAGES = 255  # nstages is a u8
+
+# Header flags
+FLAG_DIM32 = 0x01  # width/height exceed u16: stored as 0 above, real values follow in HDR32
+FLAG_STAGE_EXT = 0x02  # stage headers use STGX_FMT (u16 band bounds + successive-approximation Ah/Al)
+FLAG_INT_DCT = 0x04    # fixed-point integer DCT/IDCT (dct.block_*_int); decodes are bit-exact everywhere
+FLAG_SKIP = 0x08       # each stage payload starts with a coded-block bitmap; skipped blocks carry no symbols
+FLAG_CRC = 0x10        # CRC block follows the header (see CRC_FMT)
+FLAG_CAT = 0x20        # magnitude-category symbols: table values are categories, raw bits follow each code
+FLAG_ROI_FIRST = 0x40  # stage symbols code ROI blocks first, then the rest (raster order in each group)
+
+# Dimension extension (present iff FLAG_DIM32), right after the main header:
+# width(u32) height(u32)
+HDR32_FMT = "<II"
+HDR32_SIZE = struct.calcsize(HDR32_FMT)
+
+# CRC block (present iff FLAG_CRC), after the header and dimension extension:
+# maps_crc(u32) stage_crc(u32) * nstages
+# CRC32 (zlib) of the ROI + block-scale maps and of each whole stage
+# (stage header + table + payload), so integrity checks need no entropy decoding.
+CRC_FMT = "<I"
+CRC_SIZE = struct.calcsize(CRC_FMT)
 
 # Stage header:
 # k0(u8) k1(u8) table_len(u16) payload_len(u32)
+# With FLAG_SKIP the payload is ceil(nblocks/8) bytes of MSB-first coded bits
+# (1 = block has a nonzero value in this scan) followed by the symbols of the
+# coded blocks only; payload_len covers both.
+# With FLAG_ROI_FIRST the blocks' symbols follow the ROI map: blocks with ROI
+# bit 1 in raster order, then the others (the skip bitmap stays raster), so a
+# decoder can stop a stage once its ROI blocks are read.
 STG_FMT = "<BBHI"
 STG_SIZE = struct.calcsize(STG_FMT)
 
+# Extended stage header (FLAG_STAGE_EXT):
+# k0(u16) k1(u16) ah(u8) al(u8) table_len(u16) payload_len(u32)
+# ah=0: first scan of band [k0,k1), values are coefficients >> al (magnitude, sign kept)
+# ah>0: refinement scan, values are sign * bit 'al' of the magnitude (al = ah-1)
+STGX_FMT = "<HHBBHI"
+STGX_SIZE = struct.calcsize(STGX_FMT)
+
 # Huffman table entry:
 # run(u8) value(i16) codelen(u8)
+# With FLAG_CAT, value is the magnitude category c = bit length of |v| (1..16;
+# 0 only for EOB/ZRL) and every non-EOB/ZRL code is followed by c raw bits:
+# v if v > 0, else v + 2^c - 1 (rle.cat_split). Tables hold at most 256*16+2 entries.
 TBL_FMT = "<Bhb"
 TBL_SIZE = struct.calcsize(TBL_FMT)
 
@@ -29,16 +69,31 @@ def write_header(
     qstep_bg, qstep_roi,
     roi_bits, roi_bytes,
     sb_qscale, sb_bytes,
-    nstages
+    nstages, crcs=None
 ):
+    """crcs: [maps_crc, stage_crc...] for FLAG_CRC streams; None writes zeros to patch later."""
+    if width > 0xFFFF or height > 0xFFFF:
+        flags |= FLAG_DIM32
+    dim32 = bool(flags & FLAG_DIM32)
     f.write(struct.pack(
         HDR_FMT, MAGIC, VERSION, flags, bitdepth, blockN,
-        width, height, padW, padH,
+        0 if dim32 else width, 0 if dim32 else height, padW, padH,
         qstep_bg, qstep_roi,
         roi_bits, roi_bytes,
         sb_qscale, sb_bytes,
         nstages, b"\x00\x00\x00"
     ))
+    if dim32:
+        f.write(struct.pack(HDR32_FMT, width, height))
+    if flags & FLAG_CRC:
+        crcs = list(crcs) if crcs is not None else [0] * (1 + nstages)
+        if len(crcs) != 1 + nstages:
+            raise ValueError("need one CRC for the maps plus one per stage")
+        f.write(struct.pack(f"<{1 + nstages}I", *crcs))
+
+def header_size(flags: int, nstages: int = 0) -> int:
+    return (HDR_SIZE + (HDR32_SIZE if flags & FLAG_DIM32 else 0)
+            + (CRC_SIZE * (1 + nstages) if flags & FLAG_CRC else 0))
 
 def read_header(f):
     data = f.read(HDR_SIZE)
@@ -54,7 +109,12 @@ def read_header(f):
         raise ValueError("Bad magic")
     if ver != VERSION:
         raise ValueError(f"Unsupported version: {ver}")
-    return dict(
+    if flags & FLAG_DIM32:
+        ext = f.read(HDR32_SIZE)
+        if len(ext) != HDR32_SIZE:
+            raise ValueError("Malformed stream: dimension extension truncated")
+        width, height = struct.unpack(HDR32_FMT, ext)
+    h = dict(
         flags=flags, bitdepth=bitdepth, blockN=blockN,
         width=width, height=height, padW=padW, padH=padH,
         qstep_bg=qbg, qstep_roi=qroi,
@@ -62,16 +122,32 @@ def read_header(f):
         sb_qscale=sb_qscale, sb_bytes=sb_bytes,
         nstages=nstages
     )
+    if flags & FLAG_CRC:
+        data = f.read(CRC_SIZE * (1 + nstages))
+        if len(data) != CRC_SIZE * (1 + nstages):
+            raise ValueError("Malformed stream: CRC block truncated")
+        h["crcs"] = list(struct.unpack(f"<{1 + nstages}I", data))
+    return h
 
-def write_stage_header(f, k0: int, k1: int, table_len: int, payload_len: int):
-    f.write(struct.pack(STG_FMT, k0, k1, table_len, payload_len))
+def write_stage_header(f, k0: int, k1: int, table_len: int, payload_len: int, *, ext=False, ah=0, al=0):
+    if ext:
+        f.write(struct.pack(STGX_FMT, k0, k1, ah, al, table_len, payload_len))
+    else:
+        if ah or al:
+            raise ValueError("successive approximation needs extended stage headers")
+        f.write(struct.pack(STG_FMT, k0, k1, table_len, payload_len))
 
-def read_stage_header(f):
-    data = f.read(STG_SIZE)
-    if len(data) != STG_SIZE:
+def read_stage_header(f, ext=False):
+    size = STGX_SIZE if ext else STG_SIZE
+    data = f.read(size)
+    if len(data) != size:
         raise ValueError("Malformed stream: stage header truncated")
-    k0, k1, table_len, payload_len = struct.unpack(STG_FMT, data)
-    return dict(k0=k0, k1=k1, table_len=table_len, payload_len=payload_len)
+    if ext:
+        k0, k1, ah, al, table_len, payload_len = struct.unpack(STGX_FMT, data)
+    else:
+        k0, k1, table_len, payload_len = struct.unpack(STG_FMT, data)
+        ah = al = 0
+    return dict(k0=k0, k1=k1, ah=ah, al=al, table_len=table_len, payload_len=payload_len)
 
 def write_table(f, entries: List[Tuple[int, int, int]]):
     for run, val, L in entries:
@@ -80,6 +156,10 @@ def write_table(f, entries: List[Tuple[int, int, int]]):
         if not (1 <= L <= 31): raise ValueError("codelen out of range")
         f.write(struct.pack(TBL_FMT, run, int(val), int(L)))
 
+def stage_size(table_len: int, ext=False) -> int:
+    # bytes before the payload: stage header + table
+    return (STGX_SIZE if ext else STG_SIZE) + table_len * TBL_SIZE
+
 def read_table(f, table_len: int):
     out = []
     for _ in range(table_len):
@@ -89,3 +169,128 @@ def read_table(f, table_len: int):
         run, val, L = struct.unpack(TBL_FMT, data)
         out.append((int(run), int(val), int(L)))
     return out
+
+
+def write_v4(f, *, h, roi_blk: np.ndarray, sb_q: np.ndarray, stages):
+    """
+    Serialize a whole v4 stream.
+    h: header fields for write_header except roi_bits/roi_bytes/sb_bytes/nstages
+    stages: list of dict {k0,k1, table_entries, payload_bytes} (+ ah, al)
+    FLAG_CRC in h["flags"] fills the CRC block.
+    """
+    if any(st["k1"] > 0xFF or st.get("ah", 0) or st.get("al", 0) for st in stages):
+        h = dict(h, flags=h["flags"] | FLAG_STAGE_EXT)
+    ext = bool(h["flags"] & FLAG_STAGE_EXT)
+    roi_bytes = pack_bits_u8(roi_blk)
+    sb_bytes = np.ascontiguousarray(sb_q, dtype=np.uint8).tobytes(order="C")  # 1 byte per block
+    blobs = []
+    for st in stages:
+        buf = io.BytesIO()
+        write_stage_header(buf, st["k0"], st["k1"], len(st["table_entries"]), len(st["payload_bytes"]),
+                           ext=ext, ah=st.get("ah", 0), al=st.get("al", 0))
+        write_table(buf, st["table_entries"])
+        buf.write(st["payload_bytes"])
+        blobs.append(buf.getvalue())
+    crcs = None
+    if h["flags"] & FLAG_CRC:
+        crcs = [zlib.crc32(sb_bytes, zlib.crc32(roi_bytes))] + [zlib.crc32(b) for b in blobs]
+    write_header(
+        f, **h,
+        roi_bits=roi_blk.size, roi_bytes=len(roi_bytes),
+        sb_bytes=len(sb_bytes), nstages=len(stages), crcs=crcs
+    )
+    f.write(roi_bytes)
+    f.write(sb_bytes)
+    for b in blobs:
+        f.write(b)
+
+def read_v4(f, max_stages=None, partial_last: bool = False):
+    """
+    Parse a whole v4 stream: header, ROI map, block-scale map and stages.
+    max_stages: stop after this many stages (later stages are never read).
+    partial_last: the last stage read may be cut short (e.g. a FLAG_ROI_FIRST
+      file cut after the ROI part of that stage, see decode_v4 roi_only); its
+      payload is whatever is left, and decoding it checks that enough is there.
+    Returns (header, roi_blk uint8 (Hb,Wb), sb_q uint8 (Hb,Wb), stages_data).
+    """
+    h = read_header(f)
+
+    roi_bytes = f.read(h["roi_bytes"])
+    if len(roi_bytes) != h["roi_bytes"]:
+        raise ValueError("Malformed stream: ROI map truncated")
+    roi_flat = unpack_bits_u8(roi_bytes, h["roi_bits"])
+
+    Hb = (h["height"] + h["padH"]) // h["blockN"]
+    Wb = (h["width"] + h["padW"]) // h["blockN"]
+    roi_blk = roi_flat.reshape(Hb, Wb).astype(np.uint8)
+
+    sb_bytes = f.read(h["sb_bytes"])
+    if len(sb_bytes) != h["sb_bytes"]:
+        raise ValueError("Malformed stream: block-scale map truncated")
+    sb_q = np.frombuffer(sb_bytes, dtype=np.uint8).reshape(Hb, Wb)
+
+    n = h["nstages"] if max_stages is None else min(max_stages, h["nstages"])
+    stages_data = []
+    ext = bool(h["flags"] & FLAG_STAGE_EXT)
+    for si in range(n):
+        sh = read_stage_header(f, ext)
+        tbl = read_table(f, sh["table_len"])
+        payload = f.read(sh["payload_len"])
+        if len(payload) != sh["payload_len"] and not (partial_last and si == n - 1):
+            raise ValueError("Malformed stream: stage payload truncated")
+        stages_data.append(dict(k0=sh["k0"], k1=sh["k1"], ah=sh["ah"], al=sh["al"],
+                                table_entries=tbl, payload_bytes=payload))
+    return h, roi_blk, sb_q, stages_data
+
+def index_v4(f):
+    """
+    Like read_v4 but reads no map or payload bytes: returns (header, layout) with
+    absolute file offsets, for decoders that memory-map the stream.
+    layout: roi_offset, sb_offset, stages_offset, end,
+            stages=[{k0,k1,ah,al, table_entries, offset, payload_offset, payload_len}]
+    """
+    h = read_header(f)
+    roi_offset = f.tell()
+    sb_offset = roi_offset + h["roi_bytes"]
+    stages_offset = sb_offset + h["sb_bytes"]
+    f.seek(stages_offset)
+    stages = []
+    ext = bool(h["flags"] & FLAG_STAGE_EXT)
+    for _ in range(h["nstages"]):
+        offset = f.tell()
+        sh = read_stage_header(f, ext)
+        tbl = read_table(f, sh["table_len"])
+        stages.append(dict(k0=sh["k0"], k1=sh["k1"], ah=sh["ah"], al=sh["al"], table_entries=tbl,
+                           offset=offset, payload_offset=f.tell(), payload_len=sh["payload_len"]))
+        f.seek(sh["payload_len"], 1)
+    end = f.seek(0, 2)
+    if stages_offset > end or (stages and stages[-1]["payload_offset"] + stages[-1]["payload_len"] > end):
+        raise ValueError("Malformed stream: stage payload truncated")
+    return h, dict(roi_offset=roi_offset, sb_offset=sb_offset, stages_offset=stages_offset, end=end, stages=stages)
+
+def stream_crcs(buf, layout):
+    """
+    [maps_crc, stage_crc...] of a whole v4 stream held in buf (bytes, mmap, ...),
+    using the offsets from index_v4. Pure CRC32 over the regions, no decoding.
+    """
+    with memoryview(buf) as mv:
+        crcs = [zlib.crc32(mv[layout["roi_offset"]:layout["stages_offset"]])]
+        for st in layout["stages"]:
+            crcs.append(zlib.crc32(mv[st["offset"]:st["payload_offset"] + st["payload_len"]]))
+    return crcs
+
+def patch_crcs(f):
+    """
+    Fill in the CRC block of a FLAG_CRC stream that was written with
+    placeholder CRCs (f: real file opened for read + write).
+    """
+    f.flush()
+    f.seek(0)
+    h, layout = index_v4(f)
+    if not h["flags"] & FLAG_CRC:
+        raise ValueError("stream has no CRC block")
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        crcs = stream_crcs(mm, layout)
+    f.seek(layout["roi_offset"] - CRC_SIZE * len(crcs))  # CRC block ends where the maps start
+    f.write(struct.pack(f"<{len(crcs)}I", *crcs))
+    return crcs
@@ -0,0 +1,46 @@
+import numpy as np
+
+def output_buffer(out, height: int, width: int, dtype=np.uint16) -> np.ndarray:
+    """
+    Destination of a decode: a new (height, width) array, or the caller's
+    'out' (any writable view, e.g. a slice of a volume). dtype is uint16, or
+    the LUT's dtype for display decodes.
+    """
+    if out is None:
+        return np.empty((height, width), dtype=dtype)
+    if out.shape != (height, width):
+        raise ValueError(f"out shape mismatch: expected {(height, width)}, got {out.shape}")
+    if out.dtype != dtype:
+        raise ValueError(f"out must be {np.dtype(dtype)}, got {out.dtype}")
+    return out
+
+def window_lut(center: float, width: float) -> np.ndarray:
+    """
+    uint8 display value of every uint16 sample for a linear window
+    (DICOM VOI LUT function LINEAR, PS3.3 C.11.2.1.2).
+    """
+    if width < 1:
+        raise ValueError(f"window width must be >= 1, got {width}")
+    x = np.arange(65536, dtype=np.float64)
+    if width == 1:
+        return np.where(x > center - 0.5, 255, 0).astype(np.uint8)
+    y = ((x - (center - 0.5)) / (width - 1.0) + 0.5) * 255.0
+    return np.clip(np.round(y), 0, 255).astype(np.uint8)
+
+def store_rows(out: np.ndarray, r0: int, rows: np.ndarray, lut=None):
+    """
+    Clip reconstructed rows (float or int, may include padding) in place and
+    write the part that falls inside 'out' starting at row r0; the uint16
+    cast happens on assignment, so no full-size temporaries are made.
+    lut: optional 65536-entry table (e.g. window_lut) applied to the uint16
+    values on the way, so 'out' gets display values straight from the strip.
+    """
+    r1 = min(r0 + rows.shape[0], out.shape[0])
+    if r1 <= r0:
+        return
+    src = rows[:r1 - r0, :out.shape[1]]
+    np.clip(src, 0, 65535, out=src)
+    if lut is None:
+        out[r0:r1] = src
+    else:
+        out[r0:r1] = lut[src.astype(np.uint16)]
@@ -1,6 +1,7 @@
 import numpy as np
 from dct import dct_matrix, block_dct2, block_idct2
 from zigzag import zigzag_scan, zigzag_unscan
+from canvas import output_buffer, store_rows
 
 def pad_to_block(x: np.ndarray, N: int):
     H, W = x.shape
@@ -38,11 +39,17 @@ def encode_v1(x_u16: np.ndarray, blockN: int, qstep: int):
     meta = {"padW": padW, "padH": padH}
     return payload, meta
 
-def decode_v1(payload_i16: np.ndarray, *, width: int, height: int, padW: int, padH: int, blockN: int, qstep: int):
+def decode_v1(payload_i16: np.ndarray, *, width: int, height: int, padW: int, padH: int, blockN: int, qstep: int,
+              out=None):
+    """
+    out: optional preallocated uint16 (height, width) array to decode into.
+    Blocks are reconstructed one block row at a time and clipped into 'out'.
+    """
     C = dct_matrix(blockN)
     H = height + padH
     W = width + padW
-    out = np.zeros((H, W), dtype=np.float32)
+    out = output_buffer(out, height, width)
+    row = np.empty((blockN, W), dtype=np.float32)  # one block row, reused
 
     idx = 0
     for r in range(0, H, blockN):
@@ -51,10 +58,6 @@ def decode_v1(payload_i16: np.ndarray, *, width: int, height: int, padW: int, pa
             idx += 1
             qblk = zigzag_unscan(zz, blockN).astype(np.float32)
             coeff = qblk * float(qstep)
-            blk = block_idct2(coeff, C)
-            out[r:r+blockN, c:c+blockN] = blk
-
-    out = np.clip(out, 0, 65535).astype(np.uint16)
-    # crop padding
-    out = out[:height, :width]
+            row[:, c:c+blockN] = block_idct2(coeff, C)
+        store_rows(out, r, row)  # clip + crop padding
     return out
@@ -1,6 +1,7 @@
 import numpy as np
 from dct import dct_matrix, block_dct2, block_idct2
 from zigzag import zigzag_scan, zigzag_unscan
+from canvas import output_buffer, store_rows
 from rle import rle_encode, rle_decode, EOB
 from huff_canonical import build_code_lengths, canonical_codes_from_lengths, build_decode_trie, decode_one_symbol
 from bitpack import BitWriter, BitReader
@@ -64,9 +65,10 @@ def encode_v2(x_u16: np.ndarray, blockN: int, qstep: int):
     meta = {"padW": padW, "padH": padH, "nb": nb}
     return table_entries, payload_bytes, meta
 
-def decode_v2(payload_bytes: bytes, *, table_entries, width, height, padW, padH, blockN, qstep):
+def decode_v2(payload_bytes: bytes, *, table_entries, width, height, padW, padH, blockN, qstep, out=None):
     """
     table_entries: list of (run, val, codelen)
+    out: optional preallocated uint16 (height, width) array to decode into
     """
     # 1) Rebuild canonical codes from lengths
     lengths = {(run, val): L for (run, val, L) in table_entries}
@@ -81,7 +83,8 @@ def decode_v2(payload_bytes: bytes, *, table_entries, width, height, padW, padH,
     C = dct_matrix(blockN)
     br = BitReader(payload_bytes)
 
-    out = np.zeros((Hp, Wp), dtype=np.float32)
+    out = output_buffer(out, height, width)
+    row = np.empty((blockN, Wp), dtype=np.float32)  # one block row, reused
 
     # 2) Decode each block until EOB
     idx_block = 0
@@ -101,12 +104,11 @@ def decode_v2(payload_bytes: bytes, *, table_entries, width, height, padW, padH,
             zz = rle_decode(pairs, coeffs_per_block)
             qblk = zigzag_unscan(zz, blockN).astype(np.float32)
             coeff = qblk * float(qstep)
-            blk = block_idct2(coeff, C)
-            out[r:r+blockN, c:c+blockN] = blk
+            row[:, c:c+blockN] = block_idct2(coeff, C)
 
             idx_block += 1
             if idx_block > nb:
                 raise ValueError("Corrupt stream: too many blocks decoded")
+        store_rows(out, r, row)  # clip + crop padding
 
-    out = np.clip(out, 0, 65535).astype(np.uint16)
-    return out[:height, :width]
+    return out
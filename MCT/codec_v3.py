@@ -1,6 +1,7 @@
 import numpy as np
 from dct import dct_matrix, block_dct2, block_idct2
 from zigzag import zigzag_scan, zigzag_unscan
+from canvas import output_buffer, store_rows
 from rle import rle_encode, rle_decode, EOB
 from huff_canonical import build_code_lengths, canonical_codes_from_lengths, build_decode_trie, decode_one_symbol
 from bitpack import BitWriter, BitReader
@@ -79,10 +80,12 @@ def encode_v3(x_u16: np.ndarray, *, blockN: int, qstep_bg: int, qstep_roi: int,
     meta = dict(padW=padW, padH=padH, Hb=Hb, Wb=Wb)
     return stages, meta
 
-def decode_v3(*, stages_data, width, height, padW, padH, blockN, qstep_bg, qstep_roi, block_roi_01, stages_to_decode: int):
+def decode_v3(*, stages_data, width, height, padW, padH, blockN, qstep_bg, qstep_roi, block_roi_01, stages_to_decode: int,
+              out=None):
     """
     stages_data: list of dict {k0,k1, table_entries, payload_bytes} length=nstages
     stages_to_decode: decode first N stages (1..nstages)
+    out: optional preallocated uint16 (height, width) array to decode into
     """
     Hp = height + padH
     Wp = width + padW
@@ -122,7 +125,8 @@ def decode_v3(*, stages_data, width, height, padW, padH, blockN, qstep_bg, qstep
             zz_acc[bi, k0:k1] = vec[k0:k1]
 
     # Reconstruct spatial image block-by-block with ROI-aware inverse scaling
-    out = np.zeros((Hp, Wp), dtype=np.float32)
+    out = output_buffer(out, height, width)
+    row = np.empty((blockN, Wp), dtype=np.float32)  # one block row, reused
     bi = 0
     for br in range(Hb):
         for bc in range(Wb):
@@ -130,10 +134,8 @@ def decode_v3(*, stages_data, width, height, padW, padH, blockN, qstep_bg, qstep
             qblk = zigzag_unscan(zz_acc[bi], blockN).astype(np.float32)
             bi += 1
             coeff = qblk * float(qstep)
-            blk = block_idct2(coeff, C)
-            r = br * blockN
             c = bc * blockN
-            out[r:r+blockN, c:c+blockN] = blk
+            row[:, c:c+blockN] = block_idct2(coeff, C)
+        store_rows(out, br * blockN, row)  # clip + crop padding
 
-    out = np.clip(out, 0, 65535).astype(np.uint16)
-    return out[:height, :width]
+    return out
@@ -1,10 +1,14 @@
 import numpy as np
-from dct import dct_matrix, block_dct2, block_idct2
-from zigzag import zigzag_scan, zigzag_unscan
-from rle import rle_encode, rle_decode, EOB
-from huff_canonical import build_code_lengths, canonical_codes_from_lengths, build_decode_trie, decode_one_symbol
-from bitpack import BitWriter, BitReader
-from phys_quant import block_stats, attenuation_scale, noise_scale, stage_freq_matrix, quantize_block_scale
+from dct import (dct_matrix, block_dct2, block_idct2, block_idct2_scaled,
+                 block_dct2_int, block_idct2_int, COEF_FRAC_BITS)
+from zigzag import zigzag_rc
+from rle import rle_encode_band, cat_split, EOB, ZRL
+from huff_canonical import build_code_lengths, canonical_codes_from_lengths, VecSymbolReader
+from bitpack import BitWriter
+from roi import pack_bits_u8, unpack_bits_u8
+from canvas import output_buffer, store_rows
+from bitstream_v4 import FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST, MAX_STAGES
+from phys_quant import attenuation_scale, noise_scale, stage_freq_matrix, quantize_block_scale
 
 def qmin_for_stage(stage_id: int) -> float:
     # 防溢位的最小量化步階（對 16-bit + 8x8 很安全）
@@ -27,94 +31,663 @@ def stage_ranges_for_8x8():
     # spectral selection over zigzag positions: [k0,k1)
     return [(0, 1), (1, 10), (10, 64)]
 
-def stage_id_from_range(k0, k1):
+def stage_id_from_range(k0, k1, ranges=None):
+    # ranges given: id = band index (0=DC band, 1=first AC band, 2+=higher bands)
+    if ranges is not None:
+        return list(ranges).index((k0, k1))
     if (k0, k1) == (0, 1): return 0
     if (k0, k1) == (1, 10): return 1
     return 2
 
-def encode_v4(x_u16: np.ndarray, *, blockN: int, qstep_bg: int, qstep_roi: int, block_roi_01: np.ndarray, sb_qscale: int = 16):
-    """
-    Returns:
-      roi_map: uint8 0/1 (Hb,Wb)
-      sb_q: uint8 (Hb,Wb) quantized block-scale
-      stages: list {k0,k1, table_entries, payload_bytes}
-      meta: padW,padH,Hb,Wb
-    """
-    assert x_u16.dtype == np.uint16 and x_u16.ndim == 2
-    x_pad, padW, padH = pad_to_block(x_u16, blockN)
-    H, W = x_pad.shape
-    Hb, Wb = H // blockN, W // blockN
-    if block_roi_01.shape != (Hb, Wb):
-        raise ValueError(f"block_roi_01 mismatch: expected {(Hb,Wb)}, got {block_roi_01.shape}")
-
-    # ---- Physics block scale (encoder side) ----
-    mu_blk, sd_blk = block_stats(x_pad, blockN)
+def block_scale_q(mu_blk: np.ndarray, sd_blk: np.ndarray, sb_qscale: int) -> np.ndarray:
+    """Physics block scale (attenuation x noise) quantized to the stored uint8 map."""
     s_att = attenuation_scale(mu_blk, tau=9000.0, kappa=1200.0, alpha=1.5)
     s_noise = noise_scale(mu_blk, sd_blk, lam=0.8, c=300.0)
     s_block = s_att * s_noise  # float (Hb,Wb)
-    sb_q = quantize_block_scale(s_block, qscale=sb_qscale)  # uint8 map stored in bitstream
-    # decoder uses sb = sb_q / sb_qscale
-    sb = (sb_q.astype(np.float32) / float(sb_qscale))
-    sb = np.clip(sb, 1.0, 1.6)
+    return quantize_block_scale(s_block, qscale=sb_qscale)
+
+def default_stage_bounds(blockN: int):
+    """
+    Interior zigzag boundaries of the default spectral partition.
+    8x8 keeps [1, 10] (DC | diagonals 1-3 | rest); other sizes use the same
+    shape: DC, then the first ~3N/8 anti-diagonals, then the rest.
+    """
+    if blockN == 8:
+        return [k1 for (_, k1) in stage_ranges_for_8x8()[:-1]]
+    d = max(1, (3 * blockN) // 8)
+    return [1, (d + 1) * (d + 2) // 2]
+
+def stage_ranges(blockN: int, bounds=None):
+    """
+    Spectral bands [k0,k1) over zigzag positions.
+    bounds: interior boundaries, e.g. [1, 10] -> (0,1), (1,10), (10,64) for 8x8.
+    """
+    K = blockN * blockN
+    b = default_stage_bounds(blockN) if bounds is None else sorted(set(int(v) for v in bounds))
+    if any(not (0 < v < K) for v in b):
+        raise ValueError(f"stage bounds must lie in (0, {K}), got {b}")
+    edges = [0] + b + [K]
+    return list(zip(edges[:-1], edges[1:]))
+
+def stage_plan(blockN: int, sa_al: int = 0, bounds=None):
+    """
+    Stage list as (k0, k1, ah, al), in stream order.
+    sa_al=0 is the plain spectral progression. sa_al>0 sends the last
+    (high-frequency) band as coefficients >> sa_al, followed by one refinement
+    stage per bit plane sa_al-1 .. 0 (progressive-JPEG style Ah/Al).
+    bounds: see stage_ranges(). At most MAX_STAGES stages in all.
+    """
+    if not (0 <= sa_al <= 15):
+        raise ValueError(f"sa_al must lie in [0, 15] (bit planes of a 16-bit coefficient), got {sa_al}")
+    ranges = stage_ranges(blockN, bounds)
+    plan = [(k0, k1, 0, 0) for (k0, k1) in ranges[:-1]]
+    k0, k1 = ranges[-1]
+    plan.append((k0, k1, 0, sa_al))
+    for b in range(sa_al - 1, -1, -1):
+        plan.append((k0, k1, b + 1, b))
+    if len(plan) > MAX_STAGES:
+        raise ValueError(f"{len(plan)} stages exceed the stream limit of {MAX_STAGES} (nstages is a u8)")
+    return plan
+
+def sa_scan_values(zzq: np.ndarray, ah: int, al: int) -> np.ndarray:
+    """Values carried by one scan: |q| >> al (first scan) or bit al of |q| (refinement), sign kept."""
+    mag = np.abs(zzq.astype(np.int32))
+    v = (mag >> al) if ah == 0 else ((mag >> al) & 1)
+    return (np.sign(zzq) * v).astype(np.int16)
+
+def merge_scan(acc: np.ndarray, vals: np.ndarray, ah: int, al: int):
+    """Fold one decoded scan into the accumulated quantized band (in place)."""
+    v = vals.astype(np.int16) << al
+    if ah == 0:
+        acc[...] = v
+    else:
+        acc += v
+
+def to_blocks(x_rows: np.ndarray, N: int) -> np.ndarray:
+    """(rows, W) with both multiples of N -> (nblocks, N, N) float32 in raster order."""
+    h, w = x_rows.shape
+    b = x_rows.reshape(h // N, N, w // N, N).swapaxes(1, 2).reshape(-1, N, N)
+    return b.astype(np.float32)
+
+def from_blocks(blks: np.ndarray, Hb: int, Wb: int) -> np.ndarray:
+    """Inverse of to_blocks: (Hb*Wb, N, N) -> (Hb*N, Wb*N)."""
+    N = blks.shape[-1]
+    return blks.reshape(Hb, Wb, N, N).swapaxes(1, 2).reshape(Hb * N, Wb * N)
+
+def forward_zz(blocks: np.ndarray, C: np.ndarray) -> np.ndarray:
+    """Batched block DCT, returned in zigzag order: (n, N, N) -> (n, N*N)."""
+    rows, cols = zigzag_rc(C.shape[0])
+    return block_dct2(blocks, C)[:, rows, cols]
+
+def forward_zz_int(blocks: np.ndarray, N: int) -> np.ndarray:
+    """forward_zz through the fixed-point DCT; float32 out, exact for 8x8 16-bit data."""
+    rows, cols = zigzag_rc(N)
+    X = block_dct2_int(blocks, N)[:, rows, cols]
+    return X.astype(np.float32) / np.float32(1 << COEF_FRAC_BITS)
+
+def dequant_int(zz: np.ndarray, qbase: np.ndarray, sb_q: np.ndarray, sb_qscale: int) -> np.ndarray:
+    """
+    Integer form of zz * qbase * (sb_q / sb_qscale), per block (first axis),
+    with COEF_FRAC_BITS fraction bits, rounded half up.
+    """
+    step = (qbase.astype(np.int64) * sb_q.astype(np.int64)).reshape((-1,) + (1,) * (zz.ndim - 1))
+    num = (zz.astype(np.int64) * step) << COEF_FRAC_BITS
+    d = int(sb_qscale)
+    return (num + d // 2) // d
+
+def unique_rows(a: np.ndarray):
+    """
+    Distinct rows of a 2D array, compared bytewise (packed rows, one np.unique).
+    Returns (first, inverse): a[first] are the distinct rows, a == a[first][inverse].
+    """
+    a = np.ascontiguousarray(a)
+    packed = a.view(np.dtype((np.void, a.dtype.itemsize * a.shape[1]))).ravel()
+    _, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+    return first, inverse.reshape(-1)
+
+def _idct_live(coef_zz: np.ndarray, live: np.ndarray, idct, blockN: int, dtype, dedup: bool, stats):
+    """
+    Scatter IDCTs of the dequantized zigzag rows of the live blocks into a
+    (len(live), N, N) array; all-zero blocks stay 0. dedup: transform each
+    distinct row once. stats: optional dict, counts added under blocks,
+    zero, idct.
+    """
+    rows, cols = zigzag_rc(blockN)
+    nl = coef_zz.shape[0]
+    first = inverse = None
+    if dedup and nl:
+        first, inverse = unique_rows(coef_zz)
+        coef_zz = coef_zz[first]
+    coef = np.zeros((coef_zz.shape[0], blockN, blockN), dtype=dtype)
+    coef[:, rows, cols] = coef_zz
+    pix = idct(coef)
+    blks = np.zeros((live.size, blockN, blockN), dtype=dtype)
+    blks[live] = pix if inverse is None else pix[inverse]
+    if stats is not None:
+        stats["blocks"] = stats.get("blocks", 0) + live.size
+        stats["zero"] = stats.get("zero", 0) + live.size - nl
+        stats["idct"] = stats.get("idct", 0) + coef.shape[0]
+    return blks
+
+def reconstruct_rows_int(zz: np.ndarray, qbase: np.ndarray, sb_q: np.ndarray, sb_qscale: int,
+                         blockN: int, Wb: int, live=None, dedup: bool = False, stats=None) -> np.ndarray:
+    """
+    Integer-path reconstruction of whole block rows.
+    zz: int16 (rows*Wb, K) accumulated q-coeffs; qbase, sb_q: (rows*Wb,)
+    live: optional bool (rows*Wb,), blocks outside it are all-zero and skip the IDCT
+    dedup, stats: as reconstruct_rows
+    Returns int64 pixels (rows*N, Wb*N), not yet clipped (see canvas.store_rows).
+    """
+    if live is None:
+        live = np.ones(zz.shape[0], dtype=bool)
+    coef = dequant_int(zz[live], qbase[live], sb_q[live], sb_qscale)
+    blks = _idct_live(coef, live, lambda c: block_idct2_int(c, blockN), blockN, np.int64, dedup, stats)
+    return from_blocks(blks, zz.shape[0] // Wb, Wb)
 
+def reconstruct_rows(zz: np.ndarray, roi01: np.ndarray, sb_q: np.ndarray, *, qstep_bg, qstep_roi,
+                     sb_qscale: int, blockN: int, Wb: int, live=None, int_dct: bool = False,
+                     dedup: bool = False, stats=None) -> np.ndarray:
+    """
+    Dequantize + IDCT whole block rows (decoder side, qbase * sb per block).
+    zz: int16 (rows*Wb, K) accumulated q-coeffs; roi01, sb_q: (rows*Wb,)
+    live: optional bool (rows*Wb,), blocks outside it are all-zero and skip the IDCT
+    dedup: blocks with identical dequantized coefficients share one IDCT
+      (same pixels, bit for bit; pays off only when many blocks repeat)
+    stats: optional dict accumulating blocks / zero / idct counts
+    Returns float32 (int64 with int_dct) pixels (rows*N, Wb*N), not yet clipped.
+    """
+    if int_dct:
+        qbase_i = np.where(roi01 == 1, qstep_roi, qstep_bg)
+        return reconstruct_rows_int(zz, qbase_i, sb_q, sb_qscale, blockN, Wb, live, dedup, stats)
+    if live is None:
+        live = np.ones(zz.shape[0], dtype=bool)
+    qbase = np.where(roi01 == 1, np.float32(qstep_roi), np.float32(qstep_bg))
+    sb = sb_q.astype(np.float32) / float(sb_qscale)
+    coef = zz[live].astype(np.float32) * (qbase * sb)[live, None]
     C = dct_matrix(blockN)
-    ranges = stage_ranges_for_8x8() if blockN == 8 else [(0, blockN*blockN)]
+    blks = _idct_live(coef, live, lambda c: block_idct2(c, C), blockN, np.float32, dedup, stats)
+    return from_blocks(blks, zz.shape[0] // Wb, Wb)
 
-    stages = []
-    # For each stage: build symbol stream + huffman + payload
-    for (k0, k1) in ranges:
+def quantize_stage(coeff_zz: np.ndarray, qb: np.ndarray, k0: int, k1: int, blockN: int, sid=None,
+                   out=None, work=None) -> np.ndarray:
+    """
+    Vectorized form of the encode_v4 per-block quantizer for one stage.
+    qb: (n,) float32 base step per block (ROI qstep * clipped sb)
+    sid: band index for the MTF weight / qmin (default: the 8x8 mapping)
+    out, work: optional int16 / float32 (n, k1-k0) arrays to quantize in (no allocation)
+    Returns int16 (n, k1-k0).
+    """
+    if sid is None:
         sid = stage_id_from_range(k0, k1)
-        M = stage_freq_matrix(blockN, sid)            # (N,N)
-        Mzz = zigzag_scan(M).astype(np.float32)       # (N*N,)
+    Mzz = stage_freq_matrix(blockN, sid)[zigzag_rc(blockN)]
+    if out is None:
+        Qzz = np.maximum(qb[:, None] * Mzz[None, k0:k1], qmin_for_stage(sid))
+        return np.round(coeff_zz[:, k0:k1] / Qzz).astype(np.int16)
+    np.multiply(qb[:, None], Mzz[None, k0:k1], out=work)
+    np.maximum(work, qmin_for_stage(sid), out=work)
+    np.divide(coeff_zz[:, k0:k1], work, out=work)
+    np.round(work, out=work)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+def skip_map_bytes(nb: int) -> int:
+    """Length of a stage's coded-block bitmap (FLAG_SKIP streams)."""
+    return (nb + 7) // 8
+
+def split_skip_payload(payload, nb: int):
+    """FLAG_SKIP stage payload -> (coded uint8 0/1 (nb,), entropy-coded part)."""
+    m = skip_map_bytes(nb)
+    if len(payload) < m:
+        raise ValueError("Malformed stream: skip bitmap truncated")
+    return unpack_bits_u8(payload[:m], nb), memoryview(payload)[m:]
+
+class SparseCoeffs:
+    """
+    Decoder-side quantized coefficients of a whole image as
+    (block index, zigzag position, value) triplets, one chunk per decoded scan
+    (block indices ascending inside a chunk). Scans of a band add up, as in
+    merge_scan. Memory follows the nonzero count; dense() builds block rows on
+    demand, one strip at a time.
+    """
+    def __init__(self, nb: int, K: int):
+        self.nb, self.K = nb, K
+        self.chunks = []
+
+    def clear(self):
+        """Drop every scan (reuse for the next image of the same shape)."""
+        self.chunks.clear()
+
+    @property
+    def nnz(self) -> int:
+        return sum(blk.size for blk, _, _ in self.chunks)
+
+    def add_scan(self, blk, pos, val, al: int = 0):
+        blk = np.asarray(blk, dtype=np.int32)
+        pos = np.asarray(pos, dtype=np.uint16)
+        val = np.asarray(val, dtype=np.int16)
+        if blk.size:
+            self.chunks.append((blk, pos, val << al if al else val))
+
+    def dense(self, b0: int, b1: int, out=None) -> np.ndarray:
+        """int16 (b1-b0, K) accumulated q-coeffs of blocks [b0, b1) (into 'out' if given)."""
+        if out is None:
+            out = np.zeros((b1 - b0, self.K), dtype=np.int16)
+        else:
+            out.fill(0)
+        for blk, pos, val in self.chunks:
+            i0, i1 = np.searchsorted(blk, [b0, b1])
+            out[blk[i0:i1] - b0, pos[i0:i1]] += val[i0:i1]  # (block, pos) unique within a scan
+        return out
+
+class DenseCoeffs:
+    """SparseCoeffs interface over a dense int16 (nb, K) array, e.g. a v1 payload memmap (no copy)."""
+    def __init__(self, zz: np.ndarray):
+        self.zz = zz
 
-        block_streams = []
-        symbols = []
+    def dense(self, b0: int, b1: int, out=None) -> np.ndarray:
+        if out is None:
+            return self.zz[b0:b1]
+        out[...] = self.zz[b0:b1]
+        return out
 
-        for br in range(Hb):
-            for bc in range(Wb):
-                r = br * blockN
-                c = bc * blockN
-                blk = x_pad[r:r+blockN, c:c+blockN].astype(np.float32)
-                coeff = block_dct2(blk, C)
-                coeff_zz = zigzag_scan(coeff).astype(np.float32)
+class SparseStageReader:
+    """
+    Incremental entropy decode of one stage payload (skip bitmap already split
+    off) into (block, zigzag position, value) triplets of the nonzero
+    coefficients inside [k0, k1). read(blocks) decodes the next len(blocks)
+    coded blocks, which are 'blocks' in coding order. The Huffman codes are
+    resolved in bulk (huff_canonical.VecSymbolReader) and the runs are turned
+    into positions with a per-block cumulative sum, a chunk at a time, so the
+    working memory does not grow with the stage.
+    cat: (run, category) symbols with raw magnitude bits (FLAG_CAT).
+    """
+    def __init__(self, payload, table_entries, k0: int, k1: int, K: int, cat: bool = False):
+        lengths = {(run, val): L for (run, val, L) in table_entries}
+        if not lengths:
+            raise ValueError("Empty Huffman table")
+        extra = None
+        if cat:
+            if any(c > 16 for (_, c) in lengths):
+                raise ValueError("Corrupt stream: magnitude category > 16")
+            extra = {sym: sym[1] for sym in lengths}
+        self.reader = VecSymbolReader(payload, lengths, EOB, extra)
+        self.sym_run = np.array([r for (r, _) in self.reader.syms], dtype=np.int64)
+        self.sym_val = np.array([v for (_, v) in self.reader.syms], dtype=np.int64)
+        self.k0, self.k1, self.K, self.cat = k0, k1, K, cat
+
+    def read(self, blocks: np.ndarray):
+        """(int32 blocks, uint16 positions, int16 values) of the next coded blocks, in coding order."""
+        blk, pos, val = [], [], []
+        done = 0
+        while done < blocks.size:
+            seq, raw = self.reader.read(blocks.size - done)
+            runs, vals = self.sym_run[seq], self.sym_val[seq]
+            is_eob = (runs == EOB[0]) & (vals == EOB[1])
+            is_zrl = (runs == ZRL[0]) & (vals == ZRL[1])
+            step = np.where(is_zrl, 255, runs + 1)
+            step[is_eob] = 0
+            cs = np.cumsum(step)
+            bno = np.cumsum(is_eob) - is_eob                    # block ordinal of each symbol
+            base = np.concatenate([[0], cs[is_eob][:-1]])       # position count before each block
+            p = cs - base[bno] - 1
+            if np.any(p[~is_eob] >= self.K):
+                raise ValueError("RLE decode overflow (corrupt stream or bug)")
+
+            keep = ~is_eob & ~is_zrl & (p >= self.k0) & (p < self.k1)
+            vals = vals[keep]
+            if self.cat:
+                c, r = vals, raw[keep]
+                vals = np.where((r >> np.maximum(c - 1, 0)) & 1, r, r - (1 << c) + 1)
+            blk.append(blocks[done + bno[keep]])
+            pos.append(p[keep].astype(np.uint16))
+            val.append(vals.astype(np.int16))
+            done += int(is_eob.sum())
+        if not blk:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.int16)
+        return np.concatenate(blk), np.concatenate(pos), np.concatenate(val)
+
+def decode_stage_sparse(st, nb: int, K: int, skip: bool = False, cat: bool = False,
+                        order=None, head=None):
+    """
+    Entropy-decode one stage straight into triplets: returns int32 block
+    indices, uint16 zigzag positions and int16 values of the nonzero
+    coefficients inside [k0, k1). No dense per-block vector is built (see
+    SparseStageReader).
+    cat: (run, category) symbols with raw magnitude bits (FLAG_CAT).
+    order: block coding order (FLAG_ROI_FIRST, see roi_first_order); triplets
+      still come back sorted by block.
+    head: decode only the blocks order[:head]; the rest of the payload is
+      never read, so it may be missing.
+    """
+    payload = st["payload_bytes"]
+    blocks = np.arange(nb, dtype=np.int32) if order is None else np.asarray(order, dtype=np.int32)
+    if head is not None:
+        blocks = blocks[:head]
+    if skip:
+        coded, payload = split_skip_payload(payload, nb)
+        blocks = blocks[coded[blocks] != 0]
+    if blocks.size == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.int16)
+
+    blk, pos, vals = SparseStageReader(payload, st["table_entries"], st["k0"], st["k1"], K, cat).read(blocks)
+    if order is not None:
+        srt = np.argsort(blk, kind="stable")
+        blk, pos, vals = blk[srt], pos[srt], vals[srt]
+    return blk, pos, vals
+
+def analyze_v4(x_u16: np.ndarray, *, blockN: int, sb_qscale: int = 16, bone_threshold=None, int_dct: bool = False):
+    """
+    Quality-independent half of encode_v4: padding, block-scale map, block DCT
+    (fixed-point if int_dct) and (optionally) the phantom-threshold ROI map.
+    Returns dict: coeff_zz float32 (nb, N*N), sb_q uint8 (Hb,Wb),
+      roi_blk uint8 (Hb,Wb) or None, padW, padH, Hb, Wb, blockN, sb_qscale, int_dct.
+    """
+    assert x_u16.dtype == np.uint16 and x_u16.ndim == 2
+    x_pad, padW, padH = pad_to_block(x_u16, blockN)
+    H, W = x_pad.shape
+    Hb, Wb = H // blockN, W // blockN
+    blocks = to_blocks(x_pad, blockN)
 
-                # ROI base step (hard clinical priority) + physics soft scale + stage MTF weight
-                qbase = float(qstep_roi if block_roi_01[br, bc] == 1 else qstep_bg)
-                Qzz = (qbase * float(sb[br, bc])) * Mzz  # per-coefficient step
-                Qzz = np.maximum(Qzz, qmin_for_stage(sid))
+    # ---- Physics block scale (encoder side) ----
+    mu_blk = blocks.mean(axis=(1, 2)).reshape(Hb, Wb)
+    sd_blk = blocks.std(axis=(1, 2)).reshape(Hb, Wb)
+    sb_q = block_scale_q(mu_blk, sd_blk, sb_qscale)  # uint8 map stored in bitstream
+
+    roi_blk = None
+    if bone_threshold is not None:
+        # same rule as roi.block_roi_map(roi_mask_from_phantom(x_pad)): any pixel >= threshold
+        roi_blk = (blocks >= float(bone_threshold)).any(axis=(1, 2)).astype(np.uint8).reshape(Hb, Wb)
 
-                zzq = np.zeros(blockN * blockN, dtype=np.int16)
-                zzq[k0:k1] = np.round(coeff_zz[k0:k1] / Qzz[k0:k1]).astype(np.int16)
+    if int_dct:
+        coeff_zz = forward_zz_int(blocks, blockN)
+    else:
+        coeff_zz = forward_zz(blocks, dct_matrix(blockN))
+    return dict(coeff_zz=coeff_zz, sb_q=sb_q, roi_blk=roi_blk,
+                padW=padW, padH=padH, Hb=Hb, Wb=Wb, blockN=blockN, sb_qscale=sb_qscale, int_dct=int_dct)
 
-                pairs = rle_encode(zzq)
-                block_streams.append(pairs)
-                symbols.extend(pairs)
+def roi_first_order(block_roi_01: np.ndarray) -> np.ndarray:
+    """
+    Block coding order of FLAG_ROI_FIRST stages: ROI blocks, then the rest,
+    raster order inside each group. Follows from the stored ROI map alone.
+    """
+    roi = block_roi_01.reshape(-1)
+    return np.concatenate([np.flatnonzero(roi), np.flatnonzero(roi == 0)])
 
-        if len(symbols) == 0:
-            symbols = [EOB]
+def entropy_code_stage(zzq: np.ndarray, k0: int, k1: int, skip: bool = False, cat: bool = False,
+                       order=None, head=None):
+    """
+    RLE + canonical Huffman for one stage.
+    zzq: int16 (nb, k1-k0) quantized band of every block, raster order.
+    skip: prefix the coded-block bitmap and code only blocks with a nonzero value.
+    cat: code (run, magnitude category) symbols + raw bits (FLAG_CAT).
+    order: block coding order (default raster; see roi_first_order). The skip
+      bitmap stays in raster order.
+    head: also report head_bytes, the payload prefix that holds order[:head].
+    Returns dict {k0,k1, table_entries, payload_bytes[, head_bytes]}.
+    """
+    blocks = np.arange(zzq.shape[0]) if order is None else np.asarray(order)
+    nhead = blocks.size if head is None else head
+    if skip:
+        coded = zzq.any(axis=1)
+        sel = coded[blocks]
+        nhead = int(np.count_nonzero(sel[:nhead]))
+        blocks = blocks[sel]
+    block_streams = [rle_encode_band(zzq[i], k0) for i in blocks]
+    if cat:
+        block_streams = [[cat_split(sym) for sym in pairs] for pairs in block_streams]
+        symbols = [sym for items in block_streams for (sym, _, _) in items]
+    else:
+        symbols = [sym for pairs in block_streams for sym in pairs]
+    if len(symbols) == 0:
+        symbols = [EOB]
 
-        lengths = build_code_lengths(symbols)
-        codes = canonical_codes_from_lengths(lengths)
+    lengths = build_code_lengths(symbols)
+    codes = canonical_codes_from_lengths(lengths)
 
-        bw = BitWriter()
+    bw = BitWriter()
+    if cat:
+        for items in block_streams:
+            for sym, raw, n in items:
+                code, L = codes[sym]
+                bw.write_code((code << n) | raw, L + n)
+    else:
         for pairs in block_streams:
             for sym in pairs:
                 code, L = codes[sym]
                 bw.write_code(code, L)
-        payload_bytes = bw.finish()
+    payload_bytes = bw.finish()
+    map_bytes = b""
+    if skip:
+        map_bytes = pack_bits_u8(coded)
+        payload_bytes = map_bytes + payload_bytes
+
+    table_entries = [(run, val, lengths[(run, val)]) for (run, val) in lengths.keys()]
+    st = dict(k0=k0, k1=k1, table_entries=table_entries, payload_bytes=payload_bytes)
+    if head is not None:
+        if cat:
+            head_bits = sum(codes[sym][1] + n for items in block_streams[:nhead] for (sym, _, n) in items)
+        else:
+            head_bits = sum(codes[sym][1] for pairs in block_streams[:nhead] for sym in pairs)
+        st["head_bytes"] = len(map_bytes) + (head_bits + 7) // 8
+    return st
+
+def band_sq_error(coeff: np.ndarray, zz: np.ndarray, roi01: np.ndarray, sb_q: np.ndarray, *,
+                  qstep_bg, qstep_roi, sb_qscale: int, int_dct: bool = False) -> np.ndarray:
+    """
+    Per-block squared error between coefficients (nb, n) and the decoder's
+    dequantization of zz (nb, n), as reconstruct_rows does it. roi01, sb_q: (nb,)
+    Returns float64 (nb,).
+    """
+    d = coeff.astype(np.float64) - dequant_band(zz, roi01, sb_q, qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+                                                 sb_qscale=sb_qscale, int_dct=int_dct)
+    return np.einsum("ij,ij->i", d, d)
+
+def dequant_band(zz: np.ndarray, roi01: np.ndarray, sb_q: np.ndarray, *, qstep_bg, qstep_roi,
+                 sb_qscale: int, int_dct: bool = False) -> np.ndarray:
+    """Decoder-side coefficient values of q-coeffs zz (nb, n), as reconstruct_rows; float64."""
+    if int_dct:
+        qbase_i = np.where(roi01 == 1, qstep_roi, qstep_bg)
+        return dequant_int(zz, qbase_i, sb_q, sb_qscale) / float(1 << COEF_FRAC_BITS)
+    qbase = np.where(roi01 == 1, np.float32(qstep_roi), np.float32(qstep_bg))
+    sb = sb_q.astype(np.float32) / float(sb_qscale)
+    return (zz.astype(np.float32) * (qbase * sb)[:, None]).astype(np.float64)
+
+def code_stages_v4(an, *, qstep_bg: int, qstep_roi: int, block_roi_01: np.ndarray, sa_al: int = 0,
+                   bounds=None, skip: bool = False, cat: bool = False, roi_first: bool = False,
+                   distortion: bool = False, work=None):
+    """
+    Quality-dependent half of encode_v4: quantize the shared coefficients of
+    analyze_v4() and entropy-code every stage of stage_plan(blockN, sa_al, bounds).
+    skip writes FLAG_SKIP stage payloads, cat FLAG_CAT symbols, roi_first
+    FLAG_ROI_FIRST block order (each stage also gets head_bytes, the prefix
+    holding its ROI blocks).
+    distortion adds mse / roi_mse to each stage: pixel MSE after decoding stages
+    0..s, over the image / the in-image pixels of the ROI blocks (padding
+    excluded; roi_mse None without ROI). The DCT is orthonormal, so for whole
+    blocks this is the coefficient quantization error (Parseval); blocks that
+    hold padding get their in-image error from the inverse transform of their
+    error coefficients. Exact before the decoder's clipping to 0..65535 and
+    rounding, and close for int_dct.
+    work: optional dict the quantized bands are kept in between calls (same
+    shape and bands every call, e.g. codec_v4_session.Encoder); the returned
+    stages never alias it.
+    """
+    return _code_stages(an, qstep_bg=qstep_bg, qstep_roi=qstep_roi, block_roi_01=block_roi_01, sa_al=sa_al,
+                        bounds=bounds, skip=skip, cat=cat, roi_first=roi_first, distortion=distortion,
+                        work=work)[0]
+
+def _code_stages(an, *, qstep_bg, qstep_roi, block_roi_01, sa_al, bounds, skip, cat, roi_first, distortion,
+                 nslices: int = 1, work=None):
+    """
+    code_stages_v4 on nslices slices stacked vertically in 'an' (whole block
+    rows each, an padH / padW the padding of each slice): quantization runs
+    once over all blocks, entropy coding per slice. Returns one stage list per
+    slice.
+    """
+    blockN, Hb, Wb = an["blockN"], an["Hb"], an["Wb"]
+    if block_roi_01.shape != (Hb, Wb):
+        raise ValueError(f"block_roi_01 mismatch: expected {(Hb,Wb)}, got {block_roi_01.shape}")
+    S = nslices
+    nbs = Hb * Wb // S  # blocks per slice
+
+    # decoder uses sb = sb_q / sb_qscale
+    sb = (an["sb_q"].astype(np.float32) / float(an["sb_qscale"]))
+    sb = np.clip(sb, 1.0, 1.6)
+    # ROI base step (hard clinical priority) + physics soft scale; stage MTF weight in quantize_stage
+    qbase = np.where(block_roi_01 == 1, np.float32(qstep_roi), np.float32(qstep_bg))
+    qb = (qbase * sb).reshape(-1)
+
+    roi_s = block_roi_01.reshape(S, Hb // S, Wb)
+    order = head = [None] * S
+    if roi_first:
+        order = [roi_first_order(r) for r in roi_s]
+        head = [int(np.count_nonzero(r)) for r in roi_s]
+
+    ranges = stage_ranges(blockN, bounds)
+    if distortion:
+        roi01 = block_roi_01.reshape(-1)
+        sb_q = an["sb_q"].reshape(-1)
+        dq = dict(qstep_bg=qstep_bg, qstep_roi=qstep_roi, sb_qscale=an["sb_qscale"],
+                  int_dct=an.get("int_dct", False))
+        coeff = an["coeff_zz"]
+        # per band: squared error of what the decoder holds so far (nothing yet -> energy)
+        err = {(k0, k1): np.einsum("ij,ij->i", coeff[:, k0:k1].astype(np.float64), coeff[:, k0:k1].astype(np.float64))
+               for (k0, k1) in ranges}
+        acc = {}
+        # in-image pixels per block; padded edge blocks are measured in the pixel domain
+        rows_in = np.full(Hb // S, blockN)
+        rows_in[-1] -= an["padH"]
+        cols_in = np.full(Wb, blockN)
+        cols_in[-1] -= an["padW"]
+        inpix = np.tile(np.outer(rows_in, cols_in).reshape(-1), S)
+        edge = np.flatnonzero(inpix < blockN * blockN)
+        rr, cc = zigzag_rc(blockN)
+        Cd = dct_matrix(blockN).astype(np.float64)
+        br, bc = (edge % nbs) // Wb, edge % Wb
+        edge_mask = ((np.arange(blockN)[None, :, None] < rows_in[br][:, None, None])
+                     & (np.arange(blockN)[None, None, :] < cols_in[bc][:, None, None]))
+        edge_rec = np.zeros((edge.size, blockN * blockN))
+        roi2 = roi01.reshape(S, nbs) == 1
+        npix = inpix.reshape(S, nbs).sum(axis=1)
+        nroi = np.where(roi2, inpix.reshape(S, nbs), 0).sum(axis=1)
+    stages = [[] for _ in range(S)]
+    bands = {}
+    for (k0, k1, ah, al) in stage_plan(blockN, sa_al, bounds):
+        if (k0, k1) not in bands:
+            sid = stage_id_from_range(k0, k1, ranges)
+            buf = (None, None)
+            if work is not None:
+                shape = (Hb * Wb, k1 - k0)
+                buf = work.get((k0, k1))
+                if buf is None or buf[0].shape != shape:
+                    buf = work[(k0, k1)] = (np.empty(shape, dtype=np.int16), np.empty(shape, dtype=np.float32))
+            bands[(k0, k1)] = quantize_stage(an["coeff_zz"], qb, k0, k1, blockN, sid, *buf)
+        zzq = bands[(k0, k1)]
+        if ah or al:
+            zzq = sa_scan_values(zzq, ah, al)
+        if distortion:
+            a = acc.setdefault((k0, k1), np.zeros(zzq.shape, dtype=np.int16))
+            merge_scan(a, zzq, ah, al)
+            err[(k0, k1)] = band_sq_error(coeff[:, k0:k1], a, roi01, sb_q, **dq)
+            e = sum(err.values())
+            if edge.size:
+                edge_rec[:, k0:k1] = dequant_band(a[edge], roi01[edge], sb_q[edge], **dq)
+                D = np.zeros((edge.size, blockN, blockN))
+                D[:, rr, cc] = coeff[edge].astype(np.float64) - edge_rec
+                P = Cd.T @ D @ Cd
+                e[edge] = np.einsum("ijk,ijk->i", P * edge_mask, P)
+            e = e.reshape(S, nbs)
+        for s in range(S):
+            st = entropy_code_stage(zzq[s * nbs:(s + 1) * nbs], k0, k1, skip, cat, order[s], head[s])
+            st.update(ah=ah, al=al)
+            if distortion:
+                st.update(mse=float(e[s].sum()) / npix[s],
+                          roi_mse=float(e[s][roi2[s]].sum()) / nroi[s] if nroi[s] else None)
+            stages[s].append(st)
+    return stages
+
+def encode_v4(x_u16: np.ndarray, *, blockN: int, qstep_bg: int, qstep_roi: int, block_roi_01: np.ndarray, sb_qscale: int = 16,
+              sa_al: int = 0, bounds=None, int_dct: bool = False, skip: bool = False, cat: bool = False,
+              roi_first: bool = False, distortion: bool = False):
+    """
+    Returns:
+      roi_map: uint8 0/1 (Hb,Wb)
+      sb_q: uint8 (Hb,Wb) quantized block-scale
+      stages: list {k0,k1,ah,al, table_entries, payload_bytes}
+      meta: padW,padH,Hb,Wb
+    sa_al > 0 adds successive-approximation stages, bounds sets the spectral
+    bands (see stage_plan); write_v4 switches to extended stage headers as needed.
+    int_dct uses the fixed-point forward DCT (pair with FLAG_INT_DCT), skip
+    drops all-zero blocks from each stage behind a bitmap (pair with FLAG_SKIP),
+    cat codes magnitude categories + raw bits (pair with FLAG_CAT), roi_first
+    codes every stage's ROI blocks first (pair with FLAG_ROI_FIRST).
+    distortion adds per-stage mse / roi_mse computed from the coefficients
+    (see code_stages_v4), no decode needed.
+    """
+    an = analyze_v4(x_u16, blockN=blockN, sb_qscale=sb_qscale, int_dct=int_dct)
+    stages = code_stages_v4(an, qstep_bg=qstep_bg, qstep_roi=qstep_roi, block_roi_01=block_roi_01,
+                            sa_al=sa_al, bounds=bounds, skip=skip, cat=cat, roi_first=roi_first,
+                            distortion=distortion)
+    meta = dict(padW=an["padW"], padH=an["padH"], Hb=an["Hb"], Wb=an["Wb"])
+    return an["sb_q"], stages, meta
 
-        table_entries = [(run, val, lengths[(run, val)]) for (run, val) in lengths.keys()]
-        stages.append(dict(k0=k0, k1=k1, table_entries=table_entries, payload_bytes=payload_bytes))
+def encode_v4_stack(vol_u16: np.ndarray, *, blockN: int, qstep_bg: int, qstep_roi: int, block_roi_01: np.ndarray,
+                    sb_qscale: int = 16, sa_al: int = 0, bounds=None, int_dct: bool = False, skip: bool = False,
+                    cat: bool = False, roi_first: bool = False, distortion: bool = False, batch: int = 8):
+    """
+    encode_v4 for every slice of a uint16 (S,H,W) volume. Padding, block
+    scale, DCT and quantization run over the blocks of 'batch' slices at once
+    (stacked as one tall image, so the float32 coefficients of 'batch' slices
+    are the peak memory); each slice keeps its own tables and stages, the same
+    as encode_v4 gives for it, so every slice is an ordinary v4 stream.
+    block_roi_01: uint8 (S,Hb,Wb), or (Hb,Wb) shared by all slices.
+    Returns (sb_q uint8 (S,Hb,Wb), list of per-slice stage lists, meta).
+    """
+    if vol_u16.dtype != np.uint16 or vol_u16.ndim != 3:
+        raise ValueError(f"expected a uint16 (S,H,W) volume, got {vol_u16.dtype} {vol_u16.shape}")
+    S, H, W = vol_u16.shape
+    padH = (blockN - H % blockN) % blockN
+    padW = (blockN - W % blockN) % blockN
+    Hb, Wb = (H + padH) // blockN, (W + padW) // blockN
+    roi = block_roi_01 if block_roi_01.ndim == 3 else np.broadcast_to(block_roi_01, (S,) + block_roi_01.shape)
+    if roi.shape != (S, Hb, Wb):
+        raise ValueError(f"block_roi_01 mismatch: expected {(S,Hb,Wb)} or {(Hb,Wb)}, got {block_roi_01.shape}")
 
-    meta = dict(padW=padW, padH=padH, Hb=Hb, Wb=Wb)
-    return sb_q, stages, meta
+    sb_q = np.empty((S, Hb, Wb), dtype=np.uint8)
+    stages = []
+    for s0 in range(0, S, max(1, batch)):
+        v = vol_u16[s0:s0 + batch]
+        n = v.shape[0]
+        if padH or padW:
+            v = np.pad(v, ((0, 0), (0, padH), (0, padW)), mode="edge")  # per slice, as pad_to_block
+        an = analyze_v4(v.reshape(n * Hb * blockN, Wb * blockN), blockN=blockN, sb_qscale=sb_qscale, int_dct=int_dct)
+        an.update(padH=padH, padW=padW)  # padding of each slice, not of the (already padded) stack
+        stages += _code_stages(an, qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+                               block_roi_01=np.ascontiguousarray(roi[s0:s0 + n]).reshape(n * Hb, Wb),
+                               sa_al=sa_al, bounds=bounds, skip=skip, cat=cat, roi_first=roi_first,
+                               distortion=distortion, nslices=n)
+        sb_q[s0:s0 + n] = an["sb_q"].reshape(n, Hb, Wb)
+    return sb_q, stages, dict(padW=padW, padH=padH, Hb=Hb, Wb=Wb)
 
 def decode_v4(*, width, height, padW, padH, blockN, qstep_bg, qstep_roi,
               block_roi_01: np.ndarray, sb_q: np.ndarray, sb_qscale: int,
-              stages_data, stages_to_decode: int):
+              stages_data, stages_to_decode: int, int_dct: bool = False, skip: bool = False,
+              cat: bool = False, roi_first: bool = False, roi_only: bool = False, lut=None, out=None,
+              dedup: bool = False, stats=None):
     """
     stages_data: list of dict {k0,k1, table_entries, payload_bytes}
     sb_q: uint8 (Hb,Wb) stored map
+    int_dct: fixed-point reconstruction (streams flagged FLAG_INT_DCT)
+    skip: stage payloads carry coded-block bitmaps (FLAG_SKIP)
+    cat: magnitude-category symbols (FLAG_CAT)
+    roi_first: stages code ROI blocks first (FLAG_ROI_FIRST)
+    roi_only: stop the last decoded stage after its ROI blocks (needs
+      roi_first); that stage's payload may be cut at its ROI prefix
+    lut: display table over uint16 values (canvas.window_lut): the result is
+      lut[decoded pixels], written strip by strip without a uint16 image
+    out: optional preallocated uint16 (lut dtype with lut) array to decode into
+    dedup, stats: memoized IDCT and its block counts (reconstruct_rows)
+    Blocks whose decoded coefficients are all zero reconstruct to 0 without an IDCT.
     """
     Hp = height + padH
     Wp = width + padW
@@ -125,70 +698,224 @@ def decode_v4(*, width, height, padW, padH, blockN, qstep_bg, qstep_roi,
     if sb_q.shape != (Hb, Wb):
         raise ValueError("block-scale map shape mismatch in decode")
 
-    sb = (sb_q.astype(np.float32) / float(sb_qscale))
+    if roi_only and not roi_first:
+        raise ValueError("roi_only needs a FLAG_ROI_FIRST stream")
+
+    nb = Hb * Wb
+    K = blockN * blockN
+    n = max(1, min(stages_to_decode, len(stages_data)))
+    order = roi_first_order(block_roi_01) if roi_first else None
+    nroi = int(np.count_nonzero(block_roi_01))
+
+    # Decode each stage into the sparse store; q-coeffs only, dequantization
+    # happens in the strip-wise reconstruction below
+    coeffs = SparseCoeffs(nb, K)
+    for si in range(n):
+        st = stages_data[si]
+        head = nroi if roi_only and si == n - 1 else None
+        blk, pos, val = decode_stage_sparse(st, nb, K, skip, cat, order, head)
+        coeffs.add_scan(blk, pos, val, st.get("al", 0))
+
+    return reconstruct_image(coeffs, block_roi_01.reshape(-1), sb_q.reshape(-1), height=height, width=width,
+                             blockN=blockN, Wb=Wb, qstep_bg=qstep_bg, qstep_roi=qstep_roi, sb_qscale=sb_qscale,
+                             int_dct=int_dct, lut=lut, out=out, dedup=dedup, stats=stats)
+
+def reconstruct_image(coeffs, roi01: np.ndarray, sb_q: np.ndarray, *, height, width, blockN, Wb,
+                      qstep_bg, qstep_roi, sb_qscale: int, int_dct: bool = False, lut=None, out=None,
+                      dedup: bool = False, stats=None):
+    """
+    Decoder back end shared by every stream version: strip-wise dequantization
+    (qbase * sb_q / sb_qscale per block) + IDCT of 'coeffs' (SparseCoeffs or
+    DenseCoeffs), clipped and cropped into out (lut applied, see store_rows).
+    roi01, sb_q: flat (nb,) per-block maps. dedup, stats: see reconstruct_rows
+    (blocks are deduplicated within each strip).
+    """
+    nb = roi01.size
+    Hb = nb // Wb
+    out = output_buffer(out, height, width, np.uint16 if lut is None else lut.dtype)
+    step = 8  # block rows per pass: the only dense coefficient / pixel state
+    for br0 in range(0, Hb, step):
+        br1 = min(br0 + step, Hb)
+        sl = slice(br0 * Wb, br1 * Wb)
+        zz = coeffs.dense(sl.start, sl.stop)
+        pix = reconstruct_rows(zz, roi01[sl], sb_q[sl], qstep_bg=qstep_bg, qstep_roi=qstep_roi, sb_qscale=sb_qscale,
+                               blockN=blockN, Wb=Wb, live=zz.any(axis=1), int_dct=int_dct, dedup=dedup, stats=stats)
+        store_rows(out, br0 * blockN, pix, lut)  # clip + crop padding (+ display LUT)
+    return out
+
+def decode_v4_stack(streams, *, stages_to_decode: int = 255, roi_only: bool = False, rows: int = 64, out=None):
+    """
+    decode_v4 for the v4 streams of one volume (bitstream_v4.read_v4 results:
+    (h, roi_blk, sb_q, stages_data) per slice). The slices must share size,
+    blockN, qsteps, sb_qscale and FLAG_INT_DCT. Entropy decoding stays per
+    slice; dequantization and IDCT run over the whole volume's blocks as one
+    tall image, 'rows' block rows at a time.
+    out: optional preallocated uint16 (S, height, width) array to decode into
+    Returns uint16 (S, height, width), slice s equal to decode_v4 of stream s.
+    """
+    if not streams:
+        raise ValueError("no streams to decode")
+    h0 = streams[0][0]
+    shared = ("width", "height", "padW", "padH", "blockN", "qstep_bg", "qstep_roi", "sb_qscale")
+    S = len(streams)
+    N = h0["blockN"]
+    Hp, Wp = h0["height"] + h0["padH"], h0["width"] + h0["padW"]
+    Hb, Wb = Hp // N, Wp // N
+    nb, K = Hb * Wb, N * N
+    int_dct = bool(h0["flags"] & FLAG_INT_DCT)
+
+    scans = {}  # stage index -> per-slice triplets, block indices offset by slice
+    for s, (h, roi_blk, sb_q, stages_data) in enumerate(streams):
+        if any(h[k] != h0[k] for k in shared) or bool(h["flags"] & FLAG_INT_DCT) != int_dct:
+            raise ValueError(f"slice {s}: header differs from slice 0 in size, qsteps, sb_qscale or FLAG_INT_DCT")
+        if roi_blk.shape != (Hb, Wb) or sb_q.shape != (Hb, Wb):
+            raise ValueError(f"slice {s}: ROI / block-scale map shape mismatch in decode")
+        skip, cat, roi_first = (bool(h["flags"] & f) for f in (FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST))
+        if roi_only and not roi_first:
+            raise ValueError("roi_only needs FLAG_ROI_FIRST streams")
+        order = roi_first_order(roi_blk) if roi_first else None
+        nroi = int(np.count_nonzero(roi_blk))
+        n = max(1, min(stages_to_decode, len(stages_data)))
+        for si in range(n):
+            st = stages_data[si]
+            head = nroi if roi_only and si == n - 1 else None
+            blk, pos, val = decode_stage_sparse(st, nb, K, skip, cat, order, head)
+            al = st.get("al", 0)
+            scans.setdefault(si, []).append((blk + s * nb, pos, val << al if al else val))
+
+    # one chunk per stage: slices are in block order, so each chunk stays sorted
+    coeffs = SparseCoeffs(S * nb, K)
+    for si in sorted(scans):
+        coeffs.add_scan(*(np.concatenate(c) for c in zip(*scans[si])))
+
+    roi = np.concatenate([r.reshape(-1) for (_, r, _, _) in streams])
+    sbq = np.concatenate([q.reshape(-1) for (_, _, q, _) in streams])
+    if out is None:
+        out = np.empty((S, h0["height"], h0["width"]), dtype=np.uint16)
+    elif out.shape != (S, h0["height"], h0["width"]) or out.dtype != np.uint16:
+        raise ValueError(f"out must be uint16 {(S, h0['height'], h0['width'])}, got {out.dtype} {out.shape}")
+    for br0 in range(0, S * Hb, rows):
+        br1 = min(br0 + rows, S * Hb)
+        sl = slice(br0 * Wb, br1 * Wb)
+        zz = coeffs.dense(sl.start, sl.stop)
+        pix = reconstruct_rows(zz, roi[sl], sbq[sl], qstep_bg=h0["qstep_bg"], qstep_roi=h0["qstep_roi"],
+                               sb_qscale=h0["sb_qscale"], blockN=N, Wb=Wb, live=zz.any(axis=1), int_dct=int_dct)
+        r0, r1 = br0 * N, br1 * N  # rows of the stacked padded volume
+        for s in range(r0 // Hp, (r1 - 1) // Hp + 1):
+            a, b = max(r0, s * Hp), min(r1, (s + 1) * Hp)
+            store_rows(out[s], a - s * Hp, pix[a - r0:b - r0])  # clip + crop padding
+    return out
+
+def decode_thumbnail(*, width, height, padW, padH, blockN, qstep_bg, qstep_roi,
+                     block_roi_01: np.ndarray, sb_q: np.ndarray, sb_qscale: int,
+                     stage0, upsample: int = 1, skip: bool = False, cat: bool = False,
+                     roi_first: bool = False, lut=None):
+    """
+    Block-mean image from stage 0 alone (no IDCT).
+    The orthonormal DC coefficient is N * mean, so mean = DC * qbase * sb / N.
+    stage0: dict {k0,k1, table_entries, payload_bytes}, must start at k0=0
+    upsample: integer nearest-neighbour factor (blockN gives full resolution)
+    skip: stage payload carries a coded-block bitmap (FLAG_SKIP)
+    cat: magnitude-category symbols (FLAG_CAT)
+    roi_first: ROI blocks are coded first (FLAG_ROI_FIRST)
+    lut: display table over uint16 values (canvas.window_lut), applied before upsampling
+    Returns uint16 (ceil(H*u/N), ceil(W*u/N)), lut dtype with lut.
+    """
+    Hp = height + padH
+    Wp = width + padW
+    Hb = Hp // blockN
+    Wb = Wp // blockN
+    if block_roi_01.shape != (Hb, Wb):
+        raise ValueError("ROI map shape mismatch in decode")
+    if sb_q.shape != (Hb, Wb):
+        raise ValueError("block-scale map shape mismatch in decode")
+    if stage0["k0"] != 0:
+        raise ValueError("Thumbnail needs a stage that carries the DC coefficient")
+    if upsample < 1:
+        raise ValueError("upsample must be >= 1")
+    al = stage0.get("al", 0)  # DC-carrying first scan may be point-transformed
 
-    C = dct_matrix(blockN)
     nb = Hb * Wb
     K = blockN * blockN
-    zz_acc = np.zeros((nb, K), dtype=np.int16)
+    order = roi_first_order(block_roi_01) if roi_first else None
+    blk, pos, val = decode_stage_sparse(stage0, nb, K, skip, cat, order)
+    dc = np.zeros(nb, dtype=np.float32)
+    m = pos == 0
+    dc[blk[m]] = val[m].astype(np.int32) << al
+
+    qbase = np.where(block_roi_01 == 1, float(qstep_roi), float(qstep_bg)).astype(np.float32)
+    sb = sb_q.astype(np.float32) / float(sb_qscale)
+    mean = dc.reshape(Hb, Wb) * qbase * sb / float(blockN)
+    thumb = np.clip(mean, 0, 65535).astype(np.uint16)
+    if lut is not None:
+        thumb = lut[thumb]
+
+    if upsample > 1:
+        thumb = np.repeat(np.repeat(thumb, upsample, axis=0), upsample, axis=1)
+    th = -(-height * upsample // blockN)
+    tw = -(-width * upsample // blockN)
+    return thumb[:th, :tw]
+
+def decode_v4_scaled(*, width, height, padW, padH, blockN, qstep_bg, qstep_roi,
+                     block_roi_01: np.ndarray, sb_q: np.ndarray, sb_qscale: int,
+                     stages_data, stages_to_decode: int, scale: int = 2, int_dct: bool = False,
+                     skip: bool = False, cat: bool = False, roi_first: bool = False, lut=None, out=None):
+    """
+    Reduced-resolution decode (1/scale per axis, scale must divide blockN).
+    Only the top-left M x M coefficients (M = blockN // scale) of each block are
+    kept and inverted with an M-point IDCT; stages whose zigzag range holds none
+    of them are skipped without touching their payload.
+    int_dct: fixed-point M-point IDCT (scale must then be a power of two).
+    skip: stage payloads carry coded-block bitmaps (FLAG_SKIP).
+    cat: magnitude-category symbols (FLAG_CAT).
+    roi_first: ROI blocks are coded first (FLAG_ROI_FIRST).
+    lut: display table over uint16 values (canvas.window_lut), as in decode_v4.
+    out: optional preallocated uint16 (lut dtype with lut) array of the result shape.
+    Returns uint16 (ceil(H/scale), ceil(W/scale)).
+    """
+    if scale < 1 or blockN % scale != 0:
+        raise ValueError(f"scale must divide blockN={blockN}, got {scale}")
+    if int_dct and scale & (scale - 1):
+        raise ValueError("integer scaled decode needs a power-of-two scale")
+    Hp = height + padH
+    Wp = width + padW
+    Hb = Hp // blockN
+    Wb = Wp // blockN
+    if block_roi_01.shape != (Hb, Wb):
+        raise ValueError("ROI map shape mismatch in decode")
+    if sb_q.shape != (Hb, Wb):
+        raise ValueError("block-scale map shape mismatch in decode")
 
-    nstages = len(stages_data)
-    n = max(1, min(stages_to_decode, nstages))
+    M = blockN // scale
+    nb = Hb * Wb
+    K = blockN * blockN
+    rows, cols = zigzag_rc(blockN)
+    keep = (rows < M) & (cols < M)
 
-    # Decode each stage, fill its coefficient subset
+    acc = np.zeros((nb, M, M), dtype=np.int16)
+    order = roi_first_order(block_roi_01) if roi_first else None
+    n = max(1, min(stages_to_decode, len(stages_data)))
     for si in range(n):
         st = stages_data[si]
         k0, k1 = st["k0"], st["k1"]
-        sid = stage_id_from_range(k0, k1)
-        # NOTE: quantization is applied in final reconstruction, not here.
-        # Here we only recover integer q-coeffs in this stage range.
-        lengths = {(run, val): L for (run, val, L) in st["table_entries"]}
-        codes = canonical_codes_from_lengths(lengths)
-        trie = build_decode_trie(codes)
-        br = BitReader(st["payload_bytes"])
-
-        for bi in range(nb):
-            pairs = []
-            while True:
-                sym = decode_one_symbol(trie, br)
-                pairs.append(sym)
-                if sym == EOB:
-                    break
-                if len(pairs) > K + 1:
-                    raise ValueError("Corrupt stream: too many symbols in block")
-            vec = rle_decode(pairs, K)
-            zz_acc[bi, k0:k1] = vec[k0:k1]
-
-    # Reconstruct spatial image: apply stage-specific Qzz to the pieces we decoded
-    out = np.zeros((Hp, Wp), dtype=np.float32)
-    bi = 0
-    for br in range(Hb):
-        for bc in range(Wb):
-            # Start with empty coefficient zigzag vector (float)
-            coeff_zz = np.zeros(K, dtype=np.float32)
-            qbase = float(qstep_roi if block_roi_01[br, bc] == 1 else qstep_bg)
-            sbv = float(sb[br, bc])
-
-            # For each decoded stage, apply its own MTF matrix
-            for si in range(n):
-                st = stages_data[si]
-                k0, k1 = st["k0"], st["k1"]
-
-                # 注意：decoder 不再使用 MTF / stage 權重
-                # 只使用 encoder 已決定好的 base quantization scale
-                Qbase = qbase * sbv
-
-                coeff_zz[k0:k1] = (
-                        zz_acc[bi, k0:k1].astype(np.float32) * Qbase
-                )
-
-            coeff = zigzag_unscan(coeff_zz, blockN).astype(np.float32)
-            blk = block_idct2(coeff, C)
-
-            r = br * blockN
-            c = bc * blockN
-            out[r:r+blockN, c:c+blockN] = blk
-            bi += 1
-
-    out = np.clip(out, 0, 65535).astype(np.uint16)
-    return out[:height, :width]
\ No newline at end of file
+        if not keep[k0:k1].any():
+            continue  # purely higher-frequency stage
+        blk, pos, val = decode_stage_sparse(st, nb, K, skip, cat, order)
+        m = keep[pos]
+        blk, pos, val = blk[m], pos[m], val[m] << st.get("al", 0)
+        acc[blk, rows[pos], cols[pos]] += val  # (block, pos) unique within a scan, as in merge_scan
+
+    if int_dct:
+        # M/N = 2^-log2(scale) folds into the final shift
+        qbase_i = np.where(block_roi_01 == 1, qstep_roi, qstep_bg).reshape(-1)
+        coef = dequant_int(acc, qbase_i, sb_q.reshape(-1), sb_qscale)
+        blks = block_idct2_int(coef, M, COEF_FRAC_BITS + scale.bit_length() - 1)
+    else:
+        # same dequantization as decode_v4: qbase * sb per block
+        qbase = np.where(block_roi_01 == 1, float(qstep_roi), float(qstep_bg)).astype(np.float32)
+        Qbase = (qbase * (sb_q.astype(np.float32) / float(sb_qscale))).reshape(nb, 1, 1)
+        blks = block_idct2_scaled(acc.astype(np.float32) * Qbase, blockN, M)
+
+    out = output_buffer(out, -(-height // scale), -(-width // scale), np.uint16 if lut is None else lut.dtype)
+    store_rows(out, 0, blks.reshape(Hb, Wb, M, M).transpose(0, 2, 1, 3).reshape(Hb * M, Wb * M), lut)
+    return out
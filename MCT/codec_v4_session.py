@@ -0,0 +1,211 @@
+import numpy as np
+from dct import dct_matrix, dct_matrix_int, DCT_INT_BITS, COEF_FRAC_BITS
+from zigzag import zigzag_rc
+from canvas import output_buffer, store_rows
+from bitstream_v4 import FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST
+from codec_v4 import (block_scale_q, code_stages_v4, forward_zz_int, stage_plan, roi_first_order,
+                      decode_stage_sparse, SparseCoeffs)
+
+# Same-shaped slices, many times: each object derives its transforms, zigzag
+# indices and stage plan once and keeps its working arrays between calls.
+# Outputs never alias those arrays. Objects are not shared between threads
+# (use one per thread); the cached tables they read are immutable.
+# What still allocates per call is what depends on the content: the entropy
+# coder's symbol lists, tables and payloads, the decoded (block, pos, value)
+# triplets (they follow the nonzero count), per-block maps (Hb*Wb values),
+# the distortion bookkeeping, and the output unless 'out' is given.
+
+def _pad_sizes(height: int, width: int, blockN: int):
+    return (blockN - height % blockN) % blockN, (blockN - width % blockN) % blockN
+
+class Encoder:
+    """
+    encode_v4 for a fixed slice shape and coding options.
+    encode() returns exactly what encode_v4 returns for the same arguments.
+    Padding, block DCT and the quantized bands reuse arrays kept here.
+    """
+    def __init__(self, shape, blockN: int = 8, *, sb_qscale: int = 16, sa_al: int = 0, bounds=None,
+                 int_dct: bool = False, skip: bool = False, cat: bool = False, roi_first: bool = False):
+        self.height, self.width = shape
+        self.blockN = blockN
+        self.padH, self.padW = _pad_sizes(self.height, self.width, blockN)
+        self.Hb = (self.height + self.padH) // blockN
+        self.Wb = (self.width + self.padW) // blockN
+        self.opts = dict(sa_al=sa_al, bounds=bounds, skip=skip, cat=cat, roi_first=roi_first)
+        self.sb_qscale = sb_qscale
+        self.int_dct = int_dct
+        stage_plan(blockN, sa_al, bounds)  # reject bad bounds up front
+
+        N, nb = blockN, self.Hb * self.Wb
+        self._C = dct_matrix(N)
+        self._zz = np.ravel_multi_index(zigzag_rc(N), (N, N))
+        self._pad = np.empty((self.Hb * N, self.Wb * N), dtype=np.uint16)
+        self._blocks = np.empty((nb, N, N), dtype=np.float32)
+        self._tmp = np.empty((nb, N, N), dtype=np.float32)
+        self._dct = np.empty((nb, N, N), dtype=np.float32)
+        self._coeff = np.empty((nb, N * N), dtype=np.float32)
+        self._bands = {}  # code_stages_v4 work: quantized bands
+
+    def _analyze(self, x_u16: np.ndarray):
+        """analyze_v4 into the preallocated arrays."""
+        if x_u16.dtype != np.uint16 or x_u16.shape != (self.height, self.width):
+            raise ValueError(f"expected uint16 {(self.height, self.width)}, got {x_u16.dtype} {x_u16.shape}")
+        H, W, N, Hb, Wb = self.height, self.width, self.blockN, self.Hb, self.Wb
+        xp = self._pad
+        xp[:H, :W] = x_u16
+        xp[H:, :W] = x_u16[H - 1:H]          # edge padding, as np.pad(mode="edge")
+        xp[:, W:] = xp[:, W - 1:W]
+        np.copyto(self._blocks.reshape(Hb, Wb, N, N), xp.reshape(Hb, N, Wb, N).swapaxes(1, 2))
+
+        blocks = self._blocks
+        mu_blk = blocks.mean(axis=(1, 2)).reshape(Hb, Wb)
+        sd_blk = blocks.std(axis=(1, 2)).reshape(Hb, Wb)
+        sb_q = block_scale_q(mu_blk, sd_blk, self.sb_qscale)
+
+        if self.int_dct:
+            coeff_zz = forward_zz_int(blocks, N)
+        else:
+            np.matmul(self._C, blocks, out=self._tmp)
+            np.matmul(self._tmp, self._C.T, out=self._dct)
+            coeff_zz = np.take(self._dct.reshape(-1, N * N), self._zz, axis=1, out=self._coeff)
+        return dict(coeff_zz=coeff_zz, sb_q=sb_q, padW=self.padW, padH=self.padH, Hb=Hb, Wb=Wb,
+                    blockN=N, sb_qscale=self.sb_qscale, int_dct=self.int_dct)
+
+    def encode(self, x_u16: np.ndarray, *, qstep_bg: int, qstep_roi: int, block_roi_01: np.ndarray,
+               distortion: bool = False):
+        """Returns (sb_q, stages, meta) as encode_v4."""
+        an = self._analyze(x_u16)
+        stages = code_stages_v4(an, qstep_bg=qstep_bg, qstep_roi=qstep_roi, block_roi_01=block_roi_01,
+                                distortion=distortion, work=self._bands, **self.opts)
+        meta = dict(padW=self.padW, padH=self.padH, Hb=self.Hb, Wb=self.Wb)
+        return an["sb_q"], stages, meta
+
+class Decoder:
+    """
+    decode_v4 for a fixed slice shape and block size; per-stream options come
+    from the header flags. decode() returns what decode_v4 returns.
+    The coefficient store and the strip-wise dequantization / IDCT (float or
+    fixed-point) reuse arrays kept here.
+    """
+    ROWS = 8  # block rows per reconstruction pass, as decode_v4
+
+    def __init__(self, shape, blockN: int = 8):
+        self.height, self.width = shape
+        self.blockN = blockN
+        self.padH, self.padW = _pad_sizes(self.height, self.width, blockN)
+        self.Hb = (self.height + self.padH) // blockN
+        self.Wb = (self.width + self.padW) // blockN
+
+        N, n = blockN, self.ROWS * self.Wb
+        self._C = dct_matrix(N)
+        self._rc = zigzag_rc(N)
+        self._zz = np.empty((n, N * N), dtype=np.int16)
+        self._coeff = np.empty((n, N, N), dtype=np.float32)
+        self._tmp = np.empty((n, N, N), dtype=np.float32)
+        self._idct = np.empty((n, N, N), dtype=np.float32)
+        self._blks = np.empty((n, N, N), dtype=np.float32)
+        self._rows = np.empty((self.ROWS * N, self.Wb * N), dtype=np.float32)
+        self._int = None  # fixed-point work arrays, on the first FLAG_INT_DCT stream
+        self._coeffs = SparseCoeffs(self.Hb * self.Wb, N * N)
+
+    def _reconstruct(self, zz: np.ndarray, qb: np.ndarray, br: int) -> np.ndarray:
+        """reconstruct_rows (float path) of br block rows into the work arrays."""
+        N, Wb = self.blockN, self.Wb
+        n = zz.shape[0]
+        live = zz.any(axis=1)
+        nl = int(live.sum())
+        coeff, tmp, idct = self._coeff[:nl], self._tmp[:nl], self._idct[:nl]
+        coeff[:, self._rc[0], self._rc[1]] = zz[live].astype(np.float32) * qb[live, None]
+        np.matmul(self._C.T, coeff, out=tmp)
+        np.matmul(tmp, self._C, out=idct)
+        blks = self._blks[:n]
+        blks[~live] = 0
+        blks[live] = idct
+        rows = self._rows[:br * N]
+        np.copyto(rows.reshape(br, N, Wb, N), blks.reshape(br, Wb, N, N).swapaxes(1, 2))
+        return rows
+
+    def _reconstruct_int(self, zz: np.ndarray, step: np.ndarray, sb_qscale: int, br: int) -> np.ndarray:
+        """reconstruct_rows_int of br block rows into the work arrays; step: qbase * sb_q per block."""
+        N, Wb = self.blockN, self.Wb
+        if self._int is None:
+            n = self.ROWS * Wb
+            self._int = dict(Ci=dct_matrix_int(N), coeff=np.empty((n, N, N), dtype=np.int64),
+                             tmp=np.empty((n, N, N), dtype=np.int64), idct=np.empty((n, N, N), dtype=np.int64),
+                             blks=np.empty((n, N, N), dtype=np.int64),
+                             rows=np.empty((self.ROWS * N, Wb * N), dtype=np.int64))
+        w = self._int
+        n = zz.shape[0]
+        live = zz.any(axis=1)
+        nl = int(live.sum())
+        coeff, tmp, idct = w["coeff"][:nl], w["tmp"][:nl], w["idct"][:nl]
+        # dequant_int: ((zz * step) << COEF_FRAC_BITS + d // 2) // d
+        coeff[:, self._rc[0], self._rc[1]] = zz[live]
+        coeff *= step[live, None, None]
+        coeff <<= COEF_FRAC_BITS
+        coeff += sb_qscale // 2
+        coeff //= sb_qscale
+        # block_idct2_int, rounding shifts in place
+        np.matmul(w["Ci"].T, coeff, out=tmp)
+        tmp += 1 << (DCT_INT_BITS - 1)
+        tmp >>= DCT_INT_BITS
+        np.matmul(tmp, w["Ci"], out=idct)
+        idct += 1 << (DCT_INT_BITS + COEF_FRAC_BITS - 1)
+        idct >>= DCT_INT_BITS + COEF_FRAC_BITS
+        blks = w["blks"][:n]
+        blks[~live] = 0
+        blks[live] = idct
+        rows = w["rows"][:br * N]
+        np.copyto(rows.reshape(br, N, Wb, N), blks.reshape(br, Wb, N, N).swapaxes(1, 2))
+        return rows
+
+    def decode(self, h, roi_blk: np.ndarray, sb_q: np.ndarray, stages_data, stages_to_decode: int = 255,
+               roi_only: bool = False, lut=None, out=None):
+        """
+        h, roi_blk, sb_q, stages_data: as returned by bitstream_v4.read_v4.
+        lut: display table (canvas.window_lut), as in decode_v4.
+        out: optional uint16 (lut dtype with lut) destination; a new array otherwise.
+        """
+        if (h["height"], h["width"], h["blockN"]) != (self.height, self.width, self.blockN):
+            raise ValueError(f"stream is {h['height']}x{h['width']} N={h['blockN']}, "
+                             f"decoder is {self.height}x{self.width} N={self.blockN}")
+        Hb, Wb, N = self.Hb, self.Wb, self.blockN
+        if roi_blk.shape != (Hb, Wb) or sb_q.shape != (Hb, Wb):
+            raise ValueError("ROI / block-scale map shape mismatch in decode")
+        flags = h["flags"]
+        int_dct, skip = bool(flags & FLAG_INT_DCT), bool(flags & FLAG_SKIP)
+        cat, roi_first = bool(flags & FLAG_CAT), bool(flags & FLAG_ROI_FIRST)
+        if roi_only and not roi_first:
+            raise ValueError("roi_only needs a FLAG_ROI_FIRST stream")
+
+        nb, K = Hb * Wb, N * N
+        n = max(1, min(stages_to_decode, len(stages_data)))
+        order = roi_first_order(roi_blk) if roi_first else None
+        nroi = int(np.count_nonzero(roi_blk))
+        coeffs = self._coeffs
+        coeffs.clear()
+        for si in range(n):
+            st = stages_data[si]
+            head = nroi if roi_only and si == n - 1 else None
+            blk, pos, val = decode_stage_sparse(st, nb, K, skip, cat, order, head)
+            coeffs.add_scan(blk, pos, val, st.get("al", 0))
+
+        roi = roi_blk.reshape(-1)
+        sbq = sb_q.reshape(-1)
+        qstep_bg, qstep_roi, sb_qscale = h["qstep_bg"], h["qstep_roi"], h["sb_qscale"]
+        if int_dct:
+            step = np.where(roi == 1, qstep_roi, qstep_bg).astype(np.int64) * sbq
+        else:
+            qb = (np.where(roi == 1, np.float32(qstep_roi), np.float32(qstep_bg))
+                  * (sbq.astype(np.float32) / float(sb_qscale)))
+        out = output_buffer(out, self.height, self.width, np.uint16 if lut is None else lut.dtype)
+        for br0 in range(0, Hb, self.ROWS):
+            br1 = min(br0 + self.ROWS, Hb)
+            b0, b1 = br0 * Wb, br1 * Wb
+            zz = coeffs.dense(b0, b1, out=self._zz[:b1 - b0])
+            if int_dct:
+                pix = self._reconstruct_int(zz, step[b0:b1], int(sb_qscale), br1 - br0)
+            else:
+                pix = self._reconstruct(zz, qb[b0:b1], br1 - br0)
+            store_rows(out, br0 * N, pix, lut)
+        return out
@@ -0,0 +1,246 @@
+import tempfile
+from collections import Counter
+import numpy as np
+from dct import dct_matrix
+from rle import rle_encode_band, cat_split, EOB, ZRL
+from huff_canonical import build_code_lengths_from_freqs, canonical_codes_from_lengths
+from bitpack import BitWriter
+from roi import pack_bits_u8
+from bitstream_v4 import (write_header, write_stage_header, write_table, read_header, read_stage_header,
+                          read_table, patch_crcs, header_size, stage_size,
+                          FLAG_STAGE_EXT, FLAG_INT_DCT, FLAG_SKIP, FLAG_CRC, FLAG_CAT)
+from codec_v4 import stage_plan, stage_ranges, stage_id_from_range, skip_map_bytes
+from codec_v4_strip import _strip_blocks, _scan
+
+# Code lengths are capped so tables stay valid (write_table allows <= 31)
+MAX_CODE_LEN = 24
+
+def stage_alphabet(k0: int, k1: int, ah: int = 0, al: int = 0):
+    """
+    Every FLAG_CAT symbol one scan of band [k0, k1) can produce: (run, cat)
+    with run < k1 (runs count from zigzag position 0) and cat 1..16-al
+    (refinement scans send +-1 only), plus EOB and ZRL when runs can exceed 255.
+    """
+    cats = range(1, 2) if ah else range(1, 17 - al)
+    out = [(run, c) for run in range(min(k1, 256)) for c in cats]
+    out.append(EOB)
+    if k1 > 256:
+        out.append(ZRL)
+    return out
+
+def default_stage_counts(k0: int, k1: int, ah: int = 0, al: int = 0) -> Counter:
+    """
+    Generic prior when no statistics are known: EOB, small categories and
+    runs near 0 (inside a block) or near k0 (first value of a block) are likely.
+    """
+    counts = Counter({(run, c): 1 << max(0, 20 - 2 * min(run, abs(run - k0)) - abs(c - 2))
+                      for (run, c) in stage_alphabet(k0, k1, ah, al)})
+    counts[EOB] = 1 << 21
+    return counts
+
+def stage_counts_from_stream(path):
+    """
+    Per-stage symbol counts implied by the code lengths of an earlier FLAG_CAT
+    v4 stream (count ~ 2^-length), e.g. the previous slice of a series.
+    Returns [(k0, k1, ah, al, Counter)] in stream order.
+    """
+    with open(path, "rb") as f:
+        h = read_header(f)
+        if not h["flags"] & FLAG_CAT:
+            raise ValueError(f"{path}: statistics need a FLAG_CAT stream")
+        f.seek(header_size(h["flags"], h["nstages"]) + h["roi_bytes"] + h["sb_bytes"])
+        out = []
+        for _ in range(h["nstages"]):
+            sh = read_stage_header(f, bool(h["flags"] & FLAG_STAGE_EXT))
+            tbl = read_table(f, sh["table_len"])
+            maxlen = max(L for (_, _, L) in tbl)
+            out.append((sh["k0"], sh["k1"], sh["ah"], sh["al"],
+                        Counter({(run, val): 1 << (maxlen - L) for (run, val, L) in tbl})))
+            f.seek(sh["payload_len"], 1)
+    return out
+
+def _bounded_lengths(freqs: Counter):
+    """Huffman code lengths, flattening the counts until no code exceeds MAX_CODE_LEN."""
+    while True:
+        lengths = build_code_lengths_from_freqs(freqs)
+        if max(lengths.values()) <= MAX_CODE_LEN:
+            return lengths
+        freqs = Counter({sym: (n + 1) // 2 for sym, n in freqs.items()})
+
+class StreamEncoderV4:
+    """
+    Single-pass v4 encoder for rows that arrive over time (detector readout).
+    Code tables are fixed up front from prior statistics over the complete
+    FLAG_CAT alphabet of every stage (see stage_alphabet), so any block can be
+    coded the moment its block row is complete:
+
+        enc = StreamEncoderV4(f, width=W, height=H, blockN=8, qstep_bg=..., qstep_roi=...)
+        for rows in readout:
+            enc.write_rows(rows)
+        info = enc.close()
+
+    f must be seekable. Header, maps, stage 0 header + table are written at
+    construction; stage 0 symbols go to f as soon as they are coded, the maps
+    are filled in place, later stages are spooled (a v4 stream stores stages
+    one after another) and appended by close(), which also patches the
+    payload lengths and, with crc, the CRC block.
+    stats: [(k0, k1, ah, al, Counter)] per stage (stage_counts_from_stream),
+    default default_stage_counts(). Other options as in encode_v4_strips.
+    """
+    def __init__(self, f, *, width: int, height: int, blockN: int, qstep_bg: int, qstep_roi: int,
+                 bone_threshold: int = 9000, sb_qscale: int = 16, sa_al: int = 0, bounds=None,
+                 int_dct: bool = False, skip: bool = False, crc: bool = False, stats=None,
+                 spool_bytes: int = 16 << 20):
+        self.f = f
+        self.W, self.H, self.N = width, height, blockN
+        padH = (blockN - (height % blockN)) % blockN
+        padW = (blockN - (width % blockN)) % blockN
+        self.Wp = width + padW
+        self.Hb, self.Wb = (height + padH) // blockN, self.Wp // blockN
+        self.plan = stage_plan(blockN, sa_al, bounds)
+        ranges = stage_ranges(blockN, bounds)
+        self.sids = [stage_id_from_range(k0, k1, ranges) for (k0, k1, _, _) in self.plan]
+        if stats is not None and [s[:4] for s in stats] != [tuple(p) for p in self.plan]:
+            raise ValueError("stats do not match the stage plan (blockN / bands / sa_al)")
+
+        self.flags = FLAG_CAT | (FLAG_STAGE_EXT if (sa_al or blockN * blockN > 0xFF) else 0)
+        self.flags |= (FLAG_INT_DCT if int_dct else 0) | (FLAG_SKIP if skip else 0) | (FLAG_CRC if crc else 0)
+        self.skip, self.crc = skip, crc
+        self.kw = dict(blockN=blockN, Wp=self.Wp, C=dct_matrix(blockN), qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+                       bone_threshold=bone_threshold, sb_qscale=sb_qscale, int_dct=int_dct)
+
+        # ---- fixed tables over the full alphabet (+1: every symbol gets a code) ----
+        self.tables = []
+        for si, (k0, k1, ah, al) in enumerate(self.plan):
+            counts = Counter(dict.fromkeys(stage_alphabet(k0, k1, ah, al), 1))
+            counts.update(stats[si][4] if stats is not None else default_stage_counts(k0, k1, ah, al))
+            lengths = _bounded_lengths(counts)
+            self.tables.append(dict(
+                k0=k0, k1=k1, ah=ah, al=al, codes=canonical_codes_from_lengths(lengths),
+                table_entries=[(run, val, lengths[(run, val)]) for (run, val) in lengths.keys()],
+            ))
+
+        nb = self.Hb * self.Wb
+        self.map_len = skip_map_bytes(nb) if skip else 0
+        self.hdr = dict(flags=self.flags, bitdepth=16, blockN=blockN, width=width, height=height,
+                        padW=padW, padH=padH, qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+                        roi_bits=nb, roi_bytes=(nb + 7) // 8, sb_qscale=sb_qscale, sb_bytes=nb,
+                        nstages=len(self.tables))
+        write_header(f, **self.hdr)
+        self.roi_off = f.tell()
+        self.sb_off = self.roi_off + self.hdr["roi_bytes"]
+        f.write(bytes(self.hdr["roi_bytes"] + nb))  # maps are filled in row by row
+
+        # stage 0 goes straight to f, later stages into spools (payload_len patched in close)
+        self.sinks, self.stage_off = [], []
+        ext = bool(self.flags & FLAG_STAGE_EXT)
+        for si, t in enumerate(self.tables):
+            sink = f if si == 0 else tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+            self.stage_off.append(sink.tell())
+            write_stage_header(sink, t["k0"], t["k1"], len(t["table_entries"]), 0, ext=ext, ah=t["ah"], al=t["al"])
+            write_table(sink, t["table_entries"])
+            sink.write(bytes(self.map_len))
+            self.sinks.append(sink)
+        self.map_pos = [sink.tell() - self.map_len for sink in self.sinks]
+        self.pos = [sink.tell() for sink in self.sinks]
+        self.writers = [BitWriter() for _ in self.tables]
+        self.map_tail = [np.zeros(0, dtype=np.uint8) for _ in self.tables]
+        self.roi_tail = np.zeros(0, dtype=np.uint8)
+        self.pending = np.zeros((0, width), dtype=np.uint16)
+        self.rows_in = 0
+        self.brow = 0  # next block row to code
+
+    def _put(self, si: int, offset_attr: str, data: bytes):
+        lst = getattr(self, offset_attr)
+        sink = self.sinks[si]
+        sink.seek(lst[si])
+        sink.write(data)
+        lst[si] += len(data)
+
+    def _code_block_row(self, rows: np.ndarray):
+        br = self.brow
+        roi01, sb_q, qb, coeff_zz = _strip_blocks(rows, 0, 1, **self.kw)
+
+        # maps: ROI bits carry a partial byte between rows, block scales are 1 byte each
+        bits = np.concatenate([self.roi_tail, roi01])
+        nfull = bits.size & ~7
+        self.f.seek(self.roi_off + (br * self.Wb - self.roi_tail.size) // 8)
+        self.f.write(pack_bits_u8(bits[:nfull]))
+        self.roi_tail = bits[nfull:]
+        self.f.seek(self.sb_off + br * self.Wb)
+        self.f.write(sb_q.tobytes())
+
+        for si, t in enumerate(self.tables):
+            k0, codes, bw = t["k0"], t["codes"], self.writers[si]
+            zzq = _scan(coeff_zz, qb, k0, t["k1"], t["ah"], t["al"], self.N, self.sids[si])
+            blocks = range(zzq.shape[0])
+            if self.skip:
+                coded = zzq.any(axis=1)
+                blocks = np.flatnonzero(coded)
+                bits = np.concatenate([self.map_tail[si], coded.astype(np.uint8)])
+                nfull = bits.size & ~7
+                self._put(si, "map_pos", pack_bits_u8(bits[:nfull]))
+                self.map_tail[si] = bits[nfull:]
+            for i in blocks:
+                for sym in rle_encode_band(zzq[i], k0):
+                    sym, raw, n = cat_split(sym)
+                    code, L = codes[sym]
+                    bw.write_code((code << n) | raw, L + n)
+            self._put(si, "pos", bw.take_bytes())
+        self.brow += 1
+
+    def write_rows(self, rows):
+        """Append image rows (uint16, (n, width)); every completed block row is coded at once."""
+        rows = np.asarray(rows)
+        if rows.ndim != 2 or rows.shape[1] != self.W or rows.dtype != np.uint16:
+            raise ValueError(f"rows must be uint16 (n, {self.W}), got {rows.dtype} {rows.shape}")
+        if self.rows_in + rows.shape[0] > self.H:
+            raise ValueError(f"more than height={self.H} rows written")
+        self.rows_in += rows.shape[0]
+        self.pending = np.concatenate([self.pending, rows])  # copy: the caller may reuse its buffer
+        N = self.N
+        if self.pending.shape[0] >= N:
+            while self.pending.shape[0] >= N:
+                self._code_block_row(self.pending[:N])
+                self.pending = self.pending[N:]
+            self.f.flush()
+
+    def close(self):
+        """Flush the last (edge-padded) block row, assemble the stages, patch lengths / CRCs."""
+        if self.rows_in != self.H:
+            raise ValueError(f"got {self.rows_in} of {self.H} rows")
+        if self.pending.shape[0]:
+            self._code_block_row(self.pending)  # read_strip pads it to a full block row
+            self.pending = self.pending[:0]
+        f = self.f
+        if self.roi_tail.size:
+            f.seek(self.roi_off + self.hdr["roi_bytes"] - 1)
+            f.write(pack_bits_u8(self.roi_tail))
+
+        ext = bool(self.flags & FLAG_STAGE_EXT)
+        info = []
+        for si, t in enumerate(self.tables):
+            if self.skip and self.map_tail[si].size:
+                self._put(si, "map_pos", pack_bits_u8(self.map_tail[si]))
+            self._put(si, "pos", self.writers[si].finish())
+            sink = self.sinks[si]
+            payload_len = self.pos[si] - self.stage_off[si] - stage_size(len(t["table_entries"]), ext)
+            sink.seek(self.stage_off[si])
+            write_stage_header(sink, t["k0"], t["k1"], len(t["table_entries"]), payload_len,
+                               ext=ext, ah=t["ah"], al=t["al"])
+            info.append(dict(k0=t["k0"], k1=t["k1"], ah=t["ah"], al=t["al"],
+                             table_len=len(t["table_entries"]), payload_len=payload_len))
+        f.seek(self.pos[0])
+        for sink in self.sinks[1:]:
+            sink.seek(0)
+            while True:
+                data = sink.read(1 << 20)
+                if not data:
+                    break
+                f.write(data)
+            sink.close()
+        f.truncate()
+        if self.crc:
+            patch_crcs(f)
+        f.flush()
+        return dict(header=self.hdr, stages=info)
@@ -0,0 +1,282 @@
+import mmap, tempfile
+from collections import Counter
+import numpy as np
+from dct import dct_matrix
+from rle import rle_encode_band, cat_split, EOB
+from huff_canonical import build_code_lengths_from_freqs, canonical_codes_from_lengths
+from bitpack import BitWriter
+from roi import pack_bits_u8
+from canvas import output_buffer, store_rows
+from bitstream_v4 import write_header, write_stage_header, write_table, stage_size, index_v4, patch_crcs
+from codec_v4 import (block_scale_q, stage_plan, stage_ranges, stage_id_from_range, to_blocks, forward_zz, quantize_stage,
+                      sa_scan_values, forward_zz_int, reconstruct_rows, skip_map_bytes, SparseStageReader)
+from bitstream_v4 import FLAG_STAGE_EXT, FLAG_INT_DCT, FLAG_SKIP, FLAG_CRC, FLAG_CAT, FLAG_ROI_FIRST
+
+# Rough working-set cost of one block row: uint16 strip + float32 blocks,
+# coefficients and zigzag copies, plus per-block Python symbol lists.
+_BYTES_PER_PIXEL = 24
+_BYTES_PER_BLOCK = 512
+
+def strip_rows_for_budget(Wp: int, blockN: int, mem_bytes: int) -> int:
+    """Block rows per strip so that one strip's working set stays within mem_bytes."""
+    per_row = Wp * blockN * _BYTES_PER_PIXEL + (Wp // blockN) * _BYTES_PER_BLOCK
+    return max(1, int(mem_bytes) // per_row)
+
+def read_strip(x, r0: int, r1: int, Wp: int) -> np.ndarray:
+    """
+    Rows [r0, r1) of the edge-padded image, padded locally
+    (same values as np.pad(x, ..., mode="edge") on the whole image).
+    """
+    H, W = x.shape
+    rows = np.asarray(x[r0:min(r1, H)], dtype=np.uint16)
+    padH = r1 - r0 - rows.shape[0]
+    padW = Wp - W
+    if padH or padW:
+        rows = np.pad(rows, ((0, padH), (0, padW)), mode="edge")
+    return rows
+
+def _strip_blocks(x, br0, br1, *, blockN, Wp, C, qstep_bg, qstep_roi, bone_threshold, sb_qscale, int_dct):
+    rows = read_strip(x, br0 * blockN, br1 * blockN, Wp)
+    blocks = to_blocks(rows, blockN)                      # (n,N,N) float32
+    roi01 = (blocks >= float(bone_threshold)).any(axis=(1, 2)).astype(np.uint8)
+    sb_q = block_scale_q(blocks.mean(axis=(1, 2)), blocks.std(axis=(1, 2)), sb_qscale)
+    sb = np.clip(sb_q.astype(np.float32) / float(sb_qscale), 1.0, 1.6)
+    qb = np.where(roi01 == 1, np.float32(qstep_roi), np.float32(qstep_bg)) * sb
+    coeff_zz = forward_zz_int(blocks, blockN) if int_dct else forward_zz(blocks, C)
+    return roi01, sb_q, qb, coeff_zz
+
+def _scan(coeff_zz, qb, k0, k1, ah, al, blockN, sid):
+    zzq = quantize_stage(coeff_zz, qb, k0, k1, blockN, sid)
+    return sa_scan_values(zzq, ah, al) if (ah or al) else zzq
+
+def encode_v4_strips(x, out_path, *, blockN: int, qstep_bg: int, qstep_roi: int,
+                     bone_threshold: int = 9000, sb_qscale: int = 16,
+                     mem_bytes: int = 256 << 20, sa_al: int = 0, bounds=None, int_dct: bool = False,
+                     skip: bool = False, crc: bool = False, cat: bool = False):
+    """
+    Bounded-memory v4 encoder. x is any 2D uint16 array-like that supports row
+    slicing (typically np.load(..., mmap_mode="r") or np.memmap); it is read one
+    strip of block rows at a time, twice:
+      pass 1: ROI / block-scale maps (spilled to temp memmaps) + symbol counts
+      pass 2: Huffman coding straight into pre-sized payload slots of out_path
+    Peak memory is set by mem_bytes, not by the image size. Width/height beyond
+    u16 are written with the FLAG_DIM32 header variant; sa_al/bounds as in stage_plan();
+    int_dct selects the fixed-point transform (FLAG_INT_DCT), skip the
+    coded-block bitmaps (FLAG_SKIP), crc the per-stage checksums (FLAG_CRC,
+    computed from the finished file), cat the magnitude-category symbols (FLAG_CAT).
+    Returns dict(header=..., stages=[{k0,k1,table_len,payload_len}], strip_rows=...).
+    """
+    if x.ndim != 2 or x.dtype != np.uint16:
+        raise ValueError("Input must be a 2D uint16 array")
+    H, W = x.shape
+    padH = (blockN - (H % blockN)) % blockN
+    padW = (blockN - (W % blockN)) % blockN
+    Hp, Wp = H + padH, W + padW
+    Hb, Wb = Hp // blockN, Wp // blockN
+    rows_per_strip = strip_rows_for_budget(Wp, blockN, mem_bytes)
+    strips = [(b, min(b + rows_per_strip, Hb)) for b in range(0, Hb, rows_per_strip)]
+
+    C = dct_matrix(blockN)
+    plan = stage_plan(blockN, sa_al, bounds)
+    ranges = stage_ranges(blockN, bounds)
+    sids = [stage_id_from_range(k0, k1, ranges) for (k0, k1, _, _) in plan]
+    flags = FLAG_STAGE_EXT if (sa_al or blockN * blockN > 0xFF) else 0
+    if int_dct:
+        flags |= FLAG_INT_DCT
+    if skip:
+        flags |= FLAG_SKIP
+    if crc:
+        flags |= FLAG_CRC
+    if cat:
+        flags |= FLAG_CAT
+    map_len = skip_map_bytes(Hb * Wb) if skip else 0
+    kw = dict(blockN=blockN, Wp=Wp, C=C, qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+              bone_threshold=bone_threshold, sb_qscale=sb_qscale, int_dct=int_dct)
+
+    with tempfile.TemporaryFile() as roi_tf, tempfile.TemporaryFile() as sb_tf:
+        roi_map = np.memmap(roi_tf, dtype=np.uint8, mode="w+", shape=(Hb, Wb))
+        sb_map = np.memmap(sb_tf, dtype=np.uint8, mode="w+", shape=(Hb, Wb))
+
+        # ---- pass 1: maps + per-stage symbol statistics ----
+        freqs = [Counter() for _ in plan]
+        raw_bits = [0] * len(plan)  # FLAG_CAT magnitude bits, outside the Huffman counts
+        for br0, br1 in strips:
+            roi01, sb_q, qb, coeff_zz = _strip_blocks(x, br0, br1, **kw)
+            roi_map[br0:br1] = roi01.reshape(br1 - br0, Wb)
+            sb_map[br0:br1] = sb_q.reshape(br1 - br0, Wb)
+            for si, (k0, k1, ah, al) in enumerate(plan):
+                zzq = _scan(coeff_zz, qb, k0, k1, ah, al, blockN, sids[si])
+                for i in (np.flatnonzero(zzq.any(axis=1)) if skip else range(zzq.shape[0])):
+                    pairs = rle_encode_band(zzq[i], k0)
+                    if cat:
+                        items = [cat_split(sym) for sym in pairs]
+                        pairs = [sym for (sym, _, _) in items]
+                        raw_bits[si] += sum(n for (_, _, n) in items)
+                    freqs[si].update(pairs)
+
+        # ---- code tables; payload sizes follow exactly from the counts ----
+        tables = []
+        for si, (k0, k1, ah, al) in enumerate(plan):
+            if not freqs[si]:
+                freqs[si][EOB] = 0  # no coded blocks (skip): table-only EOB, as encode_v4; no payload bits
+            lengths = build_code_lengths_from_freqs(freqs[si])
+            nbits = raw_bits[si] + sum(freqs[si][sym] * L for sym, L in lengths.items())
+            tables.append(dict(
+                k0=k0, k1=k1, ah=ah, al=al,
+                codes=canonical_codes_from_lengths(lengths),
+                table_entries=[(run, val, lengths[(run, val)]) for (run, val) in lengths.keys()],
+                payload_len=map_len + (nbits + 7) // 8,
+            ))
+        del freqs
+
+        roi_bits = Hb * Wb
+        roi_nbytes = (roi_bits + 7) // 8
+        hdr = dict(
+            flags=flags, bitdepth=16, blockN=blockN,
+            width=W, height=H, padW=padW, padH=padH,
+            qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+            roi_bits=roi_bits, roi_bytes=roi_nbytes,
+            sb_qscale=sb_qscale, sb_bytes=Hb * Wb,
+            nstages=len(tables)
+        )
+
+        with open(out_path, "w+b") as f:
+            write_header(f, **hdr)
+            flat_roi = roi_map.reshape(-1)
+            chunk = 8 << 20  # multiple of 8 bits, so chunks pack independently
+            for i in range(0, roi_bits, chunk):
+                f.write(pack_bits_u8(flat_roi[i:i + chunk]))
+            flat_sb = sb_map.reshape(-1)
+            for i in range(0, flat_sb.size, chunk):
+                f.write(flat_sb[i:i + chunk].tobytes())
+
+            # stage headers + tables, payload slots reserved in between
+            off = f.tell()
+            offsets = []
+            for t in tables:
+                f.seek(off)
+                write_stage_header(f, t["k0"], t["k1"], len(t["table_entries"]), t["payload_len"],
+                                   ext=bool(flags & FLAG_STAGE_EXT), ah=t["ah"], al=t["al"])
+                write_table(f, t["table_entries"])
+                off += stage_size(len(t["table_entries"]), ext=bool(flags & FLAG_STAGE_EXT))
+                offsets.append(off)
+                off += t["payload_len"]
+            f.truncate(off)
+
+            # ---- pass 2: entropy-code each strip into its stage slots ----
+            writers = [BitWriter() for _ in tables]
+            map_tail = [np.zeros(0, dtype=np.uint8) for _ in tables]  # coded bits not yet a full byte (FLAG_SKIP)
+            map_pos = list(offsets)
+            pos = [o + map_len for o in offsets]
+            for br0, br1 in strips:
+                _, _, qb, coeff_zz = _strip_blocks(x, br0, br1, **kw)
+                for si, t in enumerate(tables):
+                    k0, codes, bw = t["k0"], t["codes"], writers[si]
+                    zzq = _scan(coeff_zz, qb, k0, t["k1"], t["ah"], t["al"], blockN, sids[si])
+                    blocks = range(zzq.shape[0])
+                    if skip:
+                        coded = zzq.any(axis=1)
+                        blocks = np.flatnonzero(coded)
+                        bits = np.concatenate([map_tail[si], coded.astype(np.uint8)])
+                        nfull = bits.size & ~7
+                        data, map_tail[si] = pack_bits_u8(bits[:nfull]), bits[nfull:]
+                        f.seek(map_pos[si])
+                        f.write(data)
+                        map_pos[si] += len(data)
+                    for i in blocks:
+                        for sym in rle_encode_band(zzq[i], k0):
+                            if cat:
+                                sym, raw, n = cat_split(sym)
+                                code, L = codes[sym]
+                                bw.write_code((code << n) | raw, L + n)
+                            else:
+                                code, L = codes[sym]
+                                bw.write_code(code, L)
+                    data = bw.take_bytes()
+                    f.seek(pos[si])
+                    f.write(data)
+                    pos[si] += len(data)
+            for si, bw in enumerate(writers):
+                if skip:
+                    f.seek(map_pos[si])
+                    f.write(pack_bits_u8(map_tail[si]))
+                f.seek(pos[si])
+                f.write(bw.finish())
+                pos[si] = f.tell()
+                if pos[si] != offsets[si] + tables[si]["payload_len"]:
+                    raise RuntimeError("strip encoder: payload size differs from pass-1 estimate")
+            if crc:
+                patch_crcs(f)
+
+        del roi_map, sb_map
+
+    stages = [dict(k0=t["k0"], k1=t["k1"], ah=t["ah"], al=t["al"], table_len=len(t["table_entries"]), payload_len=t["payload_len"])
+              for t in tables]
+    return dict(header=hdr, stages=stages, strip_rows=rows_per_strip)
+
+def decode_v4_strips(path, out, *, stages_to_decode: int = 255, strip_rows: int = 4):
+    """
+    Streaming v4 decoder: block rows come out in order and are written as uint16
+    rows straight into 'out' (any writable (H, W) array, e.g. an .npy memmap).
+    The stream itself is memory-mapped; every decoded stage keeps its own
+    SparseStageReader, advanced strip by strip, so the live state is strip_rows
+    block rows of coefficients/pixels plus one chunk of bulk-decode state.
+    Returns the parsed header.
+    """
+    with open(path, "rb") as f:
+        h, layout = index_v4(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # all views into mm live inside the helper, so mm can close afterwards
+            _decode_strips(mm, h, layout, out, stages_to_decode, strip_rows)
+    if hasattr(out, "flush"):
+        out.flush()
+    return h
+
+def _decode_strips(mm, h, layout, out, stages_to_decode, strip_rows):
+    N = h["blockN"]
+    H, W = h["height"], h["width"]
+    Hb = (H + h["padH"]) // N
+    Wb = (W + h["padW"]) // N
+    K = N * N
+    output_buffer(out, H, W)
+    if h["flags"] & FLAG_ROI_FIRST:
+        raise ValueError("ROI-first stages are not in raster order; use decode_v4")
+
+    buf = memoryview(mm)
+    roi_bits = np.frombuffer(mm, dtype=np.uint8, count=h["roi_bytes"], offset=layout["roi_offset"])
+    sb_map = np.frombuffer(mm, dtype=np.uint8, count=Hb * Wb, offset=layout["sb_offset"]).reshape(Hb, Wb)
+
+    n = max(1, min(stages_to_decode, h["nstages"]))
+    skip = bool(h["flags"] & FLAG_SKIP)
+    map_len = skip_map_bytes(Hb * Wb) if skip else 0
+    cat = bool(h["flags"] & FLAG_CAT)
+    decoders = []
+    for st in layout["stages"][:n]:
+        p0 = st["payload_offset"]
+        if st["payload_len"] < map_len:
+            raise ValueError("Malformed stream: skip bitmap truncated")
+        coded = np.frombuffer(mm, dtype=np.uint8, count=map_len, offset=p0) if skip else None
+        rd = SparseStageReader(buf[p0 + map_len:p0 + st["payload_len"]], st["table_entries"],
+                               st["k0"], st["k1"], K, cat)
+        decoders.append((st["al"], coded, rd))
+
+    int_dct = bool(h["flags"] & FLAG_INT_DCT)
+    step = max(1, int(strip_rows))
+    for br0 in range(0, Hb, step):
+        br1 = min(br0 + step, Hb)
+        nbs = (br1 - br0) * Wb
+        b0, b1 = br0 * Wb, br1 * Wb
+        zz = np.zeros((nbs, K), dtype=np.int16)
+        for al, coded, rd in decoders:
+            blocks = np.arange(nbs, dtype=np.int32)
+            if coded is not None:
+                blocks = np.flatnonzero(np.unpackbits(coded[b0 // 8:(b1 + 7) // 8])[b0 % 8:b0 % 8 + nbs]).astype(np.int32)
+            blk, pos, val = rd.read(blocks)
+            zz[blk, pos] += val << al  # scans of a band add up, as in merge_scan
+        live = zz.any(axis=1)
+
+        # ROI bits for this strip (MSB-first, possibly not byte aligned)
+        roi = np.unpackbits(roi_bits[b0 // 8:(b1 + 7) // 8])[b0 % 8:b0 % 8 + nbs]
+        pix = reconstruct_rows(zz, roi, sb_map[br0:br1].reshape(-1), qstep_bg=h["qstep_bg"], qstep_roi=h["qstep_roi"],
+                               sb_qscale=h["sb_qscale"], blockN=N, Wb=Wb, live=live, int_dct=int_dct)
+        store_rows(out, br0 * N, pix)
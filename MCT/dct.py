@@ -1,5 +1,9 @@
+from functools import lru_cache
 import numpy as np
 
+# Transform matrices are built once per size and shared (read-only) by every
+# caller and thread.
+@lru_cache(maxsize=None)
 def dct_matrix(N: int) -> np.ndarray:
     C = np.zeros((N, N), dtype=np.float32)
     alpha0 = np.sqrt(1.0 / N)
@@ -7,6 +11,7 @@ def dct_matrix(N: int) -> np.ndarray:
     for k in range(N):
         for n in range(N):
             C[k, n] = (alpha0 if k == 0 else alpha) * np.cos(np.pi * (2*n + 1) * k / (2*N))
+    C.setflags(write=False)
     return C
 
 def block_dct2(block: np.ndarray, C: np.ndarray) -> np.ndarray:
@@ -16,3 +21,52 @@ def block_dct2(block: np.ndarray, C: np.ndarray) -> np.ndarray:
 def block_idct2(coeff: np.ndarray, C: np.ndarray) -> np.ndarray:
     # IDCT: C^T * X * C
     return C.T @ coeff @ C
+
+def block_idct2_scaled(coeff: np.ndarray, N: int, M: int) -> np.ndarray:
+    # Reduced-size IDCT (JPEG-style scaled decoding):
+    # keep the top-left MxM coefficients of an NxN block, rescale by M/N so the
+    # DC still maps to the block mean, and invert with an M-point basis.
+    # coeff: (..., M, M) -> (..., M, M) pixels at 1/(N/M) resolution
+    Cm = dct_matrix(M)
+    return Cm.T @ (coeff * np.float32(M / N)) @ Cm
+
+# ---- Fixed-point integer transforms (bit-exact on every machine) ----
+# Basis entries are round(C * 2^DCT_INT_BITS); coefficients carry COEF_FRAC_BITS
+# fractional bits. Each 1-D pass accumulates in int64 and rounds half-up by an
+# arithmetic shift, so results never depend on BLAS or FMA behaviour. The point
+# of this path is determinism, not bandwidth: it moves more bytes than float32.
+# int64 is deliberate. libjpeg's int32 "islow" layout (13-bit basis, descaling
+# between passes) is sized for 8-bit samples; with 16-bit samples, and with
+# dequantized coefficients that can exceed the in-range magnitude several fold,
+# int32 headroom costs ~20 units of round-trip error at 8x8 (vs <= 1 here), and
+# numpy's integer matmul (no BLAS) is not faster in int32 anyway.
+DCT_INT_BITS = 20
+COEF_FRAC_BITS = 4
+
+@lru_cache(maxsize=None)
+def dct_matrix_int(N: int) -> np.ndarray:
+    k = np.arange(N, dtype=np.float64)[:, None]
+    n = np.arange(N, dtype=np.float64)[None, :]
+    C = np.cos(np.pi * (2*n + 1) * k / (2*N)) * np.sqrt(2.0 / N)
+    C[0, :] = np.sqrt(1.0 / N)
+    Ci = np.round(C * (1 << DCT_INT_BITS)).astype(np.int64)
+    Ci.setflags(write=False)
+    return Ci
+
+def rshift_round(x: np.ndarray, s: int) -> np.ndarray:
+    # floor(x / 2^s + 1/2) for signed integers
+    if s <= 0:
+        return x << -s
+    return (x + (1 << (s - 1))) >> s
+
+def block_dct2_int(block: np.ndarray, N: int) -> np.ndarray:
+    # integer pixels (..., N, N) -> int64 coefficients with COEF_FRAC_BITS fraction bits
+    Ci = dct_matrix_int(N)
+    t = rshift_round(Ci @ block.astype(np.int64), DCT_INT_BITS - COEF_FRAC_BITS)
+    return rshift_round(t @ Ci.T, DCT_INT_BITS)
+
+def block_idct2_int(coeff: np.ndarray, N: int, frac_bits: int = COEF_FRAC_BITS) -> np.ndarray:
+    # int64 coefficients (..., N, N) with frac_bits fraction bits -> int64 pixels
+    Ci = dct_matrix_int(N)
+    t = rshift_round(Ci.T @ coeff.astype(np.int64), DCT_INT_BITS)
+    return rshift_round(t @ Ci, DCT_INT_BITS + frac_bits)
@@ -1,48 +1,81 @@
 import argparse, os
 import numpy as np
-from bitstream_v4 import read_header, read_stage_header, read_table
-from roi import unpack_bits_u8
-from codec_v4 import decode_v4
+from bitstream_v4 import read_v4, FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST
+from codec_v4 import decode_v4, decode_thumbnail, decode_v4_scaled
+from canvas import window_lut
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", required=True, help="path to .mmip (v4)")
     ap.add_argument("--output", required=True, help="path to output .npy")
-    ap.add_argument("--stages", type=int, default=3, help="decode first N stages")
+    ap.add_argument("--stages", type=int, default=255, help="decode first N stages (default: all)")
+    ap.add_argument("--thumbnail", action="store_true", help="block-mean thumbnail from stage 0 only (no IDCT)")
+    ap.add_argument("--upsample", type=int, default=1, help="thumbnail nearest-neighbour upsampling factor")
+    ap.add_argument("--scale", type=int, default=1, help="reduced-resolution decode: 1, 2 (1/2) or 4 (1/4)")
+    ap.add_argument("--roi_only", action="store_true", help="stop the last stage after its ROI blocks (--roi_first streams)")
+    ap.add_argument("--window", type=float, nargs=2, metavar=("CENTER", "WIDTH"),
+                    help="write display-ready uint8 through this linear window (stored units)")
+    ap.add_argument("--lut", help="write lut[pixels] instead: .npy table with 65536 entries")
+    ap.add_argument("--dedup", action="store_true", help="inverse-transform repeated coefficient blocks once")
     args = ap.parse_args()
 
+    lut = None
+    if args.lut:
+        lut = np.load(args.lut)
+        if lut.shape != (65536,):
+            raise ValueError(f"LUT must have 65536 entries, got shape {lut.shape}")
+    elif args.window:
+        lut = window_lut(*args.window)
+
     with open(args.input, "rb") as f:
-        h = read_header(f)
-
-        # ROI map
-        roi_bytes = f.read(h["roi_bytes"])
-        if len(roi_bytes) != h["roi_bytes"]:
-            raise ValueError("Malformed stream: ROI map truncated")
-        roi_flat = unpack_bits_u8(roi_bytes, h["roi_bits"])
-
-        Hp = h["height"] + h["padH"]
-        Wp = h["width"] + h["padW"]
-        Hb = Hp // h["blockN"]
-        Wb = Wp // h["blockN"]
-        roi_blk = roi_flat.reshape(Hb, Wb).astype(np.uint8)
-
-        # Block-scale map
-        sb_bytes = f.read(h["sb_bytes"])
-        if len(sb_bytes) != h["sb_bytes"]:
-            raise ValueError("Malformed stream: block-scale map truncated")
-        sb_q = np.frombuffer(sb_bytes, dtype=np.uint8).reshape(Hb, Wb)
-
-        # Stages
-        stages_data = []
-        for _ in range(h["nstages"]):
-            sh = read_stage_header(f)
-            tbl = read_table(f, sh["table_len"])
-            payload = f.read(sh["payload_len"])
-            if len(payload) != sh["payload_len"]:
-                raise ValueError("Malformed stream: stage payload truncated")
-            stages_data.append(dict(k0=sh["k0"], k1=sh["k1"], table_entries=tbl, payload_bytes=payload))
+        # --roi_only: the file may end inside the last decoded stage, after its ROI part
+        h, roi_blk, sb_q, stages_data = read_v4(f, max_stages=1 if args.thumbnail else args.stages,
+                                                partial_last=args.roi_only and not args.thumbnail)
+
+    if args.thumbnail:
+        y = decode_thumbnail(
+            width=h["width"], height=h["height"],
+            padW=h["padW"], padH=h["padH"],
+            blockN=h["blockN"],
+            qstep_bg=h["qstep_bg"], qstep_roi=h["qstep_roi"],
+            block_roi_01=roi_blk,
+            sb_q=sb_q, sb_qscale=h["sb_qscale"],
+            stage0=stages_data[0],
+            upsample=args.upsample,
+            skip=bool(h["flags"] & FLAG_SKIP),
+            cat=bool(h["flags"] & FLAG_CAT),
+            roi_first=bool(h["flags"] & FLAG_ROI_FIRST),
+            lut=lut
+        )
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        np.save(args.output, y)
+        print(f"[decode_v4] wrote {args.output} shape={y.shape} dtype={y.dtype} thumbnail x{args.upsample}")
+        return
 
     n = max(1, min(args.stages, h["nstages"]))
+    if args.scale > 1:
+        y = decode_v4_scaled(
+            width=h["width"], height=h["height"],
+            padW=h["padW"], padH=h["padH"],
+            blockN=h["blockN"],
+            qstep_bg=h["qstep_bg"], qstep_roi=h["qstep_roi"],
+            block_roi_01=roi_blk,
+            sb_q=sb_q, sb_qscale=h["sb_qscale"],
+            stages_data=stages_data,
+            stages_to_decode=n,
+            scale=args.scale,
+            int_dct=bool(h["flags"] & FLAG_INT_DCT),
+            skip=bool(h["flags"] & FLAG_SKIP),
+            cat=bool(h["flags"] & FLAG_CAT),
+            roi_first=bool(h["flags"] & FLAG_ROI_FIRST),
+            lut=lut
+        )
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        np.save(args.output, y)
+        print(f"[decode_v4] wrote {args.output} shape={y.shape} dtype={y.dtype} stages={n}/{h['nstages']} scale=1/{args.scale}")
+        return
+
+    stats = {}
     y = decode_v4(
         width=h["width"], height=h["height"],
         padW=h["padW"], padH=h["padH"],
@@ -51,12 +84,25 @@ def main():
         block_roi_01=roi_blk,
         sb_q=sb_q, sb_qscale=h["sb_qscale"],
         stages_data=stages_data,
-        stages_to_decode=n
+        stages_to_decode=n,
+        int_dct=bool(h["flags"] & FLAG_INT_DCT),
+        skip=bool(h["flags"] & FLAG_SKIP),
+        cat=bool(h["flags"] & FLAG_CAT),
+        roi_first=bool(h["flags"] & FLAG_ROI_FIRST),
+        roi_only=args.roi_only,
+        lut=lut,
+        dedup=args.dedup,
+        stats=stats
     )
 
     os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
     np.save(args.output, y)
-    print(f"[decode_v4] wrote {args.output} shape={y.shape} dtype={y.dtype} stages={n}/{h['nstages']}")
+    print(f"[decode_v4] wrote {args.output} shape={y.shape} dtype={y.dtype} stages={n}/{h['nstages']}"
+          + (" (last stage ROI only)" if args.roi_only else ""))
+    coded = stats["blocks"] - stats["zero"]
+    hits = coded - stats["idct"]
+    print(f"[decode_v4] blocks={stats['blocks']} all-zero={stats['zero']} idct={stats['idct']}"
+          + (f" dedup hits={hits}/{coded} ({100.0 * hits / max(1, coded):.1f}%)" if args.dedup else ""))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
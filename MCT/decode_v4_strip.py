@@ -0,0 +1,32 @@
+import argparse, os, resource
+import numpy as np
+from bitstream_v4 import read_header
+from codec_v4_strip import decode_v4_strips
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="path to .mmip (v4)")
+    ap.add_argument("--output", required=True, help="path to output .npy (or raw uint16 with --raw)")
+    ap.add_argument("--stages", type=int, default=255, help="decode first N stages (default: all)")
+    ap.add_argument("--strip_rows", type=int, default=4, help="block rows decoded per strip")
+    ap.add_argument("--raw", action="store_true", help="write headerless little-endian uint16 instead of .npy")
+    args = ap.parse_args()
+
+    with open(args.input, "rb") as f:
+        h = read_header(f)
+    shape = (h["height"], h["width"])
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    if args.raw:
+        out = np.memmap(args.output, dtype="<u2", mode="w+", shape=shape)
+    else:
+        out = np.lib.format.open_memmap(args.output, mode="w+", dtype=np.uint16, shape=shape)
+    decode_v4_strips(args.input, out, stages_to_decode=args.stages, strip_rows=args.strip_rows)
+    del out
+
+    n = max(1, min(args.stages, h["nstages"]))
+    print(f"[decode_v4_strip] wrote {args.output} shape={shape} stages={n}/{h['nstages']}")
+    print(f"[decode_v4_strip] peak RSS={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+
+if __name__ == "__main__":
+    main()
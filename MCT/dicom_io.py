@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# CT values are stored as HU + HU_OFFSET in uint16 (air -1000 HU -> 24)
+HU_OFFSET = 1024
+
+def _pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("DICOM input needs pydicom (pip install pydicom)") from e
+    return pydicom
+
+def rescale_to_u16(px: np.ndarray, slope=1.0, intercept=0.0, offset: int = HU_OFFSET) -> np.ndarray:
+    """
+    Stored pixel values -> uint16: clip(px * slope + intercept + offset, 0, 65535).
+    Integer slope/intercept stay in integer arithmetic.
+    """
+    slope, intercept = float(slope), float(intercept)
+    if slope.is_integer() and intercept.is_integer():
+        v = px.astype(np.int64) * int(slope) + int(intercept + offset)
+    else:
+        v = np.rint(px.astype(np.float64) * slope + (intercept + offset))
+    return np.clip(v, 0, 65535).astype(np.uint16)
+
+def _slice_key(path):
+    ds = _pydicom().dcmread(path, stop_before_pixels=True)
+    pos = getattr(ds, "ImagePositionPatient", None)
+    z = float(pos[2]) if pos is not None and len(pos) == 3 else float(getattr(ds, "SliceLocation", 0.0))
+    return (z, int(getattr(ds, "InstanceNumber", 0) or 0), path)
+
+def _read_slice(path, offset):
+    ds = _pydicom().dcmread(path)
+    px = ds.pixel_array
+    if px.ndim != 2:
+        raise ValueError(f"{path}: expected a single-frame 2D slice, got shape {px.shape}")
+    return rescale_to_u16(px, getattr(ds, "RescaleSlope", 1), getattr(ds, "RescaleIntercept", 0), offset)
+
+def list_series(directory: str, *, workers: int = 8):
+    """
+    DICOM files of one series directory, sorted by slice position
+    (ImagePositionPatient z, then InstanceNumber). Non-DICOM files are skipped.
+    Only headers are read, in a thread pool.
+    """
+    pydicom = _pydicom()
+    paths = sorted(os.path.join(directory, n) for n in os.listdir(directory))
+    paths = [p for p in paths if os.path.isfile(p)]
+
+    def key(p):
+        try:
+            return _slice_key(p)
+        except pydicom.errors.InvalidDicomError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        keys = [k for k in ex.map(key, paths) if k is not None]
+    if not keys:
+        raise ValueError(f"No DICOM files in {directory}")
+    return [p for (_, _, p) in sorted(keys)]
+
+def iter_series(directory: str, *, workers: int = 8, offset: int = HU_OFFSET, prefetch: int = None):
+    """
+    Yield (index, path, uint16 2D slice) in slice order. Pixel data is decoded
+    and rescaled in a thread pool at most 'prefetch' slices ahead of the
+    consumer (default 2*workers), so memory stays bounded for long series.
+    """
+    paths = list_series(directory, workers=workers)
+    prefetch = max(1, prefetch or 2 * workers)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        pending = [ex.submit(_read_slice, p, offset) for p in paths[:prefetch]]
+        for i, p in enumerate(paths):
+            x = pending[i].result()
+            pending[i] = None
+            if i + prefetch < len(paths):
+                pending.append(ex.submit(_read_slice, paths[i + prefetch], offset))
+            yield i, p, x
+
+def load_series(directory: str, *, workers: int = 8, offset: int = HU_OFFSET) -> np.ndarray:
+    """Whole series as uint16 (nslices, H, W)."""
+    slices = [x for (_, _, x) in iter_series(directory, workers=workers, offset=offset)]
+    if len({s.shape for s in slices}) != 1:
+        raise ValueError("Slices in series differ in shape")
+    return np.stack(slices)
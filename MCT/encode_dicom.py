@@ -0,0 +1,45 @@
+import argparse, os
+from dicom_io import iter_series, HU_OFFSET
+from encode_ladder import encode_ladder
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="DICOM series directory")
+    ap.add_argument("--outdir", required=True, help="directory for the per-slice .mmip files")
+    ap.add_argument("--qualities", type=int, nargs="+", default=[10], help="one or more qualities per slice")
+    ap.add_argument("--name", default="s{i:04d}_q{q}_v4.mmip", help="output file name pattern")
+    ap.add_argument("--workers", type=int, default=8, help="threads for reading/rescaling slices")
+    ap.add_argument("--offset", type=int, default=HU_OFFSET, help="added to HU before the uint16 cast")
+    ap.add_argument("--block", type=int, default=8)
+    ap.add_argument("--bone_threshold", type=int, default=HU_OFFSET + 300, help="ROI threshold in stored units (default 300 HU)")
+    ap.add_argument("--sb_qscale", type=int, default=16, help="block-scale quant factor (default 16)")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--sa_bits", type=int, default=0, help="successive-approximation bit planes for the high band (0=off)")
+    ap.add_argument("--int_dct", action="store_true", help="fixed-point integer DCT (bit-exact decode on any platform)")
+    ap.add_argument("--skip", action="store_true", help="per-stage coded-block bitmaps; empty blocks cost no symbols")
+    ap.add_argument("--crc", action="store_true", help="store per-stage CRC32s (checked by mmip.py verify)")
+    ap.add_argument("--cat", action="store_true", help="JPEG-style (run, magnitude category) symbols + raw bits; small tables")
+    ap.add_argument("--roi_first", action="store_true", help="code each stage's ROI blocks first (decode_v4.py --roi_only can stop there)")
+    args = ap.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    total_in = total_out = 0
+    n = 0
+    for i, src, x in iter_series(args.input, workers=args.workers, offset=args.offset):
+        streams = encode_ladder(x, args.qualities, blockN=args.block, bone_threshold=args.bone_threshold,
+                                sb_qscale=args.sb_qscale, sa_al=args.sa_bits, bounds=args.bands,
+                                int_dct=args.int_dct, skip=args.skip, crc=args.crc, cat=args.cat,
+                                roi_first=args.roi_first)
+        for q, data in streams.items():
+            path = os.path.join(args.outdir, args.name.format(i=i, q=q))
+            with open(path, "wb") as f:
+                f.write(data)
+            total_out += len(data)
+        total_in += x.nbytes
+        n += 1
+        print(f"[encode_dicom] {os.path.basename(src)} -> slice {i} shape={x.shape} " +
+              " ".join(f"q{q}={len(d)}B" for q, d in streams.items()))
+    print(f"[encode_dicom] {n} slices, raw={total_in}B, coded={total_out}B")
+
+if __name__ == "__main__":
+    main()
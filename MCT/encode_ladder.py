@@ -0,0 +1,98 @@
+import argparse, io, os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from encode_v4 import quality_to_qsteps
+from codec_v4 import analyze_v4, code_stages_v4
+from bitstream_v4 import write_v4, FLAG_STAGE_EXT, FLAG_INT_DCT, FLAG_SKIP, FLAG_CRC, FLAG_CAT, FLAG_ROI_FIRST
+from sharedmem import to_shared, attach, detach, release
+
+def _code_rung(an, quality, sa_al=0, bounds=None):
+    if isinstance(an["coeff_zz"], dict):  # shared-memory descriptor (encode_ladder workers)
+        h, coeff_zz = attach(an["coeff_zz"])
+        try:
+            return _code_rung(dict(an, coeff_zz=coeff_zz), quality, sa_al, bounds)
+        finally:
+            del coeff_zz
+            detach(h)
+    flags = ((FLAG_STAGE_EXT if sa_al else 0) | (FLAG_INT_DCT if an["int_dct"] else 0)
+             | (FLAG_SKIP if an["skip"] else 0) | (FLAG_CRC if an["crc"] else 0) | (FLAG_CAT if an["cat"] else 0)
+             | (FLAG_ROI_FIRST if an["roi_first"] else 0))
+    q_bg, q_roi = quality_to_qsteps(quality)
+    stages = code_stages_v4(an, qstep_bg=q_bg, qstep_roi=q_roi, block_roi_01=an["roi_blk"],
+                            sa_al=sa_al, bounds=bounds, skip=an["skip"], cat=an["cat"], roi_first=an["roi_first"])
+    buf = io.BytesIO()
+    write_v4(
+        buf,
+        h=dict(flags=flags, bitdepth=16, blockN=an["blockN"],
+               width=an["width"], height=an["height"], padW=an["padW"], padH=an["padH"],
+               qstep_bg=q_bg, qstep_roi=q_roi, sb_qscale=an["sb_qscale"]),
+        roi_blk=an["roi_blk"], sb_q=an["sb_q"], stages=stages
+    )
+    return buf.getvalue()
+
+def encode_ladder(x_u16: np.ndarray, qualities, *, blockN: int = 8, bone_threshold: int = 9000,
+                  sb_qscale: int = 16, workers: int = 1, sa_al: int = 0, bounds=None,
+                  int_dct: bool = False, skip: bool = False, crc: bool = False, cat: bool = False,
+                  roi_first: bool = False):
+    """
+    Encode one image at several qualities. Block stats, ROI map and every block
+    DCT are computed once (analyze_v4); each rung only re-quantizes and
+    entropy-codes the shared coefficients, in worker processes if workers > 1
+    (the coefficients then go to the workers through shared memory, not pickled
+    once per rung).
+    Returns {quality: v4 .mmip bytes}, identical to separate encode_v4.py runs.
+    """
+    an = analyze_v4(x_u16, blockN=blockN, sb_qscale=sb_qscale, bone_threshold=bone_threshold, int_dct=int_dct)
+    an["int_dct"], an["skip"], an["crc"], an["cat"], an["roi_first"] = int_dct, skip, crc, cat, roi_first
+    an["height"], an["width"] = x_u16.shape
+    qualities = list(qualities)
+    if workers > 1 and len(qualities) > 1:
+        shm, desc = to_shared(an["coeff_zz"])
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(qualities))) as ex:
+                n = len(qualities)
+                streams = list(ex.map(_code_rung, [dict(an, coeff_zz=desc)] * n, qualities,
+                                      [sa_al] * n, [bounds] * n))
+        finally:
+            release(shm)
+    else:
+        streams = [_code_rung(an, q, sa_al, bounds) for q in qualities]
+    return dict(zip(qualities, streams))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="path to .npy (uint16 2D)")
+    ap.add_argument("--outdir", required=True, help="directory for the per-quality .mmip files")
+    ap.add_argument("--qualities", required=True, type=int, nargs="+", help="e.g. 10 30")
+    ap.add_argument("--name", default="q{q}_v4.mmip", help="output file name pattern")
+    ap.add_argument("--block", type=int, default=8)
+    ap.add_argument("--bone_threshold", type=int, default=9000)
+    ap.add_argument("--sb_qscale", type=int, default=16, help="block-scale quant factor (default 16)")
+    ap.add_argument("--workers", type=int, default=1, help="processes for entropy coding the rungs")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--sa_bits", type=int, default=0, help="successive-approximation bit planes for the high band (0=off)")
+    ap.add_argument("--int_dct", action="store_true", help="fixed-point integer DCT (bit-exact decode on any platform)")
+    ap.add_argument("--skip", action="store_true", help="per-stage coded-block bitmaps; empty blocks cost no symbols")
+    ap.add_argument("--crc", action="store_true", help="store per-stage CRC32s (checked by mmip.py verify)")
+    ap.add_argument("--cat", action="store_true", help="JPEG-style (run, magnitude category) symbols + raw bits; small tables")
+    ap.add_argument("--roi_first", action="store_true", help="code each stage's ROI blocks first (decode_v4.py --roi_only can stop there)")
+    args = ap.parse_args()
+
+    x = np.load(args.input)
+    if x.dtype != np.uint16 or x.ndim != 2:
+        raise ValueError("Input must be a 2D uint16 .npy array")
+
+    streams = encode_ladder(x, args.qualities, blockN=args.block, bone_threshold=args.bone_threshold,
+                            sb_qscale=args.sb_qscale, workers=args.workers, sa_al=args.sa_bits,
+                            bounds=args.bands, int_dct=args.int_dct,
+                            skip=args.skip, crc=args.crc, cat=args.cat, roi_first=args.roi_first)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    for q, data in streams.items():
+        path = os.path.join(args.outdir, args.name.format(q=q))
+        with open(path, "wb") as f:
+            f.write(data)
+        print(f"[encode_ladder] q={q}: wrote {path} ({len(data)}B)")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import argparse, os
 import numpy as np
-from roi import roi_mask_from_phantom, block_roi_map, pack_bits_u8
+from roi import roi_mask_from_phantom, block_roi_map
 from codec_v4 import encode_v4
-from bitstream_v4 import write_header, write_stage_header, write_table
+from metrics import psnr_from_mse
+from bitstream_v4 import write_v4, FLAG_STAGE_EXT, FLAG_INT_DCT, FLAG_SKIP, FLAG_CRC, FLAG_CAT, FLAG_ROI_FIRST
 
 def quality_to_qsteps(q: int):
     base = max(1, int(round(220 / max(1, q))))
@@ -18,6 +19,15 @@ def main():
     ap.add_argument("--block", type=int, default=8)
     ap.add_argument("--bone_threshold", type=int, default=9000)
     ap.add_argument("--sb_qscale", type=int, default=16, help="block-scale quant factor (default 16)")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--sa_bits", type=int, default=0, help="successive-approximation bit planes for the high band (0=off)")
+    ap.add_argument("--int_dct", action="store_true", help="fixed-point integer DCT (bit-exact decode on any platform)")
+    ap.add_argument("--skip", action="store_true", help="per-stage coded-block bitmaps; empty blocks cost no symbols")
+    ap.add_argument("--crc", action="store_true", help="store per-stage CRC32s (checked by mmip.py verify)")
+    ap.add_argument("--cat", action="store_true", help="JPEG-style (run, magnitude category) symbols + raw bits; small tables")
+    ap.add_argument("--roi_first", action="store_true", help="code each stage's ROI blocks first (decode_v4.py --roi_only can stop there)")
+    ap.add_argument("--distortion", action="store_true",
+                    help="print per-stage MSE/PSNR from the coefficients (no decode; before clipping)")
     args = ap.parse_args()
 
     x = np.load(args.input)
@@ -37,43 +47,44 @@ def main():
         roi_pix = np.pad(roi_pix, ((0, padH), (0, padW)), mode="edge")
     roi_blk = block_roi_map(roi_pix, blockN).astype(np.uint8)  # (Hb,Wb)
 
-    roi_bits = roi_blk.size
-    roi_bytes = pack_bits_u8(roi_blk)
-
     q_bg, q_roi = quality_to_qsteps(args.quality)
 
     sb_q, stages, meta = encode_v4(
         x, blockN=blockN,
         qstep_bg=q_bg, qstep_roi=q_roi,
         block_roi_01=roi_blk,
-        sb_qscale=args.sb_qscale
+        sb_qscale=args.sb_qscale,
+        sa_al=args.sa_bits,
+        bounds=args.bands,
+        int_dct=args.int_dct,
+        skip=args.skip,
+        cat=args.cat,
+        roi_first=args.roi_first,
+        distortion=args.distortion
     )
-    sb_bytes = sb_q.tobytes(order="C")  # 1 byte per block
+    flags = ((FLAG_STAGE_EXT if args.sa_bits else 0) | (FLAG_INT_DCT if args.int_dct else 0)
+             | (FLAG_SKIP if args.skip else 0) | (FLAG_CRC if args.crc else 0) | (FLAG_CAT if args.cat else 0)
+             | (FLAG_ROI_FIRST if args.roi_first else 0))
 
     os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
     with open(args.output, "wb") as f:
-        write_header(
+        write_v4(
             f,
-            flags=0, bitdepth=16, blockN=blockN,
-            width=W, height=H, padW=meta["padW"], padH=meta["padH"],
-            qstep_bg=q_bg, qstep_roi=q_roi,
-            roi_bits=roi_bits, roi_bytes=len(roi_bytes),
-            sb_qscale=args.sb_qscale, sb_bytes=len(sb_bytes),
-            nstages=len(stages)
+            h=dict(flags=flags, bitdepth=16, blockN=blockN,
+                   width=W, height=H, padW=meta["padW"], padH=meta["padH"],
+                   qstep_bg=q_bg, qstep_roi=q_roi, sb_qscale=args.sb_qscale),
+            roi_blk=roi_blk, sb_q=sb_q, stages=stages
         )
-        f.write(roi_bytes)
-        f.write(sb_bytes)
-
-        for st in stages:
-            write_stage_header(f, st["k0"], st["k1"], len(st["table_entries"]), len(st["payload_bytes"]))
-            write_table(f, st["table_entries"])
-            f.write(st["payload_bytes"])
 
     print(f"[encode_v4] wrote {args.output}")
     print(f"[encode_v4] q_bg={q_bg}, q_roi={q_roi}, sb_qscale={args.sb_qscale}")
-    print(f"[encode_v4] ROI blocks={roi_bits}, sb_bytes={len(sb_bytes)}")
+    print(f"[encode_v4] ROI blocks={roi_blk.size}, sb_bytes={sb_q.size}")
     for i, st in enumerate(stages):
-        print(f"[encode_v4] stage{i}: k[{st['k0']}:{st['k1']}) table={len(st['table_entries'])} payload={len(st['payload_bytes'])}B")
+        roi_part = f" roi_part={st['head_bytes']}B" if "head_bytes" in st else ""
+        print(f"[encode_v4] stage{i}: k[{st['k0']}:{st['k1']}) ah={st['ah']} al={st['al']} table={len(st['table_entries'])} payload={len(st['payload_bytes'])}B{roi_part}")
+        if args.distortion:
+            roi_d = "" if st["roi_mse"] is None else f" roi_mse={st['roi_mse']:.1f} roi_psnr={psnr_from_mse(st['roi_mse'], 16):.2f}"
+            print(f"[encode_v4] stage{i}: mse={st['mse']:.1f} psnr={psnr_from_mse(st['mse'], 16):.2f}{roi_d}")
 
 if __name__ == "__main__":
     main()
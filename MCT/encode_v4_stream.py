@@ -0,0 +1,61 @@
+import argparse, os, time
+import numpy as np
+from encode_v4 import quality_to_qsteps
+from codec_v4_stream import StreamEncoderV4, stage_counts_from_stream
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="path to .npy (uint16 2D, memory-mapped) or raw file with --raw")
+    ap.add_argument("--output", required=True, help="path to .mmip (v4, FLAG_CAT)")
+    ap.add_argument("--quality", required=True, type=int)
+    ap.add_argument("--block", type=int, default=8)
+    ap.add_argument("--bone_threshold", type=int, default=9000)
+    ap.add_argument("--sb_qscale", type=int, default=16, help="block-scale quant factor (default 16)")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--sa_bits", type=int, default=0, help="successive-approximation bit planes for the high band (0=off)")
+    ap.add_argument("--int_dct", action="store_true", help="fixed-point integer DCT (bit-exact decode on any platform)")
+    ap.add_argument("--skip", action="store_true", help="per-stage coded-block bitmaps; empty blocks cost no symbols")
+    ap.add_argument("--crc", action="store_true", help="store per-stage CRC32s (checked by mmip.py verify)")
+    ap.add_argument("--stats", help="earlier FLAG_CAT .mmip (e.g. previous slice) whose tables give the code statistics")
+    ap.add_argument("--rows_per_read", type=int, default=1, help="rows delivered per simulated readout")
+    ap.add_argument("--raw", action="store_true", help="input is headerless little-endian uint16")
+    ap.add_argument("--width", type=int, help="raw input width")
+    ap.add_argument("--height", type=int, help="raw input height")
+    args = ap.parse_args()
+
+    if args.raw:
+        if not (args.width and args.height):
+            raise ValueError("--raw needs --width and --height")
+        x = np.memmap(args.input, dtype="<u2", mode="r", shape=(args.height, args.width))
+    else:
+        x = np.load(args.input, mmap_mode="r")
+    if x.dtype != np.uint16 or x.ndim != 2:
+        raise ValueError("Input must be a 2D uint16 array")
+
+    q_bg, q_roi = quality_to_qsteps(args.quality)
+    stats = stage_counts_from_stream(args.stats) if args.stats else None
+    H, W = x.shape
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    lat = []
+    with open(args.output, "w+b") as f:
+        enc = StreamEncoderV4(f, width=W, height=H, blockN=args.block, qstep_bg=q_bg, qstep_roi=q_roi,
+                              bone_threshold=args.bone_threshold, sb_qscale=args.sb_qscale, sa_al=args.sa_bits,
+                              bounds=args.bands, int_dct=args.int_dct, skip=args.skip, crc=args.crc, stats=stats)
+        step = max(1, args.rows_per_read)
+        for r in range(0, H, step):
+            t0 = time.perf_counter()
+            enc.write_rows(x[r:r + step])
+            lat.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        info = enc.close()
+        t_close = time.perf_counter() - t0
+
+    print(f"[encode_v4_stream] wrote {args.output} ({os.path.getsize(args.output)}B) q_bg={q_bg}, q_roi={q_roi}, "
+          f"tables={'from ' + args.stats if args.stats else 'default prior'}")
+    for i, st in enumerate(info["stages"]):
+        print(f"[encode_v4_stream] stage{i}: k[{st['k0']}:{st['k1']}) ah={st['ah']} al={st['al']} table={st['table_len']} payload={st['payload_len']}B")
+    print(f"[encode_v4_stream] per-read latency max={1e3 * max(lat):.2f} ms mean={1e3 * sum(lat) / len(lat):.2f} ms "
+          f"({step} rows/read), close={1e3 * t_close:.2f} ms")
+
+if __name__ == "__main__":
+    main()
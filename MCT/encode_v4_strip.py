@@ -0,0 +1,58 @@
+import argparse, os, resource
+import numpy as np
+from encode_v4 import quality_to_qsteps
+from codec_v4_strip import encode_v4_strips
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="path to .npy (uint16 2D, memory-mapped) or raw file with --raw")
+    ap.add_argument("--output", required=True, help="path to .mmip (v4)")
+    ap.add_argument("--quality", required=True, type=int)
+    ap.add_argument("--block", type=int, default=8)
+    ap.add_argument("--bone_threshold", type=int, default=9000)
+    ap.add_argument("--sb_qscale", type=int, default=16, help="block-scale quant factor (default 16)")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--sa_bits", type=int, default=0, help="successive-approximation bit planes for the high band (0=off)")
+    ap.add_argument("--int_dct", action="store_true", help="fixed-point integer DCT (bit-exact decode on any platform)")
+    ap.add_argument("--skip", action="store_true", help="per-stage coded-block bitmaps; empty blocks cost no symbols")
+    ap.add_argument("--crc", action="store_true", help="store per-stage CRC32s (checked by mmip.py verify)")
+    ap.add_argument("--cat", action="store_true", help="JPEG-style (run, magnitude category) symbols + raw bits; small tables")
+    ap.add_argument("--mem_mb", type=int, default=256, help="working-memory budget per strip (MB)")
+    ap.add_argument("--raw", action="store_true", help="input is headerless little-endian uint16")
+    ap.add_argument("--width", type=int, help="raw input width")
+    ap.add_argument("--height", type=int, help="raw input height")
+    args = ap.parse_args()
+
+    if args.raw:
+        if not (args.width and args.height):
+            raise ValueError("--raw needs --width and --height")
+        x = np.memmap(args.input, dtype="<u2", mode="r", shape=(args.height, args.width))
+    else:
+        x = np.load(args.input, mmap_mode="r")
+    if x.dtype != np.uint16 or x.ndim != 2:
+        raise ValueError("Input must be a 2D uint16 array")
+
+    q_bg, q_roi = quality_to_qsteps(args.quality)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    info = encode_v4_strips(
+        x, args.output, blockN=args.block,
+        qstep_bg=q_bg, qstep_roi=q_roi,
+        bone_threshold=args.bone_threshold, sb_qscale=args.sb_qscale,
+        mem_bytes=args.mem_mb << 20,
+        sa_al=args.sa_bits,
+        bounds=args.bands,
+        int_dct=args.int_dct,
+        skip=args.skip,
+        crc=args.crc,
+        cat=args.cat
+    )
+
+    h = info["header"]
+    print(f"[encode_v4_strip] wrote {args.output}")
+    print(f"[encode_v4_strip] shape=({h['height']}, {h['width']}) q_bg={q_bg}, q_roi={q_roi}, strip={info['strip_rows']} block rows")
+    for i, st in enumerate(info["stages"]):
+        print(f"[encode_v4_strip] stage{i}: k[{st['k0']}:{st['k1']}) ah={st['ah']} al={st['al']} table={st['table_len']} payload={st['payload_len']}B")
+    print(f"[encode_v4_strip] peak RSS={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+
+if __name__ == "__main__":
+    main()
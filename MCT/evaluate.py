@@ -0,0 +1,168 @@
+import argparse, csv, sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import psnr_from_mse
+from roi import roi_mask_from_phantom
+
+SSIM_WIN = 7  # uniform window, K1/K2 and sample covariance as in the usual SSIM
+SSIM_K1, SSIM_K2 = 0.01, 0.03
+
+def _row_box_sums(a: np.ndarray, w: int) -> np.ndarray:
+    """Sums over every w x w window of a (rows, cols) -> (rows-w+1, cols-w+1)."""
+    c = np.cumsum(a, axis=1)
+    h = c[:, w - 1:].copy()
+    h[:, 1:] -= c[:, :-w]
+    out = h[:a.shape[0] - w + 1].copy()
+    for i in range(1, w):
+        out += h[i:i + a.shape[0] - w + 1]
+    return out
+
+def _ssim_tile(x: np.ndarray, y: np.ndarray, L: float, w: int = SSIM_WIN):
+    """Sum and count of the SSIM map over all full windows of a float64 tile."""
+    n = w * w
+    mx, my = _row_box_sums(x, w) / n, _row_box_sums(y, w) / n
+    cov = n / (n - 1.0)
+    vx = (_row_box_sums(x * x, w) / n - mx * mx) * cov
+    vy = (_row_box_sums(y * y, w) / n - my * my) * cov
+    vxy = (_row_box_sums(x * y, w) / n - mx * my) * cov
+    C1, C2 = (SSIM_K1 * L) ** 2, (SSIM_K2 * L) ** 2
+    s = ((2 * mx * my + C1) * (2 * vxy + C2)) / ((mx * mx + my * my + C1) * (vx + vy + C2))
+    return float(s.sum()), s.size
+
+def slice_sums(ref: np.ndarray, rec: np.ndarray, roi=None, *, bit_depth: int = 16, tile_rows: int = 256):
+    """
+    Error sums for one 2D slice, row tiles at a time (float64 accumulators,
+    at most tile_rows + SSIM_WIN - 1 rows converted at once).
+    roi: optional bool mask (same shape). Returns dict sse, n, roi_sse, roi_n,
+    ssim_sum, ssim_n; combine with sums_to_metrics().
+    """
+    if ref.shape != rec.shape or ref.ndim != 2:
+        raise ValueError(f"slice shape mismatch: {ref.shape} vs {rec.shape}")
+    if roi is not None and roi.shape != ref.shape:
+        raise ValueError(f"ROI mask shape {roi.shape} != {ref.shape}")
+    H, W = ref.shape
+    L = float((1 << bit_depth) - 1)
+    w = SSIM_WIN
+    acc = dict(sse=0.0, n=0, roi_sse=0.0, roi_n=0, ssim_sum=0.0, ssim_n=0)
+    for r0 in range(0, H, tile_rows):
+        r1 = min(H, r0 + tile_rows)
+        # error terms on rows r0..r1, SSIM windows whose top row lies there
+        x = np.asarray(ref[r0:min(H, r1 + w - 1)], dtype=np.float64)
+        y = np.asarray(rec[r0:min(H, r1 + w - 1)], dtype=np.float64)
+        d = x[:r1 - r0] - y[:r1 - r0]
+        d *= d
+        acc["sse"] += float(d.sum())
+        acc["n"] += d.size
+        if roi is not None:
+            m = np.asarray(roi[r0:r1], dtype=bool)
+            acc["roi_sse"] += float(d.sum(where=m))
+            acc["roi_n"] += int(np.count_nonzero(m))
+        if x.shape[0] >= w and W >= w:
+            s, k = _ssim_tile(x, y, L)
+            acc["ssim_sum"] += s
+            acc["ssim_n"] += k
+    return acc
+
+def sums_to_metrics(acc, bit_depth: int = 16):
+    """rmse, psnr, roi_psnr (None without ROI pixels), ssim (None below the window size)."""
+    mse = acc["sse"] / acc["n"]
+    roi_psnr = psnr_from_mse(acc["roi_sse"] / acc["roi_n"], bit_depth) if acc["roi_n"] else None
+    ssim = acc["ssim_sum"] / acc["ssim_n"] if acc["ssim_n"] else None
+    return dict(rmse=float(np.sqrt(mse)), psnr=psnr_from_mse(mse, bit_depth), roi_psnr=roi_psnr, ssim=ssim)
+
+def _as_slices(a: np.ndarray):
+    if a.ndim == 2:
+        return a[None]
+    if a.ndim == 3:
+        return a
+    raise ValueError(f"expected a 2D slice or 3D volume, got shape {a.shape}")
+
+def evaluate(ref: np.ndarray, recs, roi=None, *, bone_threshold=None, bit_depth: int = 16,
+             tile_rows: int = 256, workers: int = 1):
+    """
+    Quality table for any number of reconstructions of one reference.
+    ref: (H,W) or (S,H,W); recs: dict name -> array of the same shape (np.load
+    mmap_mode='r' arrays work and are read tile by tile).
+    roi: bool mask (H,W) or (S,H,W); bone_threshold instead derives it from
+    the reference (roi.roi_mask_from_phantom). Slices run on 'workers' threads.
+    Returns rows dict(name, slice, rmse, psnr, roi_psnr, ssim); volumes also
+    get a slice='all' row pooled over every pixel / SSIM window.
+    """
+    ref3 = _as_slices(ref)
+    roi3 = None
+    if roi is not None:
+        roi3 = np.broadcast_to(roi, ref3.shape) if np.ndim(roi) == 2 else _as_slices(roi)
+    jobs = []
+    for name, rec in recs.items():
+        rec3 = _as_slices(rec)
+        if rec3.shape != ref3.shape:
+            raise ValueError(f"{name}: shape {rec.shape} != reference {ref.shape}")
+        for s in range(ref3.shape[0]):
+            jobs.append((name, s, rec3[s]))
+
+    def run(job):
+        name, s, rec_s = job
+        m = roi3[s] if roi3 is not None else None
+        if m is None and bone_threshold is not None:
+            m = roi_mask_from_phantom(np.asarray(ref3[s]), bone_threshold)
+        return slice_sums(ref3[s], rec_s, m, bit_depth=bit_depth, tile_rows=tile_rows)
+
+    if workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+            sums = list(ex.map(run, jobs))
+    else:
+        sums = [run(j) for j in jobs]
+
+    rows = []
+    i = 0
+    for name in recs:
+        total = dict(sse=0.0, n=0, roi_sse=0.0, roi_n=0, ssim_sum=0.0, ssim_n=0)
+        for s in range(ref3.shape[0]):
+            acc = sums[i]
+            i += 1
+            rows.append(dict(name=name, slice=s, **sums_to_metrics(acc, bit_depth)))
+            for k in total:
+                total[k] += acc[k]
+        if ref3.shape[0] > 1:
+            rows.append(dict(name=name, slice="all", **sums_to_metrics(total, bit_depth)))
+    return rows
+
+COLUMNS = ["name", "slice", "rmse", "psnr", "roi_psnr", "ssim"]
+
+def _fmt(v):
+    if v is None:
+        return "-"
+    if isinstance(v, float):
+        return f"{v:.6g}"
+    return str(v)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ref", required=True, help="reference .npy (uint16 2D slice or 3D volume)")
+    ap.add_argument("--input", required=True, nargs="+", help="reconstruction .npy file(s), same shape")
+    ap.add_argument("--roi", help="ROI pixel mask .npy (2D or 3D); default: --bone_threshold on the reference")
+    ap.add_argument("--bone_threshold", type=int, default=9000)
+    ap.add_argument("--bit_depth", type=int, default=16)
+    ap.add_argument("--tile_rows", type=int, default=256, help="rows converted per tile (bounds memory)")
+    ap.add_argument("--workers", type=int, default=1, help="threads across slices")
+    ap.add_argument("--csv", help="also write the table as CSV")
+    args = ap.parse_args()
+
+    ref = np.load(args.ref, mmap_mode="r")
+    recs = {p: np.load(p, mmap_mode="r") for p in args.input}
+    roi = np.load(args.roi).astype(bool) if args.roi else None
+    rows = evaluate(ref, recs, roi, bone_threshold=None if roi is not None else args.bone_threshold,
+                    bit_depth=args.bit_depth, tile_rows=args.tile_rows, workers=args.workers)
+
+    print("\t".join(COLUMNS))
+    for r in rows:
+        print("\t".join(_fmt(r[c]) for c in COLUMNS))
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            wr = csv.DictWriter(f, fieldnames=COLUMNS)
+            wr.writeheader()
+            wr.writerows(rows)
+        print(f"[evaluate] wrote {args.csv}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
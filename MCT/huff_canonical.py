@@ -3,6 +3,7 @@ import heapq
 from collections import Counter
 from dataclasses import dataclass
 from typing import Dict, Tuple, List, Optional
+import numpy as np
 
 Symbol = Tuple[int, int]  # (run, value)
 
@@ -28,7 +29,9 @@ def _build_tree(freqs: Dict[Symbol, int]) -> _Node:
         heapq.heappush(pq, _Node(freq=a.freq + b.freq, left=a, right=b))
     return pq[0]
 
-def _collect_lengths(node: _Node, depth: int, out: Dict[Symbol, int]):
+def _collect_lengths(node: Optional[_Node], depth: int, out: Dict[Symbol, int]):
+    if node is None:  # childless filler of the one-symbol tree
+        return
     if node.sym is not None:
         out[node.sym] = max(1, depth)  # avoid 0-length
         return
@@ -36,7 +39,12 @@ def _collect_lengths(node: _Node, depth: int, out: Dict[Symbol, int]):
     _collect_lengths(node.right, depth + 1, out)
 
 def build_code_lengths(symbols: List[Symbol]) -> Dict[Symbol, int]:
-    freqs = Counter(symbols)
+    return build_code_lengths_from_freqs(Counter(symbols))
+
+def build_code_lengths_from_freqs(freqs: Dict[Symbol, int]) -> Dict[Symbol, int]:
+    """Same as build_code_lengths, from counts gathered elsewhere (e.g. per strip)."""
+    if not freqs:
+        raise ValueError("No symbols to build a Huffman code for")
     tree = _build_tree(freqs)
     lengths: Dict[Symbol, int] = {}
     _collect_lengths(tree, 0, lengths)
@@ -80,6 +88,183 @@ def decode_one_symbol(trie, bitreader) -> Symbol:
         cur = cur[b]
     return cur["sym"]
 
+def canonical_tables(lengths: Dict[Symbol, int]):
+    """
+    Canonical code layout for length-indexed decoding: symbols in code order,
+    plus per length l: first code, number of codes, index of the first symbol.
+    """
+    items = sorted(lengths.items(), key=lambda kv: (kv[1], _sym_key(kv[0])))
+    syms = [sym for sym, _ in items]
+    maxlen = items[-1][1]
+    first = [0] * (maxlen + 1)
+    count = [0] * (maxlen + 1)
+    offset = [0] * (maxlen + 1)
+    code = 0
+    prev_len = 0
+    for i, (_, L) in enumerate(items):
+        code <<= (L - prev_len)
+        if count[L] == 0:
+            first[L], offset[L] = code, i
+        count[L] += 1
+        code += 1
+        prev_len = L
+    return syms, first, count, offset
+
+LUT_BITS = 12
+
+def _length_lut(first, count, offset, bits: int):
+    """Code length / symbol index for every 'bits'-bit prefix (0 / -1: longer code)."""
+    Lt = np.zeros(1 << bits, dtype=np.int64)
+    It = np.full(1 << bits, -1, dtype=np.int64)
+    for l in range(1, min(bits, len(first) - 1) + 1):
+        if count[l]:
+            sh = bits - l
+            lo, hi = first[l] << sh, (first[l] + count[l]) << sh
+            Lt[lo:hi] = l
+            It[lo:hi] = offset[l] - first[l] + (np.arange(lo, hi) >> sh)
+    return Lt, It
+
+def _decode_at(w64: np.ndarray, a: int, n: int, first, count, offset, lut):
+    """
+    Code length (0 = no valid code) and symbol index (-1) of a code starting
+    at each bit position a..a+n-1; w64[k] holds payload bytes k..k+7 big-endian.
+    """
+    maxlen = len(first) - 1
+    P = min(LUT_BITS, maxlen)
+    i = np.arange(a, a + n, dtype=np.uint64)
+    win = (w64[i >> np.uint64(3)] << (i & np.uint64(7))) >> np.uint64(64 - maxlen)
+    top = (win >> np.uint64(maxlen - P)).astype(np.intp)
+    L, idx = lut[0][top], lut[1][top]
+    rest = np.flatnonzero(L == 0)
+    if rest.size and maxlen > P:
+        w = win[rest].astype(np.int64)
+        Lr, Ir = L[rest], idx[rest]
+        for l in range(P + 1, maxlen + 1):
+            if count[l] == 0:
+                continue
+            d = (w >> (maxlen - l)) - first[l]
+            hit = (Lr == 0) & (d >= 0) & (d < count[l])
+            Lr[hit] = l
+            Ir[hit] = offset[l] + d[hit]
+        L[rest], idx[rest] = Lr, Ir
+    return L, idx
+
+def _words64(data: np.ndarray, b0: int, n: int) -> np.ndarray:
+    """w[k] = bytes b0+k .. b0+k+7 of data as a big-endian uint64 (zeros past the end), k < n."""
+    buf = np.zeros(n + 7, dtype=np.uint64)
+    seg = data[b0:b0 + n + 7]
+    buf[:seg.size] = seg
+    w = np.zeros(n, dtype=np.uint64)
+    for j in range(8):
+        w |= buf[j:j + n] << np.uint64(8 * (7 - j))
+    return w
+
+class VecSymbolReader:
+    """
+    Vectorized canonical Huffman decoding (no per-symbol Python loop). Every
+    bit position of a chunk is decoded as if a code started there (LUT on the
+    first LUT_BITS bits, length search for longer codes), then the actual code
+    chain from the current position is extracted by pointer doubling.
+    read(n) returns whole 'stop'-terminated groups (e.g. RLE blocks) and
+    resumes where it left off, so working memory follows chunk_bits, not the
+    payload size.
+    extra: raw bits that follow each symbol's code (missing = 0), e.g. the
+    magnitude bits of the category model.
+    """
+    def __init__(self, payload, lengths: Dict[Symbol, int], stop: Symbol,
+                 extra: Optional[Dict[Symbol, int]] = None, chunk_bits: int = 1 << 18):
+        self.syms, self.first, self.count, self.offset = canonical_tables(lengths)
+        maxlen = len(self.first) - 1
+        if maxlen > 57:
+            raise ValueError(f"Huffman code length {maxlen} > 57 not supported")
+        self.lut = _length_lut(self.first, self.count, self.offset, min(LUT_BITS, maxlen))
+        if stop not in lengths:
+            raise ValueError(f"Huffman table has no {stop} symbol")
+        self.stop_idx = self.syms.index(stop)
+        self.xbits = np.array([extra.get(sym, 0) for sym in self.syms] + [0], dtype=np.int64) if extra else None
+        self.data = np.frombuffer(payload, dtype=np.uint8)
+        self.nbits = 8 * self.data.size
+        self.chunk_bits = int(chunk_bits)
+        self.pos = 0    # bit position of the next code
+        self.groups = 0
+
+    def read(self, max_groups: int):
+        """
+        Decode the next 1..max_groups groups (fewer if they span more than a
+        chunk). Returns (symbol indices into self.syms, each group ending with
+        the stop symbol; raw bits per symbol or None without 'extra').
+        """
+        nbits, xbits = self.nbits, self.xbits
+        # size the chunk from the bits per group so far: short reads stay cheap
+        est = 64 * max_groups if not self.groups else (self.pos * max_groups) // self.groups
+        C0 = max(1024, min(self.chunk_bits, est + est // 4 + 64))
+        while True:
+            start = self.pos
+            if start >= nbits:
+                raise EOFError("Unexpected end of bitstream")
+            C = min(C0, nbits - start)
+            b0 = start >> 3
+            w64 = _words64(self.data, b0, ((start + C + 63) >> 3) - b0 + 1)
+            a = start - 8 * b0
+            L, idx = _decode_at(w64, a, C, self.first, self.count, self.offset, self.lut)
+            step_len = L + xbits[idx] if xbits is not None else L  # idx -1 (no code) -> sentinel 0
+            # next code start inside the chunk; C = leaves the chunk, C+1 = invalid code
+            nxt = np.arange(C, dtype=np.int64) + step_len
+            nxt[nxt >= C] = C
+            nxt[L == 0] = C + 1
+            J = np.concatenate([nxt, [C, C + 1]])
+            pos = np.zeros(1, dtype=np.int64)
+            while True:
+                step = J[pos]
+                step = step[step < C]
+                if step.size == 0:
+                    break
+                pos = np.concatenate([pos, step])
+                J = J[J]
+            pos = np.unique(pos)
+            sidx = idx[pos]
+            hits = np.flatnonzero(sidx == self.stop_idx)
+            if hits.size:
+                ngroups = min(max_groups, hits.size)
+                last = hits[ngroups - 1]
+                break
+            if L[pos[-1]] == 0:
+                raise ValueError("Invalid Huffman code (corrupt stream)")
+            if C == nbits - start:
+                raise EOFError("Unexpected end of bitstream")
+            C0 *= 2  # one group longer than the chunk
+        pos, sidx = pos[:last + 1], sidx[:last + 1]
+        raw = None
+        if xbits is not None:
+            n = xbits[sidx]
+            q = np.minimum(a + pos + L[pos], a + nbits - start).astype(np.uint64)
+            w = (w64[q >> np.uint64(3)] << (q & np.uint64(7))) >> (np.uint64(64) - np.maximum(n, 1).astype(np.uint64))
+            raw = np.where(n > 0, w.astype(np.int64), 0)
+        end = start + int(pos[-1] + step_len[pos[-1]])
+        if end > nbits:
+            raise EOFError("Unexpected end of bitstream")
+        self.pos = end
+        self.groups += ngroups
+        return sidx, raw
+
+def decode_symbols_vec(payload, lengths: Dict[Symbol, int], stop: Symbol, stop_count: int,
+                       extra: Optional[Dict[Symbol, int]] = None, chunk_bits: int = 1 << 18):
+    """
+    Decode up to and including the stop_count-th 'stop' symbol in one call
+    (see VecSymbolReader).
+    Returns (symbol index array, symbols in canonical order, raw bits per
+    symbol or None without 'extra').
+    """
+    r = VecSymbolReader(payload, lengths, stop, extra, chunk_bits)
+    out, raws = [], []
+    while r.groups < stop_count:
+        sidx, raw = r.read(stop_count - r.groups)
+        out.append(sidx)
+        raws.append(raw)
+    seq = np.concatenate(out) if out else np.zeros(0, dtype=np.int64)
+    raw = (np.concatenate(raws) if raws else np.zeros(0, dtype=np.int64)) if extra else None
+    return seq, r.syms, raw
+
 def _sym_key(sym: Symbol):
     # stable ordering by serialized bytes: run (0..255), value (-32768..32767)
     run, val = sym
@@ -13,3 +13,10 @@ def psnr(x: np.ndarray, y: np.ndarray, bit_depth: int) -> float:
         return float("inf")
     maxv = (2 ** bit_depth) - 1
     return float(20.0 * np.log10(maxv) - 10.0 * np.log10(mse))
+
+def psnr_from_mse(mse: float, bit_depth: int) -> float:
+    """PSNR for an MSE computed elsewhere (e.g. encode_v4 distortion=True)."""
+    if mse == 0.0:
+        return float("inf")
+    maxv = (2 ** bit_depth) - 1
+    return float(20.0 * np.log10(maxv) - 10.0 * np.log10(mse))
@@ -0,0 +1,146 @@
+import argparse, mmap, os, sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from bitstream_v4 import (index_v4, stream_crcs, FLAG_DIM32, FLAG_STAGE_EXT, FLAG_INT_DCT,
+                          FLAG_SKIP, FLAG_CRC, FLAG_CAT, FLAG_ROI_FIRST)
+
+FLAG_NAMES = [(FLAG_DIM32, "dim32"), (FLAG_STAGE_EXT, "stage_ext"), (FLAG_INT_DCT, "int_dct"),
+              (FLAG_SKIP, "skip"), (FLAG_CRC, "crc"), (FLAG_CAT, "cat"),
+              (FLAG_ROI_FIRST, "roi_first")]
+
+def expand_paths(paths):
+    """Files as given; directories -> every *.mmip below them, sorted."""
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, names in os.walk(p):
+                out.extend(os.path.join(root, n) for n in names if n.endswith(".mmip"))
+        else:
+            out.append(p)
+    return sorted(out)
+
+def flag_names(flags: int) -> str:
+    return ",".join(name for bit, name in FLAG_NAMES if flags & bit) or "-"
+
+def inspect_file(path):
+    """
+    Header-level summary of one v4 file: no payload is read, only the header,
+    stage tables and the ROI / block-scale maps.
+    """
+    with open(path, "rb") as f:
+        h, layout = index_v4(f)
+        f.seek(layout["roi_offset"])
+        roi = np.unpackbits(np.frombuffer(f.read(h["roi_bytes"]), dtype=np.uint8))[:h["roi_bits"]]
+        sb = np.frombuffer(f.read(h["sb_bytes"]), dtype=np.uint8)
+    return dict(
+        path=path, size=layout["end"], header=h,
+        stages=[dict(k0=st["k0"], k1=st["k1"], ah=st["ah"], al=st["al"],
+                     table_len=len(st["table_entries"]), payload_len=st["payload_len"])
+                for st in layout["stages"]],
+        roi_frac=float(roi.mean()) if roi.size else 0.0,
+        sb_min=int(sb.min()) if sb.size else 0, sb_mean=float(sb.mean()) if sb.size else 0.0,
+        sb_max=int(sb.max()) if sb.size else 0,
+    )
+
+def verify_file(path):
+    """
+    Structural check (index_v4 bounds) plus, for FLAG_CRC files, CRC32 of the
+    maps and every stage straight from the memory-mapped file.
+    Returns dict(path, status in OK/NOCRC/BAD, bad=[region names]).
+    """
+    with open(path, "rb") as f:
+        h, layout = index_v4(f)
+        if not h["flags"] & FLAG_CRC:
+            return dict(path=path, status="NOCRC", bad=[], size=layout["end"])
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            got = stream_crcs(mm, layout)
+    names = ["maps"] + [f"stage{i}" for i in range(h["nstages"])]
+    bad = [n for n, a, b in zip(names, got, h["crcs"]) if a != b]
+    return dict(path=path, status="BAD" if bad else "OK", bad=bad, size=layout["end"])
+
+def decode_file(path, outdir, stages=255):
+    """Any-version decode (mmip_io.open_mmip) of one file to outdir/<name>.npy."""
+    from mmip_io import open_mmip
+    m = open_mmip(path)
+    y = m.decode(stages)
+    dst = os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + ".npy")
+    np.save(dst, y)
+    return dict(path=path, status="OK", version=m.version, dst=dst, shape=y.shape,
+                stages=min(stages, m.nstages), nstages=m.nstages)
+
+def _safe(fn, path):
+    try:
+        return fn(path)
+    except (OSError, ValueError) as e:
+        return dict(path=path, status="ERROR", error=str(e))
+
+def print_inspect(r):
+    if "error" in r:
+        print(f"[mmip] {r['path']}: ERROR {r['error']}")
+        return
+    h = r["header"]
+    print(f"[mmip] {r['path']}: {r['size']}B {h['width']}x{h['height']} block={h['blockN']} "
+          f"q_bg={h['qstep_bg']} q_roi={h['qstep_roi']} flags={flag_names(h['flags'])}")
+    print(f"[mmip]   ROI={100 * r['roi_frac']:.1f}% of {h['roi_bits']} blocks, "
+          f"sb_q min/mean/max={r['sb_min']}/{r['sb_mean']:.2f}/{r['sb_max']} (qscale {h['sb_qscale']})")
+    for i, st in enumerate(r["stages"]):
+        print(f"[mmip]   stage{i}: k[{st['k0']}:{st['k1']}) ah={st['ah']} al={st['al']} "
+              f"table={st['table_len']} payload={st['payload_len']}B")
+
+def main():
+    ap = argparse.ArgumentParser(description="inspect / verify v4 .mmip files, decode any version")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name, help_ in (("inspect", "per-stage sizes and map statistics from the headers"),
+                        ("verify", "check the per-stage CRC32s (files written with --crc)"),
+                        ("decode", "decode v1-v4 files to .npy (version read from each file)")):
+        p = sub.add_parser(name, help=help_)
+        p.add_argument("paths", nargs="+", help=".mmip files and/or directories")
+        p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        if name == "decode":
+            p.add_argument("--outdir", required=True, help="directory for the .npy outputs")
+            p.add_argument("--stages", type=int, default=255, help="decode first N stages (default: all)")
+    args = ap.parse_args()
+
+    paths = expand_paths(args.paths)
+    if args.cmd == "decode":
+        os.makedirs(args.outdir, exist_ok=True)
+        fn = lambda p: decode_file(p, args.outdir, args.stages)
+    else:
+        fn = inspect_file if args.cmd == "inspect" else verify_file
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+        results = list(ex.map(lambda p: _safe(fn, p), paths))
+
+    if args.cmd == "inspect":
+        for r in results:
+            print_inspect(r)
+        ok = [r for r in results if "error" not in r]
+        stage_bytes = {}
+        for r in ok:
+            for i, st in enumerate(r["stages"]):
+                stage_bytes[i] = stage_bytes.get(i, 0) + st["payload_len"]
+        print(f"[mmip] {len(ok)}/{len(results)} files, {sum(r['size'] for r in ok)}B total, " +
+              " ".join(f"stage{i}={b}B" for i, b in sorted(stage_bytes.items())))
+        return 0 if len(ok) == len(results) else 1
+
+    if args.cmd == "decode":
+        for r in results:
+            if r["status"] == "OK":
+                print(f"[mmip] {r['path']}: v{r['version']} -> {r['dst']} shape={r['shape']} "
+                      f"stages={r['stages']}/{r['nstages']}")
+            else:
+                print(f"[mmip] {r['path']}: ERROR {r['error']}")
+        nok = sum(r["status"] == "OK" for r in results)
+        print(f"[mmip] decoded {nok}/{len(results)} files")
+        return 0 if nok == len(results) else 1
+
+    counts = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+        if r["status"] in ("BAD", "ERROR"):
+            print(f"[mmip] {r['path']}: {r['status']} {r.get('error') or ' '.join(r['bad'])}")
+    print(f"[mmip] verified {len(results)} files: " +
+          " ".join(f"{k}={counts.get(k, 0)}" for k in ("OK", "NOCRC", "BAD", "ERROR")))
+    return 1 if counts.get("BAD") or counts.get("ERROR") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
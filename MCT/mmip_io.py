@@ -0,0 +1,141 @@
+import os
+import numpy as np
+
+# One entry point for every .mmip version. Headers are parsed by the
+# version's own bitstream module (imported on first use); all versions decode
+# through the v4 back end: bulk Huffman decoding into sparse triplets
+# (codec_v4.decode_stage_sparse) and strip-wise dequantization + batched IDCT
+# (codec_v4.reconstruct_image). v1-v3 have no block-scale map, which is the
+# v4 reconstruction with sb = 1 everywhere.
+
+MAGIC = b"MMIP"
+
+def sniff_version(f) -> int:
+    """Version byte of an open .mmip stream; the file position is left unchanged."""
+    pos = f.tell()
+    head = f.read(5)
+    f.seek(pos)
+    if len(head) != 5:
+        raise ValueError("Malformed stream: header too short")
+    if head[:4] != MAGIC:
+        raise ValueError("Bad magic number (not MMIP)")
+    return head[4]
+
+class MMIPFile:
+    """
+    A parsed .mmip file of any version (see open_mmip).
+    version, header (the version's header dict), nstages, shape (height, width);
+    decode() gives the uint16 image.
+    """
+    def __init__(self, path, version, header, *, roi_blk, sb_q, sb_qscale, stages=None, payload=None):
+        self.path, self.version, self.header = path, version, header
+        self.roi_blk, self.sb_q, self.sb_qscale = roi_blk, sb_q, sb_qscale
+        self.stages = stages or []
+        self.payload = payload  # v1: memory-mapped int16 (nb, K)
+
+    @property
+    def shape(self):
+        return self.header["height"], self.header["width"]
+
+    @property
+    def nstages(self) -> int:
+        return max(1, len(self.stages))
+
+    def decode(self, stages: int = 255, *, roi_only: bool = False, lut=None, out=None) -> np.ndarray:
+        """
+        First 'stages' stages (v1/v2 have one). lut / out as in codec_v4.decode_v4;
+        roi_only only for v4 FLAG_ROI_FIRST files.
+        """
+        from codec_v4 import decode_v4, reconstruct_image, decode_stage_sparse, SparseCoeffs, DenseCoeffs
+        h = self.header
+        N = h["blockN"]
+        Wb = (h["width"] + h["padW"]) // N
+        if self.version == 4:
+            from bitstream_v4 import FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST
+            return decode_v4(width=h["width"], height=h["height"], padW=h["padW"], padH=h["padH"], blockN=N,
+                             qstep_bg=h["qstep_bg"], qstep_roi=h["qstep_roi"], block_roi_01=self.roi_blk,
+                             sb_q=self.sb_q, sb_qscale=h["sb_qscale"], stages_data=self.stages,
+                             stages_to_decode=stages, int_dct=bool(h["flags"] & FLAG_INT_DCT),
+                             skip=bool(h["flags"] & FLAG_SKIP), cat=bool(h["flags"] & FLAG_CAT),
+                             roi_first=bool(h["flags"] & FLAG_ROI_FIRST), roi_only=roi_only, lut=lut, out=out)
+        if roi_only:
+            raise ValueError(f"roi_only needs a v4 FLAG_ROI_FIRST stream, got v{self.version}")
+        roi = self.roi_blk.reshape(-1)
+        nb, K = roi.size, N * N
+        if self.version == 1:
+            coeffs = DenseCoeffs(self.payload)
+        else:
+            coeffs = SparseCoeffs(nb, K)
+            for st in self.stages[:max(1, min(stages, len(self.stages)))]:
+                coeffs.add_scan(*decode_stage_sparse(st, nb, K))
+        qstep_bg = h["qstep"] if self.version < 3 else h["qstep_bg"]
+        qstep_roi = h["qstep"] if self.version < 3 else h["qstep_roi"]
+        return reconstruct_image(coeffs, roi, self.sb_q.reshape(-1), height=h["height"], width=h["width"],
+                                 blockN=N, Wb=Wb, qstep_bg=qstep_bg, qstep_roi=qstep_roi,
+                                 sb_qscale=self.sb_qscale, lut=lut, out=out)
+
+def _block_grid(h):
+    N = h["blockN"]
+    return (h["height"] + h["padH"]) // N, (h["width"] + h["padW"]) // N
+
+def _open_v1(path, f):
+    from bitstream import read_header, HEADER_SIZE
+    h = read_header(f)
+    Hb, Wb = _block_grid(h)
+    K = h["blockN"] ** 2
+    if os.path.getsize(path) < HEADER_SIZE + Hb * Wb * K * 2:
+        raise ValueError("Malformed stream: payload too short")
+    payload = np.memmap(path, dtype="<i2", mode="r", offset=HEADER_SIZE, shape=(Hb * Wb, K))
+    return MMIPFile(path, 1, h, roi_blk=np.zeros((Hb, Wb), dtype=np.uint8),
+                    sb_q=np.ones((Hb, Wb), dtype=np.uint8), sb_qscale=1, payload=payload)
+
+def _open_v2(path, f):
+    from bitstream_v2 import read_header, read_table
+    h = read_header(f)
+    table_entries = read_table(f, h["table_len"])
+    payload = f.read(h["payload_len"])
+    if len(payload) != h["payload_len"]:
+        raise ValueError("Malformed stream: payload truncated")
+    Hb, Wb = _block_grid(h)
+    st = dict(k0=0, k1=h["blockN"] ** 2, table_entries=table_entries, payload_bytes=payload)
+    return MMIPFile(path, 2, h, roi_blk=np.zeros((Hb, Wb), dtype=np.uint8),
+                    sb_q=np.ones((Hb, Wb), dtype=np.uint8), sb_qscale=1, stages=[st])
+
+def _open_v3(path, f):
+    from bitstream_v3 import read_header, read_stage_header, read_table
+    from roi import unpack_bits_u8
+    h = read_header(f)
+    roi_bytes = f.read(h["roi_map_bytes"])
+    if len(roi_bytes) != h["roi_map_bytes"]:
+        raise ValueError("Malformed stream: ROI map truncated")
+    Hb, Wb = _block_grid(h)
+    roi_blk = unpack_bits_u8(roi_bytes, h["roi_map_bits"]).reshape(Hb, Wb).astype(np.uint8)
+    stages = []
+    for _ in range(h["nstages"]):
+        sh = read_stage_header(f)
+        tbl = read_table(f, sh["table_len"])
+        payload = f.read(sh["payload_len"])
+        if len(payload) != sh["payload_len"]:
+            raise ValueError("Malformed stream: stage payload truncated")
+        stages.append(dict(k0=sh["k0"], k1=sh["k1"], table_entries=tbl, payload_bytes=payload))
+    return MMIPFile(path, 3, h, roi_blk=roi_blk, sb_q=np.ones((Hb, Wb), dtype=np.uint8), sb_qscale=1,
+                    stages=stages)
+
+def _open_v4(path, f):
+    from bitstream_v4 import read_v4
+    h, roi_blk, sb_q, stages = read_v4(f)
+    return MMIPFile(path, 4, h, roi_blk=roi_blk, sb_q=sb_q, sb_qscale=h["sb_qscale"], stages=stages)
+
+_OPENERS = {1: _open_v1, 2: _open_v2, 3: _open_v3, 4: _open_v4}
+
+def open_mmip(path) -> MMIPFile:
+    """Parse a .mmip file of any version (v1 payload memory-mapped, not read)."""
+    with open(path, "rb") as f:
+        ver = sniff_version(f)
+        if ver not in _OPENERS:
+            raise ValueError(f"Unsupported version: {ver}")
+        return _OPENERS[ver](path, f)
+
+def decode_mmip(path, stages: int = 255, **kw) -> np.ndarray:
+    """open_mmip(path).decode(stages, **kw)"""
+    return open_mmip(path).decode(stages, **kw)
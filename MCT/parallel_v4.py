@@ -0,0 +1,148 @@
+import argparse, os, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sharedmem import shared_array, to_shared, attach, detach, release
+
+# Process-pool volume decode / encode. Pixels never travel through pickling:
+# decoders write straight into a shared output volume (shared memory, or a
+# memmapped .npy file), encoders read their slice from a shared input volume;
+# workers only return small status tuples.
+
+def _decode_into(path, out, i, stages):
+    from mmip_io import open_mmip
+    t = time.perf_counter()
+    m = open_mmip(path)
+    m.decode(stages, out=out)
+    return i, m.version, time.perf_counter() - t
+
+def _decode_slice(path, desc, i, stages):
+    h, vol = attach(desc, writable=True)
+    try:
+        return _decode_into(path, vol[i], i, stages)
+    finally:
+        del vol
+        detach(h)
+
+def decode_volume(paths, *, stages: int = 255, workers: int = 1, out_path=None):
+    """
+    Decode one .mmip file (any version, mmip_io.open_mmip) per slice into a
+    uint16 (S, H, W) volume on 'workers' processes. With out_path the volume is
+    an .npy file the workers write through memmaps (returned memmapped);
+    otherwise a shared-memory segment the workers write into, returned as is:
+    the caller drops the array, then sharedmem.release(shm). One worker (or
+    one slice) decodes in-process into a plain array.
+    Returns (volume, [(slice, version, seconds)], shm or None).
+    """
+    from mmip_io import open_mmip
+    paths = list(paths)
+    if not paths:
+        raise ValueError("no input files")
+    n = len(paths)
+    shape = (n,) + open_mmip(paths[0]).shape
+    pool = workers > 1 and n > 1
+    shm = desc = None
+    if out_path:
+        vol = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint16, shape=shape)
+        desc = dict(kind="memmap", path=out_path, offset=vol.offset, shape=shape, dtype=vol.dtype.str)
+    elif pool:
+        shm, vol, desc = shared_array(shape, np.uint16)
+    else:
+        vol = np.empty(shape, dtype=np.uint16)
+    try:
+        if pool:
+            with ProcessPoolExecutor(max_workers=min(workers, n)) as ex:
+                stats = list(ex.map(_decode_slice, paths, [desc] * n, range(n), [stages] * n))
+        else:
+            stats = [_decode_into(p, vol[i], i, stages) for i, p in enumerate(paths)]
+    except BaseException:
+        del vol  # the segment cannot close while a view exists
+        release(shm)
+        raise
+    if out_path:
+        vol.flush()
+    return vol, stats, shm
+
+def _write_ladder(x_u16, i, outdir, name, qualities, kw):
+    from encode_ladder import encode_ladder
+    sizes = []
+    for q, data in encode_ladder(x_u16, qualities, **kw).items():
+        path = os.path.join(outdir, name.format(i=i, q=q))
+        with open(path, "wb") as f:
+            f.write(data)
+        sizes.append((q, path, len(data)))
+    return sizes
+
+def _encode_slice(desc, i, outdir, name, qualities, kw):
+    t = time.perf_counter()
+    h, vol = attach(desc)
+    try:
+        sizes = _write_ladder(vol[i], i, outdir, name, qualities, kw)
+    finally:
+        del vol
+        detach(h)
+    return i, sizes, time.perf_counter() - t
+
+def encode_volume(vol_u16: np.ndarray, outdir, qualities, *, name: str = "s{i:04d}_q{q}_v4.mmip",
+                  workers: int = 1, **kw):
+    """
+    encode_ladder for every slice of a uint16 (S, H, W) volume on 'workers'
+    processes, each writing its slice's files to outdir/name. A file-backed
+    volume (np.load(..., mmap_mode="r")) is shared through its file, anything
+    else through one copy into shared memory. kw: encode_ladder options.
+    Returns [(slice, [(quality, path, bytes)], seconds)].
+    """
+    if vol_u16.dtype != np.uint16 or vol_u16.ndim != 3:
+        raise ValueError(f"expected a uint16 (S,H,W) volume, got {vol_u16.dtype} {vol_u16.shape}")
+    os.makedirs(outdir, exist_ok=True)
+    qualities = list(qualities)
+    n = vol_u16.shape[0]
+    if workers <= 1 or n <= 1:
+        res = []
+        for i in range(n):
+            t = time.perf_counter()
+            res.append((i, _write_ladder(np.asarray(vol_u16[i]), i, outdir, name, qualities, kw),
+                        time.perf_counter() - t))
+        return res
+    shm, desc = to_shared(vol_u16)
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as ex:
+            return list(ex.map(_encode_slice, [desc] * n, range(n), [outdir] * n, [name] * n,
+                               [qualities] * n, [kw] * n))
+    finally:
+        release(shm)
+
+def main():
+    ap = argparse.ArgumentParser(description="process-parallel volume decode / encode")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("decode", help=".mmip slices (any version) -> one uint16 (S,H,W) .npy")
+    p.add_argument("--input", required=True, nargs="+", help=".mmip files in slice order")
+    p.add_argument("--output", required=True, help="output .npy volume (written in place by the workers)")
+    p.add_argument("--stages", type=int, default=255, help="decode first N stages (default: all)")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p = sub.add_parser("encode", help="uint16 (S,H,W) .npy volume -> per-slice v4 .mmip files")
+    p.add_argument("--input", required=True, help="uint16 (S,H,W) .npy volume (memory-mapped)")
+    p.add_argument("--outdir", required=True)
+    p.add_argument("--qualities", type=int, nargs="+", default=[10])
+    p.add_argument("--name", default="s{i:04d}_q{q}_v4.mmip", help="output file name pattern")
+    p.add_argument("--block", type=int, default=8)
+    p.add_argument("--bone_threshold", type=int, default=9000)
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = ap.parse_args()
+
+    t = time.perf_counter()
+    if args.cmd == "decode":
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        vol, stats, _ = decode_volume(args.input, stages=args.stages, workers=args.workers, out_path=args.output)
+        vers = sorted({v for (_, v, _) in stats})
+        print(f"[parallel_v4] decoded {len(stats)} slices (v{','.join(map(str, vers))}) -> {args.output} "
+              f"shape={vol.shape} in {time.perf_counter() - t:.2f}s")
+    else:
+        vol = np.load(args.input, mmap_mode="r")
+        res = encode_volume(vol, args.outdir, args.qualities, name=args.name, workers=args.workers,
+                            blockN=args.block, bone_threshold=args.bone_threshold)
+        total = sum(b for (_, sizes, _) in res for (_, _, b) in sizes)
+        print(f"[parallel_v4] encoded {len(res)} slices x {len(args.qualities)} qualities -> {args.outdir} "
+              f"{total}B in {time.perf_counter() - t:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import numpy as np
 
 def sigmoid(x):
@@ -36,16 +37,20 @@ def noise_scale(mu_block: np.ndarray, sd_block: np.ndarray, lam=0.8, c=300.0):
     s_noise = 1.0 + lam * rel
     return s_noise.astype(np.float32)
 
+@lru_cache(maxsize=None)
 def stage_freq_matrix(blockN: int, stage_id: int) -> np.ndarray:
     """
     Stage-specific MTF/PSF-inspired frequency weighting m_s(u,v).
     stage_id: 0=DC, 1=low-freq, 2=high/remaining
+    (ids > 2, from finer band partitions, share the high-frequency weighting;
+    the rho term already grows with frequency inside each band)
     """
     params = {
         0: dict(beta=0.10, p=1.0, gamma=0.60),  # protect DC strongly
         1: dict(beta=0.35, p=1.3, gamma=1.00),  # moderate
         2: dict(beta=0.35, p=1.3, gamma=1.05),  # high freq coarser
     }
+    stage_id = min(int(stage_id), 2)
     beta = params[stage_id]["beta"]
     p    = params[stage_id]["p"]
     gamma= params[stage_id]["gamma"]
@@ -56,7 +61,9 @@ def stage_freq_matrix(blockN: int, stage_id: int) -> np.ndarray:
     denom = np.sqrt(2.0 * (blockN - 1) ** 2)
     rho = np.sqrt(uu*uu + vv*vv) / (denom if denom > 0 else 1.0)  # [0,1]
     m = (1.0 + beta * (rho ** p)) * gamma
-    return m.astype(np.float32)
+    m = m.astype(np.float32)
+    m.setflags(write=False)  # cached, shared
+    return m
 
 def quantize_block_scale(s_block: np.ndarray, qscale: int = 16):
     """
@@ -2,6 +2,8 @@ import numpy as np
 
 # Reserved End-of-Block marker (safe because value==0 never appears except EOB)
 EOB = (0, 0)
+# Zero-run escape: 255 zeros and no value (runs longer than 255, i.e. 16x16+ blocks)
+ZRL = (255, 0)
 
 def rle_encode(vec: np.ndarray):
     """
@@ -10,22 +12,42 @@ def rle_encode(vec: np.ndarray):
     run: number of leading zeros before 'value'
     value: non-zero int
     """
+    return rle_encode_band(vec, 0)
+
+def rle_encode_band(band: np.ndarray, k0: int):
+    """
+    Same as rle_encode on a zero vector holding 'band' at positions [k0, k0+len).
+    """
     out = []
-    run = 0
-    for v in vec:
-        v = int(v)
-        if v == 0:
-            run += 1
-        else:
-            # If run is huge, split (rare with 8x8 but safe)
-            while run > 255:
-                out.append((255, 1))  # harmless non-zero value, will be coded; not ideal but extremely rare
-                run -= 255
-            out.append((run, v))
-            run = 0
+    last = -1 - k0
+    # walk non-zero positions only; zeros are implied by the run lengths
+    for k in np.flatnonzero(band).tolist():
+        run = k - last - 1
+        # If run is huge, split (never with 8x8; large blocks / late bands)
+        while run > 255:
+            out.append(ZRL)
+            run -= 255
+        out.append((run, int(band[k])))
+        last = k
     out.append(EOB)
     return out
 
+def cat_split(sym):
+    """
+    JPEG-style magnitude category model: (run, value) -> ((run, cat), raw, cat)
+    with cat = bit length of |value| and 'cat' raw bits sent after the code
+    (value if positive, else value + 2^cat - 1). EOB / ZRL pass unchanged.
+    """
+    run, val = sym
+    if val == 0:
+        return sym, 0, 0
+    c = abs(val).bit_length()
+    return (run, c), (val if val > 0 else val + (1 << c) - 1), c
+
+def cat_value(c: int, raw: int) -> int:
+    """Inverse of cat_split: top raw bit set -> positive, clear -> negative."""
+    return raw if raw >> (c - 1) else raw - (1 << c) + 1
+
 def rle_decode(pairs, N: int):
     """
     Input: list of (run, value) pairs until EOB
@@ -35,6 +57,9 @@ def rle_decode(pairs, N: int):
     for run, val in pairs:
         if (run, val) == EOB:
             break
+        if (run, val) == ZRL:
+            out.extend([0] * 255)
+            continue
         out.extend([0] * int(run))
         out.append(int(val))
         if len(out) > N:
@@ -29,30 +29,13 @@ def pack_bits_u8(bits01: np.ndarray) -> bytes:
     Pack a flat uint8 array of 0/1 into bytes (MSB-first).
     """
     b = bits01.astype(np.uint8).ravel()
-    out = bytearray()
-    cur = 0
-    cnt = 0
-    for v in b:
-        cur = (cur << 1) | int(v)
-        cnt += 1
-        if cnt == 8:
-            out.append(cur)
-            cur = 0
-            cnt = 0
-    if cnt > 0:
-        out.append(cur << (8 - cnt))
-    return bytes(out)
+    return np.packbits(b != 0, bitorder="big").tobytes()
 
 def unpack_bits_u8(data: bytes, nbits: int) -> np.ndarray:
     """
     Unpack bytes -> uint8 0/1 array length nbits (MSB-first).
     """
     out = np.zeros(nbits, dtype=np.uint8)
-    k = 0
-    for byte in data:
-        for i in range(7, -1, -1):
-            if k >= nbits:
-                return out
-            out[k] = (byte >> i) & 1
-            k += 1
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder="big")[:nbits]
+    out[:bits.size] = bits
     return out
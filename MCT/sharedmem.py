@@ -0,0 +1,63 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+# Large arrays cross process boundaries as small descriptors instead of
+# pickled copies: a shared-memory segment, or a file the array is mapped
+# from (np.memmap, np.load(..., mmap_mode=...), np.lib.format.open_memmap).
+#   dict(kind="shm", name, shape, dtype)
+#   dict(kind="memmap", path, offset, shape, dtype)
+
+def shared_array(shape, dtype):
+    """New shared-memory array: (SharedMemory, ndarray view, descriptor). Owner closes + unlinks."""
+    dtype = np.dtype(dtype)
+    nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    a = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, a, dict(kind="shm", name=shm.name, shape=tuple(shape), dtype=dtype.str)
+
+def describe(a: np.ndarray):
+    """Descriptor of a file-backed C-contiguous memmap, None for anything else."""
+    if isinstance(a, np.memmap) and a.filename and a.flags.c_contiguous:
+        base = a
+        while isinstance(base.base, np.memmap):  # views of a memmap keep the file offset of the root
+            base = base.base
+        off = base.offset + (a.__array_interface__["data"][0] - base.__array_interface__["data"][0])
+        return dict(kind="memmap", path=a.filename, offset=off, shape=a.shape, dtype=a.dtype.str)
+    return None
+
+def to_shared(a: np.ndarray):
+    """Descriptor for 'a' (no copy if file-backed, else one copy into shared memory) + segment or None."""
+    desc = describe(a)
+    if desc is not None:
+        return None, desc
+    shm, view, desc = shared_array(a.shape, a.dtype)
+    view[...] = a
+    return shm, desc
+
+def attach(desc, writable: bool = False):
+    """(handle, ndarray) for a descriptor; drop the array, then detach(handle)."""
+    if desc["kind"] == "memmap":
+        a = np.memmap(desc["path"], dtype=desc["dtype"], mode="r+" if writable else "r",
+                      offset=desc["offset"], shape=tuple(desc["shape"]))
+        return a, a
+    try:
+        shm = shared_memory.SharedMemory(name=desc["name"], track=False)  # Python >= 3.13
+    except TypeError:
+        # pool workers share the creator's resource tracker: registering again is a no-op
+        shm = shared_memory.SharedMemory(name=desc["name"])
+    a = np.ndarray(tuple(desc["shape"]), dtype=desc["dtype"], buffer=shm.buf)
+    if not writable:
+        a.flags.writeable = False
+    return shm, a
+
+def detach(handle):
+    if isinstance(handle, np.memmap):
+        handle.flush()
+    elif handle is not None:
+        handle.close()
+
+def release(shm):
+    """Owner side: free a segment from shared_array / to_shared (None is a no-op)."""
+    if shm is not None:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,4 @@
+import os, sys
+
+# The codec modules are flat scripts in MCT/; make them importable from tests/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,110 @@
+import sys
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, CTImageStorage
+
+from dicom_io import list_series, load_series, rescale_to_u16, HU_OFFSET
+from encode_ladder import encode_ladder
+from mmip_io import open_mmip
+
+def _write_slice(path, px, *, z=None, instance=None, slope=1, intercept=-1024, series_uid="1.2.3"):
+    """Minimal single-frame CT file (signed 16-bit stored values)."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = "CT"
+    if z is not None:
+        ds.ImagePositionPatient = [0.0, 0.0, float(z)]
+    if instance is not None:
+        ds.InstanceNumber = instance
+    ds.Rows, ds.Columns = px.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleSlope = slope
+    ds.RescaleIntercept = intercept
+    ds.PixelData = px.astype("<i2").tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+def _phantom(i, shape=(32, 48)):
+    # stored values: air (0 -> -1024 HU), tissue and a bone square, shifted per slice
+    px = np.full(shape, 1024 + 40, dtype=np.int16)
+    px[:4] = 0
+    px[8 + i:16 + i, 10:20] = 1024 + 1200
+    return px
+
+@pytest.fixture
+def series(tmp_path):
+    # file names do not follow slice order; InstanceNumber disagrees with z too
+    zs = [20.0, -10.0, 5.0, 0.0]
+    instances = [3, 9, 1, 4]
+    for name, z, inst in zip(["a.dcm", "b.dcm", "c.dcm", "d.dcm"], zs, instances):
+        _write_slice(str(tmp_path / name), _phantom(sorted(zs).index(z)), z=z, instance=inst)
+    (tmp_path / "notes.txt").write_text("not a DICOM file")
+    return tmp_path
+
+def test_list_series_sorts_by_position(series):
+    paths = list_series(str(series), workers=3)
+    assert [p.rsplit("/", 1)[-1] for p in paths] == ["b.dcm", "d.dcm", "c.dcm", "a.dcm"]
+
+def test_instance_number_breaks_ties(tmp_path):
+    for name, inst in [("x.dcm", 7), ("y.dcm", 2), ("z.dcm", 5)]:
+        _write_slice(str(tmp_path / name), _phantom(0), instance=inst)
+    paths = list_series(str(tmp_path), workers=2)
+    assert [p.rsplit("/", 1)[-1] for p in paths] == ["y.dcm", "z.dcm", "x.dcm"]
+
+def test_no_dicom_files(tmp_path):
+    (tmp_path / "readme.txt").write_text("nothing here")
+    with pytest.raises(ValueError):
+        list_series(str(tmp_path))
+
+def test_rescale_integer_and_float():
+    px = np.array([[-2000, 0, 1024, 70000 // 2]], dtype=np.int32)
+    # integer slope/intercept: exact integer arithmetic, clipped to uint16
+    got = rescale_to_u16(px, 1, -1024)
+    assert got.dtype == np.uint16
+    assert got.tolist() == [[0, 0, 1024, 35000]]
+    assert rescale_to_u16(px, 2, -1024).tolist() == [[0, 0, 2048, 65535]]
+    # float slope/intercept: rounded to nearest
+    assert rescale_to_u16(px, 0.5, -1024.25).tolist() == [[0, 0, 512, 17500]]
+    assert rescale_to_u16(np.array([3]), 0.5, 0.0, offset=0).tolist() == [2]
+
+def test_load_series_applies_rescale(tmp_path):
+    px = _phantom(0)
+    _write_slice(str(tmp_path / "int.dcm"), px, z=0.0)
+    _write_slice(str(tmp_path / "float.dcm"), px, z=1.0, slope=0.5, intercept=-512.5)
+    vol = load_series(str(tmp_path), workers=2)
+    assert vol.dtype == np.uint16 and vol.shape == (2,) + px.shape
+    assert np.array_equal(vol[0], rescale_to_u16(px, 1, -1024))
+    assert np.array_equal(vol[1], rescale_to_u16(px, 0.5, -512.5))
+    assert vol[0][0, 0] == 0 + (-1024) + HU_OFFSET
+
+def test_encode_dicom_round_trip(series, tmp_path, monkeypatch):
+    import encode_dicom
+    outdir = tmp_path / "out"
+    monkeypatch.setattr(sys, "argv", ["encode_dicom.py", "--input", str(series), "--outdir", str(outdir),
+                                      "--qualities", "10", "30", "--workers", "2"])
+    encode_dicom.main()
+    vol = load_series(str(series), workers=2)
+    assert vol.shape == (4, 32, 48)
+    for i in range(vol.shape[0]):
+        assert np.array_equal(vol[i], rescale_to_u16(_phantom(i), 1, -1024))
+    for i in range(vol.shape[0]):
+        ref = encode_ladder(vol[i], [10, 30], bone_threshold=HU_OFFSET + 300)
+        for q in (10, 30):
+            path = outdir / f"s{i:04d}_q{q}_v4.mmip"
+            assert path.read_bytes() == ref[q]
+            m = open_mmip(str(path))
+            assert m.version == 4 and m.shape == vol[i].shape
+            assert m.decode().shape == vol[i].shape
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from codec_v4 import encode_v4, encode_v4_stack, decode_v4
+
+def _slice(H, W, seed=3):
+    # smooth, mid-range data: no decoder clipping, so the prediction is exact
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:H, :W]
+    x = 20000 + 3000 * np.sin(xx / 5.0) + 2000 * np.cos(yy / 7.0) + rng.normal(0, 200, (H, W))
+    return x.astype(np.uint16)
+
+@pytest.mark.parametrize("shape", [(64, 64), (60, 70), (57, 83)])
+def test_distortion_matches_decoded_image(shape):
+    H, W = shape
+    N = 8
+    x = _slice(H, W)
+    roi = np.zeros((-(-H // N), -(-W // N)), dtype=np.uint8)
+    roi[1:4, 2:6] = 1
+    roi[-1, -1] = 1  # a padded corner block in the ROI
+    kw = dict(blockN=N, qstep_bg=40, qstep_roi=10, block_roi_01=roi)
+    sb_q, stages, meta = encode_v4(x, distortion=True, **kw)
+    rm = np.kron(roi, np.ones((N, N), dtype=np.uint8))[:H, :W] == 1
+    for s, st in enumerate(stages):
+        y = decode_v4(width=W, height=H, padW=meta["padW"], padH=meta["padH"], blockN=N, qstep_bg=40, qstep_roi=10,
+                      block_roi_01=roi, sb_q=sb_q, sb_qscale=16, stages_data=stages, stages_to_decode=s + 1)
+        assert 0 < y.min() and y.max() < 65535
+        d = (y.astype(np.float64) - x) ** 2
+        # decoded pixels are rounded to integers: allow for that, nothing more
+        assert st["mse"] == pytest.approx(d.mean(), rel=1e-3)
+        assert st["roi_mse"] == pytest.approx(d[rm].mean(), rel=1e-3)
+
+def test_stack_distortion_matches_single_slices():
+    vol = np.stack([_slice(60, 70, seed) for seed in range(3)])
+    roi = np.zeros((8, 9), dtype=np.uint8)
+    roi[2:5, 3:6] = 1
+    kw = dict(blockN=8, qstep_bg=40, qstep_roi=10, block_roi_01=roi, distortion=True)
+    _, stacked, _ = encode_v4_stack(vol, **kw)
+    for i in range(vol.shape[0]):
+        _, single, _ = encode_v4(vol[i], **kw)
+        for a, b in zip(stacked[i], single):
+            assert a["mse"] == pytest.approx(b["mse"], rel=1e-12)
+            assert a["roi_mse"] == pytest.approx(b["roi_mse"], rel=1e-12)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from bitpack import BitWriter
+from huff_canonical import build_code_lengths, canonical_codes_from_lengths, VecSymbolReader, decode_symbols_vec
+
+STOP = (0, 0)
+
+def _stream(ngroups, seed, extra=None, group_len=(0, 20)):
+    rng = np.random.default_rng(seed)
+    groups = [[(int(r), int(v)) for r, v in zip(rng.integers(0, 4, n), rng.integers(1, 6, n))] + [STOP]
+              for n in rng.integers(*group_len, ngroups)]
+    syms = [s for g in groups for s in g]
+    lengths = build_code_lengths(syms)
+    codes = canonical_codes_from_lengths(lengths)
+    bw = BitWriter()
+    raws = []
+    for s in syms:
+        bw.write_code(*codes[s])
+        nx = extra.get(s, 0) if extra else 0
+        raws.append(int(rng.integers(0, 1 << nx)) if nx else 0)
+        if nx:
+            bw.write_code(raws[-1], nx)
+    return bw.finish(), lengths, syms, raws
+
+@pytest.mark.parametrize("group_len", [(0, 20), (300, 400)])
+def test_matches_symbol_stream(group_len):
+    # groups of 300+ symbols do not fit the smallest chunk: the reader must grow it
+    payload, lengths, syms, _ = _stream(200, 1, group_len=group_len)
+    seq, order, raw = decode_symbols_vec(payload, lengths, STOP, 200, chunk_bits=1024)
+    assert [order[i] for i in seq] == syms and raw is None
+
+def test_raw_bits_and_resume():
+    extra = {(r, v): v for r in range(4) for v in range(1, 6)}
+    payload, lengths, syms, raws = _stream(500, 2, extra)
+    r = VecSymbolReader(payload, lengths, STOP, extra, chunk_bits=1024)
+    got, got_raw = [], []
+    for n in [1, 7, 100, 392]:
+        sidx, raw = r.read(n)
+        assert 1 <= (sidx == r.syms.index(STOP)).sum() <= n and r.syms[sidx[-1]] == STOP
+        got += [r.syms[i] for i in sidx]
+        got_raw += raw.tolist()
+    while r.groups < 500:
+        sidx, raw = r.read(500 - r.groups)
+        got += [r.syms[i] for i in sidx]
+        got_raw += raw.tolist()
+    assert got == syms and got_raw == raws
+    assert r.pos <= 8 * len(payload) < r.pos + 8
+
+def test_truncated_payload():
+    payload, lengths, _, _ = _stream(200, 3)
+    with pytest.raises((EOFError, ValueError)):
+        decode_symbols_vec(payload[:len(payload) // 2], lengths, STOP, 200)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from encode_ladder import encode_ladder
+from mmip_io import decode_mmip
+from parallel_v4 import decode_volume
+from sharedmem import release
+
+@pytest.fixture(scope="module")
+def slices(tmp_path_factory):
+    d = tmp_path_factory.mktemp("vol")
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        p = d / f"s{i}.mmip"
+        p.write_bytes(encode_ladder(rng.integers(0, 20000, (40, 56)).astype(np.uint16), [10])[10])
+        paths.append(str(p))
+    return paths
+
+def test_in_process_plain_array(slices):
+    vol, stats, shm = decode_volume(slices, workers=1)
+    assert shm is None and type(vol) is np.ndarray
+    assert [s[:2] for s in stats] == [(i, 4) for i in range(3)]
+    assert np.array_equal(vol, np.stack([decode_mmip(p) for p in slices]))
+
+def test_pool_returns_shared_volume(slices):
+    vol, stats, shm = decode_volume(slices, workers=2)
+    assert shm is not None and vol.base is not None  # a view of the segment, not a copy
+    assert np.array_equal(vol, np.stack([decode_mmip(p) for p in slices]))
+    del vol
+    release(shm)
+
+def test_pool_into_npy(slices, tmp_path):
+    out = str(tmp_path / "vol.npy")
+    vol, _, shm = decode_volume(slices, workers=2, out_path=out)
+    assert shm is None
+    assert np.array_equal(np.load(out), np.stack([decode_mmip(p) for p in slices]))
@@ -0,0 +1,52 @@
+import sys
+import numpy as np
+import pytest
+from codec_v4 import encode_v4
+from encode_ladder import encode_ladder
+from encode_v4 import quality_to_qsteps
+from bitstream_v4 import index_v4, read_v4
+
+def _slice():
+    rng = np.random.default_rng(7)
+    x = np.full((64, 96), 1100, dtype=np.uint16)
+    x[16:48, 24:72] = 10000  # bone: ROI blocks
+    x += rng.integers(0, 300, x.shape, dtype=np.uint16)
+    return x
+
+def _decode_cli(monkeypatch, src, dst, *extra):
+    import decode_v4
+    monkeypatch.setattr(sys, "argv", ["decode_v4.py", "--input", str(src), "--output", str(dst), *extra])
+    decode_v4.main()
+    return np.load(dst)
+
+def test_roi_only_decodes_file_cut_at_roi_part(tmp_path, monkeypatch):
+    x = _slice()
+    data = encode_ladder(x, [10], roi_first=True)[10]
+    full = tmp_path / "full.mmip"
+    full.write_bytes(data)
+
+    # head_bytes of the last stage, as encode_v4 reports it (roi_part=...)
+    with open(full, "rb") as f:
+        _, layout = index_v4(f)
+    with open(full, "rb") as f:
+        _, roi_blk, _, _ = read_v4(f)
+    q_bg, q_roi = quality_to_qsteps(10)
+    _, stages, _ = encode_v4(x, blockN=8, qstep_bg=q_bg, qstep_roi=q_roi, block_roi_01=roi_blk, roi_first=True)
+    last = layout["stages"][-1]
+    cut = last["payload_offset"] + stages[-1]["head_bytes"]
+    assert cut < len(data)
+
+    part = tmp_path / "part.mmip"
+    part.write_bytes(data[:cut])
+    ref = _decode_cli(monkeypatch, full, tmp_path / "ref.npy", "--roi_only")
+    got = _decode_cli(monkeypatch, part, tmp_path / "got.npy", "--roi_only")
+    assert np.array_equal(got, ref)
+
+    # without --roi_only the cut file is still rejected
+    with pytest.raises(ValueError):
+        _decode_cli(monkeypatch, part, tmp_path / "bad.npy")
+    # and so is a file cut inside the ROI part (bit reader runs dry)
+    short = tmp_path / "short.mmip"
+    short.write_bytes(data[:cut - 2])
+    with pytest.raises((ValueError, EOFError)):
+        _decode_cli(monkeypatch, short, tmp_path / "bad.npy", "--roi_only")
@@ -0,0 +1,53 @@
+import io
+import numpy as np
+import pytest
+from bitstream_v4 import write_v4, read_v4, FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST
+from codec_v4 import encode_v4, decode_v4
+from codec_v4_session import Encoder, Decoder
+
+OPTS = [dict(), dict(skip=True, cat=True), dict(roi_first=True, sa_al=2), dict(int_dct=True, skip=True),
+        dict(int_dct=True, cat=True, roi_first=True, sa_al=1)]
+
+def _slices(n, H=61, W=77):
+    rng = np.random.default_rng(5)
+    yy, xx = np.mgrid[:H, :W]
+    base = 12000 + 4000 * np.sin(xx / 6.0) * np.cos(yy / 9.0)
+    return [(base + rng.normal(0, 300 * (i + 1), (H, W))).astype(np.uint16) for i in range(n)]
+
+def _roi(H, W, N=8):
+    roi = np.zeros((-(-H // N), -(-W // N)), dtype=np.uint8)
+    roi[2:5, 3:7] = 1
+    return roi
+
+def _stream(x, sb_q, stages, meta, roi, opts):
+    flags = ((FLAG_INT_DCT if opts.get("int_dct") else 0) | (FLAG_SKIP if opts.get("skip") else 0)
+             | (FLAG_CAT if opts.get("cat") else 0) | (FLAG_ROI_FIRST if opts.get("roi_first") else 0))
+    f = io.BytesIO()
+    write_v4(f, h=dict(flags=flags, bitdepth=16, blockN=8, width=x.shape[1], height=x.shape[0],
+                       padW=meta["padW"], padH=meta["padH"], qstep_bg=40, qstep_roi=12, sb_qscale=16),
+             roi_blk=roi, sb_q=sb_q, stages=stages)
+    f.seek(0)
+    return read_v4(f)
+
+@pytest.mark.parametrize("opts", OPTS)
+def test_session_matches_encode_decode_v4(opts):
+    xs = _slices(3)
+    H, W = xs[0].shape
+    roi = _roi(H, W)
+    enc, dec = Encoder((H, W), 8, **opts), Decoder((H, W), 8)
+    for x in xs:  # same objects, several slices: nothing may leak between calls
+        sb_q, stages, meta = enc.encode(x, qstep_bg=40, qstep_roi=12, block_roi_01=roi, distortion=True)
+        ref = encode_v4(x, blockN=8, qstep_bg=40, qstep_roi=12, block_roi_01=roi, distortion=True, **opts)
+        assert np.array_equal(sb_q, ref[0]) and meta == ref[2]
+        assert stages == ref[1]
+
+        h, roi_blk, sbq, data = _stream(x, sb_q, stages, meta, roi, opts)
+        kw = dict(width=W, height=H, padW=meta["padW"], padH=meta["padH"], blockN=8, qstep_bg=40, qstep_roi=12,
+                  block_roi_01=roi_blk, sb_q=sbq, sb_qscale=16, stages_data=data,
+                  int_dct=bool(opts.get("int_dct")), skip=bool(opts.get("skip")), cat=bool(opts.get("cat")),
+                  roi_first=bool(opts.get("roi_first")))
+        for n in (1, len(data)):
+            assert np.array_equal(dec.decode(h, roi_blk, sbq, data, n), decode_v4(stages_to_decode=n, **kw))
+        if opts.get("roi_first"):
+            assert np.array_equal(dec.decode(h, roi_blk, sbq, data, roi_only=True),
+                                  decode_v4(stages_to_decode=255, roi_only=True, **kw))
@@ -0,0 +1,51 @@
+import io
+import numpy as np
+import pytest
+from bitstream_v4 import write_v4, read_v4, FLAG_INT_DCT, FLAG_SKIP, FLAG_CAT, FLAG_ROI_FIRST
+from codec_v4 import encode_v4, decode_v4, encode_v4_stack, decode_v4_stack
+
+OPTS = [dict(), dict(skip=True, cat=True), dict(roi_first=True, sa_al=2), dict(int_dct=True, skip=True),
+        dict(int_dct=True, cat=True, roi_first=True, sa_al=1)]
+
+def _volume(S=5, H=61, W=77):
+    rng = np.random.default_rng(9)
+    yy, xx = np.mgrid[:H, :W]
+    base = 15000 + 5000 * np.cos(xx / 8.0 + yy / 11.0)
+    return np.stack([base + rng.normal(0, 250 * (s + 1), (H, W)) for s in range(S)]).astype(np.uint16)
+
+def _read_back(x, sb_q, stages, meta, roi, opts):
+    flags = ((FLAG_INT_DCT if opts.get("int_dct") else 0) | (FLAG_SKIP if opts.get("skip") else 0)
+             | (FLAG_CAT if opts.get("cat") else 0) | (FLAG_ROI_FIRST if opts.get("roi_first") else 0))
+    f = io.BytesIO()
+    write_v4(f, h=dict(flags=flags, bitdepth=16, blockN=8, width=x.shape[1], height=x.shape[0],
+                       padW=meta["padW"], padH=meta["padH"], qstep_bg=40, qstep_roi=12, sb_qscale=16),
+             roi_blk=roi, sb_q=sb_q, stages=stages)
+    f.seek(0)
+    return read_v4(f)
+
+@pytest.mark.parametrize("opts", OPTS)
+def test_stack_matches_per_slice(opts):
+    vol = _volume()
+    S, H, W = vol.shape
+    roi = np.zeros((S, 8, 10), dtype=np.uint8)
+    for s in range(S):
+        roi[s, 1 + s % 3:4 + s % 3, 2:6 + s % 2] = 1  # per-slice ROI maps
+    # batch=2 leaves a partial last batch
+    sb_q, stages, meta = encode_v4_stack(vol, blockN=8, qstep_bg=40, qstep_roi=12, block_roi_01=roi, batch=2, **opts)
+    streams = []
+    for s in range(S):
+        ref = encode_v4(vol[s], blockN=8, qstep_bg=40, qstep_roi=12, block_roi_01=roi[s], **opts)
+        assert np.array_equal(sb_q[s], ref[0]) and meta == ref[2]
+        assert stages[s] == ref[1]
+        streams.append(_read_back(vol[s], sb_q[s], stages[s], meta, roi[s], opts))
+
+    n_all = len(streams[0][3])
+    cases = [(1, False), (n_all, False)] + ([(n_all, True)] if opts.get("roi_first") else [])
+    for n, roi_only in cases:
+        got = decode_v4_stack(streams, stages_to_decode=n, roi_only=roi_only, rows=3)
+        for s, (h, roi_blk, sbq, data) in enumerate(streams):
+            ref = decode_v4(width=W, height=H, padW=h["padW"], padH=h["padH"], blockN=8, qstep_bg=40, qstep_roi=12,
+                            block_roi_01=roi_blk, sb_q=sbq, sb_qscale=16, stages_data=data, stages_to_decode=n,
+                            int_dct=bool(opts.get("int_dct")), skip=bool(opts.get("skip")),
+                            cat=bool(opts.get("cat")), roi_first=bool(opts.get("roi_first")), roi_only=roi_only)
+            assert np.array_equal(got[s], ref)
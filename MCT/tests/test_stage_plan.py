@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from codec_v4 import stage_plan, encode_v4
+
+@pytest.mark.parametrize("sa_al", [-1, 16])
+def test_sa_al_out_of_range(sa_al):
+    with pytest.raises(ValueError, match="sa_al"):
+        stage_plan(8, sa_al)
+    x = np.full((16, 16), 1000, dtype=np.uint16)
+    with pytest.raises(ValueError, match="sa_al"):
+        encode_v4(x, blockN=8, qstep_bg=10, qstep_roi=10, block_roi_01=np.zeros((2, 2), np.uint8), sa_al=sa_al)
+
+def test_sa_al_limits_accepted():
+    assert stage_plan(8, 0)[-1] == (10, 64, 0, 0)
+    plan = stage_plan(8, 15)
+    assert plan[2] == (10, 64, 0, 15) and plan[-1] == (10, 64, 1, 0) and len(plan) == 18
+
+def test_stage_count_limit():
+    assert len(stage_plan(16, 0, bounds=range(1, 255))) == 255
+    for kw in (dict(bounds=range(1, 256)), dict(bounds=range(1, 255), sa_al=3)):
+        with pytest.raises(ValueError, match="255"):
+            stage_plan(16, **kw)
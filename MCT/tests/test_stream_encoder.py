@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+from bitstream_v4 import read_v4
+from codec_v4_stream import StreamEncoderV4, stage_counts_from_stream
+from encode_ladder import encode_ladder
+from encode_v4 import quality_to_qsteps
+from mmip_io import decode_mmip
+
+@pytest.fixture(scope="module")
+def phantom():
+    x = np.load(os.path.join(os.path.dirname(__file__), "..", "data", "phantom_512.npy")).astype(np.uint16)
+    return np.ascontiguousarray(x[150:299, 90:283])  # 149x193: partial block rows and columns
+
+def _stream(x, path, rows_per_read=5, **kw):
+    q_bg, q_roi = quality_to_qsteps(30)
+    with open(path, "wb") as f:
+        enc = StreamEncoderV4(f, width=x.shape[1], height=x.shape[0], qstep_bg=q_bg, qstep_roi=q_roi, **kw)
+        for r in range(0, x.shape[0], rows_per_read):
+            enc.write_rows(x[r:r + rows_per_read])
+        enc.close()
+
+@pytest.mark.parametrize("opts", [dict(), dict(skip=True), dict(sa_al=2), dict(int_dct=True, skip=True),
+                                  dict(blockN=16, sa_al=1), dict(blockN=16, int_dct=True)])
+def test_stream_decodes_like_encode_v4(phantom, tmp_path, opts):
+    # fixed tables change the bytes, never the coefficients or the maps
+    kw = dict(opts)
+    blockN = kw.pop("blockN", 8)
+    path = str(tmp_path / "s.mmip")
+    _stream(phantom, path, blockN=blockN, **kw)
+    ref = tmp_path / "ref.mmip"
+    ref.write_bytes(encode_ladder(phantom, [30], blockN=blockN, cat=True, **kw)[30])
+    with open(path, "rb") as f, open(ref, "rb") as g:
+        h, roi, sb, _ = read_v4(f)
+        h2, roi2, sb2, _ = read_v4(g)
+    assert h["flags"] == h2["flags"]
+    assert np.array_equal(roi, roi2) and np.array_equal(sb, sb2)
+    assert np.array_equal(decode_mmip(path), decode_mmip(str(ref)))
+
+def test_stats_from_previous_stream(phantom, tmp_path):
+    # tables from a two-pass FLAG_CAT stream of a similar slice beat the generic prior
+    prev = tmp_path / "prev.mmip"
+    prev.write_bytes(encode_ladder(phantom[::-1].copy(), [30], cat=True, skip=True)[30])
+    plain, tuned = str(tmp_path / "a.mmip"), str(tmp_path / "b.mmip")
+    _stream(phantom, plain, blockN=8, skip=True)
+    _stream(phantom, tuned, rows_per_read=1, blockN=8, skip=True, stats=stage_counts_from_stream(str(prev)))
+    assert os.path.getsize(tuned) < os.path.getsize(plain)
+    assert np.array_equal(decode_mmip(tuned), decode_mmip(plain))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from codec_v4_strip import encode_v4_strips, decode_v4_strips
+from mmip_io import decode_mmip
+
+def _slice(H, W, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 30000, (H, W)).astype(np.uint16)
+
+def test_default_decodes_every_stage(tmp_path):
+    # SA refinement stages lie past stage 3: the library default must reach them
+    x = _slice(61, 77)
+    path = str(tmp_path / "sa.mmip")
+    info = encode_v4_strips(x, path, blockN=8, qstep_bg=20, qstep_roi=10, sa_al=2)
+    assert len(info["stages"]) == 5
+    out = np.empty_like(x)
+    decode_v4_strips(path, out)
+    assert np.array_equal(out, decode_mmip(path))
+    assert not np.array_equal(out, decode_mmip(path, stages=3))
+
+@pytest.mark.parametrize("skip,cat,int_dct", [(False, False, False), (True, False, False), (False, True, True), (True, True, False)])
+@pytest.mark.parametrize("strip_rows", [1, 3])
+def test_matches_whole_image_decode(tmp_path, skip, cat, int_dct, strip_rows):
+    x = _slice(61, 77, seed=1)
+    path = str(tmp_path / "s.mmip")
+    encode_v4_strips(x, path, blockN=8, qstep_bg=20, qstep_roi=10, sa_al=1, skip=skip, cat=cat, int_dct=int_dct)
+    out = np.empty_like(x)
+    decode_v4_strips(path, out, strip_rows=strip_rows)
+    assert np.array_equal(out, decode_mmip(path))
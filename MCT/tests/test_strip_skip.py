@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from codec_v4_strip import encode_v4_strips
+from encode_ladder import encode_ladder
+from encode_v4 import quality_to_qsteps
+from huff_canonical import build_code_lengths_from_freqs
+from mmip_io import decode_mmip
+
+@pytest.mark.parametrize("cat", [False, True])
+def test_flat_slice_skip(tmp_path, cat):
+    # every AC stage of a flat slice has no coded blocks
+    x = np.full((64, 64), 5000, dtype=np.uint16)
+    q_bg, q_roi = quality_to_qsteps(10)
+    path = tmp_path / "flat.mmip"
+    encode_v4_strips(x, str(path), blockN=8, qstep_bg=q_bg, qstep_roi=q_roi, skip=True, cat=cat)
+    assert path.read_bytes() == encode_ladder(x, [10], skip=True, cat=cat)[10]
+    assert decode_mmip(str(path)).shape == x.shape
+
+def test_empty_freqs_rejected():
+    with pytest.raises(ValueError):
+        build_code_lengths_from_freqs({})
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+import bitstream_v2
+from codec_v2 import encode_v2
+from codec_v3 import encode_v3
+from encode_v2 import quality_to_qstep
+from mmip_io import decode_mmip
+from transcode_v2_v3 import transcode_v2_to_v3, transcode_file
+
+def _encode_v2(x, qstep):
+    table_entries, payload_bytes, meta = encode_v2(x, blockN=8, qstep=qstep)
+    h2 = dict(flags=0, bitdepth=16, blockN=8, width=x.shape[1], height=x.shape[0],
+              padW=meta["padW"], padH=meta["padH"], qstep=qstep)
+    return h2, table_entries, payload_bytes
+
+@pytest.fixture(scope="module")
+def phantom():
+    return np.load(os.path.join(os.path.dirname(__file__), "..", "data", "phantom_512.npy")).astype(np.uint16)
+
+@pytest.mark.parametrize("shape", [(512, 512), (61, 77)])
+@pytest.mark.parametrize("quality", [3, 20, 110])
+def test_stages_match_encode_v3(phantom, shape, quality):
+    x = np.ascontiguousarray(phantom[100:100 + shape[0], 120:120 + shape[1]] if shape != phantom.shape else phantom)
+    qstep = quality_to_qstep(quality)
+    h3, _, stages = transcode_v2_to_v3(*_encode_v2(x, qstep))
+    Hb, Wb = -(-x.shape[0] // 8), -(-x.shape[1] // 8)
+    ref, meta = encode_v3(x, blockN=8, qstep_bg=qstep, qstep_roi=qstep, block_roi_01=np.zeros((Hb, Wb), np.uint8))
+    assert (h3["padW"], h3["padH"]) == (meta["padW"], meta["padH"])
+    assert len(stages) == len(ref)
+    for a, b in zip(stages, ref):
+        assert (a["k0"], a["k1"]) == (b["k0"], b["k1"])
+        assert a["table_entries"] == b["table_entries"]
+        assert a["payload_bytes"] == b["payload_bytes"]
+
+def test_file_decodes_like_v2(phantom, tmp_path):
+    x = np.ascontiguousarray(phantom[200:261, 50:127])
+    h2, table_entries, payload_bytes = _encode_v2(x, quality_to_qstep(20))
+    src, dst = tmp_path / "a_v2.mmip", tmp_path / "a_v3.mmip"
+    with open(src, "wb") as f:
+        bitstream_v2.write_header(f, table_len=len(table_entries), payload_len=len(payload_bytes),
+                                  **{k: h2[k] for k in ("flags", "bitdepth", "blockN", "width", "height", "padW", "padH", "qstep")})
+        bitstream_v2.write_table(f, table_entries)
+        f.write(payload_bytes)
+    transcode_file(str(src), str(dst))
+    assert np.array_equal(decode_mmip(str(dst)), decode_mmip(str(src)))
@@ -0,0 +1,122 @@
+import argparse, os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import bitstream_v2, bitstream_v3
+from bitpack import pack_codes
+from huff_canonical import build_code_lengths_from_freqs, canonical_codes_from_lengths
+from roi import pack_bits_u8
+from codec_v4 import decode_stage_sparse, stage_ranges
+
+def _sym_keys(runs, vals):
+    return runs.astype(np.int64) * 65536 + (vals.astype(np.int64) + 32768)
+
+def code_band(blk, pos, val, nb: int, k0: int, k1: int):
+    """
+    Entropy-code one v3 stage straight from (block, zigzag pos, value) triplets
+    sorted by block then position: same symbols, code table and payload bytes
+    as encode_v3 produces for these quantized coefficients.
+    """
+    m = (pos >= k0) & (pos < k1)
+    b, p, v = blk[m].astype(np.int64), pos[m].astype(np.int64), val[m]
+    prev = np.full(b.size, -1, dtype=np.int64)
+    same = np.zeros(b.size, dtype=bool)
+    same[1:] = b[1:] == b[:-1]
+    prev[1:][same[1:]] = p[:-1][same[1:]]
+    runs = p - prev - 1  # absolute positions, as rle_encode on the band-masked vector
+
+    # symbol sequence in stream order: each block's pairs, then its EOB
+    sb = np.concatenate([b, np.arange(nb, dtype=np.int64)])
+    sp = np.concatenate([p, np.full(nb, k1, dtype=np.int64)])
+    keys = np.concatenate([_sym_keys(runs, v), _sym_keys(np.zeros(nb), np.zeros(nb))])
+    keys = keys[np.lexsort((sp, sb))]
+
+    # counts in first-occurrence order, so Huffman ties break as in encode_v3
+    uniq, first, inv, cnt = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    freqs = Counter()
+    for u in order:
+        freqs[(int(uniq[u] >> 16), int(uniq[u] & 0xFFFF) - 32768)] = int(cnt[u])
+    lengths = build_code_lengths_from_freqs(freqs)
+    codes = canonical_codes_from_lengths(lengths)
+
+    ucode = np.empty(uniq.size, dtype=np.int64)
+    ulen = np.empty(uniq.size, dtype=np.int64)
+    for u in range(uniq.size):
+        ucode[u], ulen[u] = codes[(int(uniq[u] >> 16), int(uniq[u] & 0xFFFF) - 32768)]
+    payload_bytes = pack_codes(ucode[inv], ulen[inv])
+    table_entries = [(run, val, lengths[(run, val)]) for (run, val) in lengths.keys()]
+    return dict(k0=k0, k1=k1, table_entries=table_entries, payload_bytes=payload_bytes)
+
+def transcode_v2_to_v3(h2, table_entries, payload_bytes, bounds=None):
+    """
+    v2 stream (header dict, table, payload) -> (v3 header fields, roi_bytes, stages).
+    Works on quantized coefficients only: the v2 payload is Huffman-decoded
+    into sparse triplets and each spectral band is re-coded, so the v3 stream
+    carries exactly the same coefficients (no IDCT/DCT, no requantization).
+    v2 has one qstep and no ROI, so qstep_bg = qstep_roi and the ROI map is empty.
+    """
+    N = h2["blockN"]
+    K = N * N
+    nb = ((h2["height"] + h2["padH"]) // N) * ((h2["width"] + h2["padW"]) // N)
+    ranges = stage_ranges(N, bounds)
+    if ranges[-1][1] > 0xFF:
+        raise ValueError(f"v3 stage headers hold k1 <= 255, blockN={N} needs {K}")
+
+    st = dict(k0=0, k1=K, table_entries=table_entries, payload_bytes=payload_bytes)
+    blk, pos, val = decode_stage_sparse(st, nb, K)
+    stages = [code_band(blk, pos, val, nb, k0, k1) for (k0, k1) in ranges]
+
+    roi_bytes = pack_bits_u8(np.zeros(nb, dtype=np.uint8))
+    h3 = dict(flags=0, bitdepth=h2["bitdepth"], blockN=N,
+              width=h2["width"], height=h2["height"], padW=h2["padW"], padH=h2["padH"],
+              qstep_bg=h2["qstep"], qstep_roi=h2["qstep"],
+              roi_map_bits=nb, roi_map_bytes=len(roi_bytes), nstages=len(stages))
+    return h3, roi_bytes, stages
+
+def transcode_file(src, dst, bounds=None):
+    with open(src, "rb") as f:
+        h2 = bitstream_v2.read_header(f)
+        table_entries = bitstream_v2.read_table(f, h2["table_len"])
+        payload = f.read(h2["payload_len"])
+        if len(payload) != h2["payload_len"]:
+            raise ValueError("Malformed stream: payload truncated")
+
+    h3, roi_bytes, stages = transcode_v2_to_v3(h2, table_entries, payload, bounds)
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    with open(dst, "wb") as f:
+        bitstream_v3.write_header(f, **h3)
+        f.write(roi_bytes)
+        for st in stages:
+            bitstream_v3.write_stage_header(f, st["k0"], st["k1"], len(st["table_entries"]), len(st["payload_bytes"]))
+            bitstream_v3.write_table(f, st["table_entries"])
+            f.write(st["payload_bytes"])
+    return dst, [len(st["payload_bytes"]) for st in stages]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, nargs="+", help="v2 .mmip file(s)")
+    ap.add_argument("--output", help="output path (single input)")
+    ap.add_argument("--outdir", help="output directory (same file names)")
+    ap.add_argument("--bands", type=int, nargs="+", help="interior zigzag band boundaries, e.g. 1 10 (default per block size)")
+    ap.add_argument("--workers", type=int, default=1, help="processes for multiple inputs")
+    args = ap.parse_args()
+
+    if args.output and len(args.input) == 1:
+        dsts = [args.output]
+    elif args.outdir:
+        dsts = [os.path.join(args.outdir, os.path.basename(p)) for p in args.input]
+    else:
+        raise ValueError("need --output (one input) or --outdir")
+
+    n = len(args.input)
+    if args.workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, n)) as ex:
+            results = list(ex.map(transcode_file, args.input, dsts, [args.bands] * n))
+    else:
+        results = [transcode_file(s, d, args.bands) for s, d in zip(args.input, dsts)]
+    for src, (dst, sizes) in zip(args.input, results):
+        print(f"[transcode_v2_v3] {src} -> {dst} stages=" + " ".join(f"{s}B" for s in sizes))
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import numpy as np
 
 def zigzag_indices(N: int):
@@ -31,4 +32,13 @@ def zigzag_unscan(vec: np.ndarray, N: int) -> np.ndarray:
     out = np.zeros((N, N), dtype=vec.dtype)
     for k, (r, c) in enumerate(idx):
         out[r, c] = vec[k]
-    return out
\ No newline at end of file
+    return out
+
+@lru_cache(maxsize=None)
+def zigzag_rc(N: int):
+    """Zigzag order as (rows, cols) int arrays, for vectorized gather/scatter (cached, read-only)."""
+    idx = np.array(zigzag_indices(N), dtype=np.intp).reshape(-1, 2)
+    rows, cols = idx[:, 0].copy(), idx[:, 1].copy()
+    rows.setflags(write=False)
+    cols.setflags(write=False)
+    return rows, cols